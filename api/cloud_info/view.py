@@ -1,16 +1,23 @@
-from typing import List, Literal
+from collections import defaultdict
+from typing import Dict, List, Literal, Optional, Union
 
-from fastapi import APIRouter, Path, Request
-from pydantic import BaseModel, conint
+from fastapi import APIRouter, Path, Query, Request
+from pydantic import BaseModel, conint, conlist, constr
 
 from db.models import NetworkNode, NetworkNodeDelay
-from utils.make_response import resp_200, resp_404
+from db.pagination import CountMode, decode_cursor, encode_cursor, paginate
+from db.telemetry import telemetry_coalescer
+from scheduler.snapshot import cluster_snapshot
+from utils.make_response import resp_200, resp_200_fast, resp_400, resp_404
 from utils.result_schema import ResultListModel, ResultModel
+from utils.single_flight import single_flight
 
 base_router = APIRouter()
 
+NetworkNodeModel = NetworkNode.get_pydantic(exclude={"mtime"})
 
-class NetworkNodeResponse(NetworkNode.get_pydantic()):
+
+class NetworkNodeResponse(NetworkNodeModel):
     class Delay(BaseModel):
         geo_place_id: int
         delay: int
@@ -18,29 +25,179 @@ class NetworkNodeResponse(NetworkNode.get_pydantic()):
     delay: List[Delay]
 
 
-@base_router.get("/nodes", response_model=ResultListModel[List[NetworkNode.get_pydantic()]],
+# max ids of one /nodes/detail call
+NODE_DETAIL_MAX_IDS = 1000
+# max nodes and max delays of one /nodes/telemetry call
+TELEMETRY_MAX_ROWS = 10000
+
+
+class NodeTelemetryModel(BaseModel):
+    """
+    inventory and / or remaining resources of a network node, only the given
+    fields are written; name, cpu, mem and disk are needed to add a node
+    """
+    id: conint(ge=1)
+    name: Optional[constr(max_length=32)]
+    cpu: Optional[conint(ge=0)]
+    mem: Optional[conint(ge=0)]
+    disk: Optional[conint(ge=0)]
+    cpu_rem: Optional[conint(ge=0)]
+    mem_rem: Optional[conint(ge=0)]
+    disk_rem: Optional[conint(ge=0)]
+
+
+class NodeDelayTelemetryModel(BaseModel):
+    node_id: conint(ge=1)
+    geo_place_id: conint(ge=1)
+    delay: conint(ge=0)
+
+
+class TelemetryModel(BaseModel):
+    nodes: conlist(NodeTelemetryModel, max_items=TELEMETRY_MAX_ROWS) = []
+    delays: conlist(NodeDelayTelemetryModel, max_items=TELEMETRY_MAX_ROWS) = []
+
+
+async def attach_delays(details: List[dict]) -> List[dict]:
+    """
+    set "delay" of every node detail with one IN query for all of them
+
+    :param details: NetworkNode dicts
+    :return: details
+    """
+    delays = defaultdict(list)
+    if details:
+        rows = await NetworkNodeDelay.objects.filter(node_id__in=[detail["id"] for detail in details]).values_list(
+            ["node_id", "geo_place_id", "delay"])
+        for node_id, geo_place_id, delay in rows:
+            delays[node_id].append({"geo_place_id": geo_place_id, "delay": delay})
+    for detail in details:
+        detail["delay"] = delays[detail["id"]]
+    return details
+
+
+@base_router.get("/nodes", response_model=ResultListModel[List[Union[NetworkNodeResponse, NetworkNodeModel]]],
                  summary="get network nodes split by page")
 async def list_network_nodes(sort_by: Literal["id"] = "id",
                              order_by: Literal["desc", "asc"] = "desc",
                              page: conint(ge=1) = 1,
-                             page_size: conint(ge=1) = 20):
+                             page_size: conint(ge=1) = 20,
+                             after: Optional[str] = Query(None, description="next_cursor of the previous page"),
+                             count_mode: CountMode = "exact",
+                             include: Optional[Literal["delay"]] = None):
     """
 
     :param sort_by:
     :param order_by:
-    :param page:
+    :param page: ignored when after is given
     :param page_size:
+    :param after:
+    :param count_mode:
+    :param include: delay to add the delays of every node
     :return:
     """
-    network_nodes_query_set = NetworkNode.objects
-    count = await network_nodes_query_set.count()
-    items = await network_nodes_query_set.order_by(getattr(getattr(NetworkNode, sort_by), order_by)()).paginate(
-        page=page, page_size=page_size).all()
-    return resp_200(data={"count": count, "items": items})
+    if cluster_snapshot.loaded:
+        try:
+            after_id = decode_cursor(after)[1] if after else None
+        except ValueError:
+            return resp_400(msg="invalid cursor")
+        items, has_next = cluster_snapshot.list_nodes(order_by=order_by, page=page, page_size=page_size,
+                                                      after_id=after_id, include_delay=include == "delay")
+        next_cursor = encode_cursor(items[-1]["id"], items[-1]["id"]) if has_next else None
+        count = cluster_snapshot.node_count if count_mode != "none" else None
+        return resp_200_fast(data={"count": count, "items": items, "next_cursor": next_cursor})
+
+    try:
+        data = await paginate(NetworkNode, sort_by, order_by, page, page_size, after=after, count_mode=count_mode)
+    except ValueError:
+        return resp_400(msg="invalid cursor")
+    data["items"] = [item.dict(exclude={"mtime"}) for item in data["items"]]
+    if include == "delay":
+        data["items"] = await attach_delays(data["items"])
+    return resp_200_fast(data=data)
+
+
+@base_router.get("/nodes/detail", response_model=ResultModel[List[NetworkNodeResponse]],
+                 summary="get information of several network nodes at once")
+async def list_network_node_details(ids: str = Query(description="comma separated network node ids")):
+    """
+    nodes are returned in the order of ids, unknown ids are skipped
+
+    :param ids:
+    :return:
+    """
+    try:
+        node_ids = list(dict.fromkeys(int(node_id) for node_id in ids.split(",") if node_id.strip()))
+    except ValueError:
+        return resp_400(msg="ids must be comma separated integers")
+    if len(node_ids) > NODE_DETAIL_MAX_IDS:
+        return resp_400(msg=f"at most {NODE_DETAIL_MAX_IDS} ids")
+
+    details = {}
+    if cluster_snapshot.loaded:
+        for node_id in node_ids:
+            detail = cluster_snapshot.get_node(node_id)
+            if detail:
+                details[node_id] = detail
+    # nodes added after the last refresh are not in the snapshot yet
+    missing = [node_id for node_id in node_ids if node_id not in details]
+    if missing:
+        network_nodes = await NetworkNode.objects.filter(id__in=missing).all()
+        for detail in await attach_delays([node.dict(exclude={"mtime"}) for node in network_nodes]):
+            details[detail["id"]] = detail
+    return resp_200(data=[details[node_id] for node_id in node_ids if node_id in details])
+
+
+@base_router.get("/nodes/reachable", response_model=ResultModel[Dict],
+                 summary="get network nodes reaching geo places within a delay")
+async def list_reachable_nodes(max_delay: conint(ge=0) = Query(description="max delay/ms"),
+                               geo_place_ids: Optional[str] = Query(
+                                   None, description="comma separated geo place ids, default all geo places")):
+    """
+    nodes whose delay to every given geo place is at most max_delay, nearest first
+
+    :param max_delay:
+    :param geo_place_ids:
+    :return:
+    """
+    geo_places = None
+    if geo_place_ids is not None:
+        try:
+            geo_places = [int(geo_place_id) for geo_place_id in geo_place_ids.split(",") if geo_place_id.strip()]
+        except ValueError:
+            return resp_400(msg="geo_place_ids must be comma separated integers")
+        # an empty list would mean no filter at all
+        if not geo_places:
+            return resp_400(msg="geo_place_ids is given but names no geo place")
+
+    if not cluster_snapshot.loaded:
+        await cluster_snapshot.refresh()
+    node_ids = cluster_snapshot.delay_index().node_ids_within(max_delay, geo_places).tolist()
+    return resp_200(data={"count": len(node_ids), "node_ids": node_ids})
+
+
+@base_router.post("/nodes/telemetry", response_model=ResultModel[Dict],
+                  summary="add or update network nodes and delays in bulk")
+async def upsert_node_telemetry(body: TelemetryModel):
+    """
+    updates are coalesced with those of other calls for a short window and
+    written in batches, the call returns once its rows are written
+
+    :param body:
+    :return: result of every node and every delay, in order; status is written,
+        coalesced (a later update of the same row was written), rejected or failed
+    """
+    node_results, delay_results = await telemetry_coalescer.submit(
+        [node.dict(exclude_none=True) for node in body.nodes], [delay.dict() for delay in body.delays])
+    return resp_200_fast(data={
+        "nodes": [{"id": node.id, **result} for node, result in zip(body.nodes, node_results)],
+        "delays": [{"node_id": delay.node_id, "geo_place_id": delay.geo_place_id, **result}
+                   for delay, result in zip(body.delays, delay_results)],
+    })
 
 
 @base_router.get("/node/{node_id}", response_model=ResultModel[NetworkNodeResponse],
                  summary="get information of specific network node")
+@single_flight
 async def get_network_node(request: Request, node_id: int = Path(description="network node id")):
     """
 
@@ -48,12 +205,14 @@ async def get_network_node(request: Request, node_id: int = Path(description="ne
     :param node_id:
     :return:
     """
+    # nodes added after the last refresh are not in the snapshot yet
+    detail = cluster_snapshot.get_node(node_id) if cluster_snapshot.loaded else None
+    if detail:
+        return resp_200_fast(data=detail)
+
     network_node = await NetworkNode.objects.get_or_none(id=node_id)
     if not network_node:
         return resp_404(data="no such record")
 
-    network_node_delay = await NetworkNodeDelay.objects.filter(node_id=network_node.id).all()
-    detail = network_node.dict()
-    network_node_delay = [{"geo_place_id": delay.geo_place_id, "delay": delay.delay} for delay in network_node_delay]
-    detail["delay"] = network_node_delay
-    return resp_200(data=detail)
+    detail, = await attach_delays([network_node.dict(exclude={"mtime"})])
+    return resp_200_fast(data=detail)
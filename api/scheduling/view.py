@@ -1,14 +1,31 @@
-from typing import Dict, List, Literal, Optional
-
-from fastapi import APIRouter, Request, Body
-from pydantic import BaseModel, conint
-
+import json
+from typing import AsyncIterator, Dict, List, Literal, Optional, Tuple
+
+import numpy as np
+from fastapi import APIRouter, Request, Body, Query
+from pydantic import BaseModel, ValidationError, confloat, conint, conlist
+
+from core import settings
+from db.cache import task_set_cache
+from db.database import database
+from db.ingest import BatchInserter
+from db.loaders import load_task_set_detail
 from db.models import TaskSet, Task, InterTaskContraints
-from utils.make_response import resp_200, resp_400, resp_404
+from db.pagination import CountMode, paginate
+from db.redis import redis_client
+from scheduler.dry_run import evaluate_all
+from scheduler.queue import enqueue_reschedule, enqueue_task_set
+from scheduler.reservation import release
+from scheduler.service import TASK_SET_FINISHED, TASK_SET_INCOMPLETE, TASK_SET_RUNNING, lock_task_set_state
+from utils.make_response import resp_200, resp_200_fast, resp_200_json, resp_400, resp_404
 from utils.result_schema import ResultListModel, ResultModel
+from utils.single_flight import single_flight
 
 base_router = APIRouter()
 
+# max candidate task sets of one dry run
+DRY_RUN_MAX_CANDIDATES = 16
+
 
 class TaskModel(BaseModel):
     """
@@ -39,6 +56,28 @@ class TaskSetModel(BaseModel):
     tasks: List[TaskModel]
     inter_task_constraints: List[InterTaskConstraintsModel]
     start_flag: bool
+    # seconds, places the task set with a portfolio of strategies and keeps the best, instead of the default one
+    time_budget: Optional[confloat(gt=0, le=settings.SOLVER_TIMEOUT)]
+
+
+class DryRunModel(BaseModel):
+    """
+    candidate task sets placed by the dry run, start_flag and time_budget of
+    the candidates are ignored
+    """
+    candidates: conlist(TaskSetModel, min_items=1, max_items=DRY_RUN_MAX_CANDIDATES)
+    # seconds, places every candidate with a portfolio of strategies and keeps the best
+    time_budget: Optional[confloat(gt=0, le=settings.SOLVER_TIMEOUT)]
+
+
+class TaskSetHeaderModel(BaseModel):
+    """
+    first line of a task set uploaded as NDJSON stream
+    """
+    name: str
+    task_count: conint(ge=1)
+    start_flag: bool
+    time_budget: Optional[confloat(gt=0, le=settings.SOLVER_TIMEOUT)]
 
 
 class TaskSetResponseModel(BaseModel):
@@ -54,172 +93,358 @@ class TaskSetResponseModel(BaseModel):
 async def list_task_sets(sort_by: Literal["ctime", "mtime"] = "ctime",
                          order_by: Literal["desc", "asc"] = "desc",
                          page: conint(ge=1) = 1,
-                         page_size: conint(ge=1) = 20):
+                         page_size: conint(ge=1) = 20,
+                         after: Optional[str] = Query(None, description="next_cursor of the previous page"),
+                         count_mode: CountMode = "exact"):
     """
 
     :param sort_by:
     :param order_by:
-    :param page:
+    :param page: ignored when after is given
     :param page_size:
+    :param after:
+    :param count_mode:
     :return:
     """
-    task_set_query_set = TaskSet.objects
-    count = await task_set_query_set.count()
-    items = await task_set_query_set.order_by(getattr(getattr(TaskSet, sort_by), order_by)()).paginate(
-        page=page, page_size=page_size).all()
-    return resp_200(data={"count": count, "items": items})
+    try:
+        data = await paginate(TaskSet, sort_by, order_by, page, page_size, after=after, count_mode=count_mode)
+    except ValueError:
+        return resp_400(msg="invalid cursor")
+    return resp_200_fast(data=data)
 
 
 @base_router.get("/task_set/{task_set_id}", response_model=ResultModel[TaskSetResponseModel],
                  summary="get specific task set and all tasks inside")
+@single_flight
 async def get_task_set(task_set_id: int):
-    task_set = await TaskSet.objects.select_related(["all_tasks", "all_inter_task_constraints"]).get_or_none(
-        id=task_set_id)
+    task_set = await task_set_cache.get_or_load_text(task_set_id, lambda: load_task_set_json(task_set_id))
     if not task_set:
         return resp_404()
-    return resp_200(data=task_set)
+    return resp_200_json(task_set)
 
 
-@base_router.post("/task_set", response_model=ResultModel[Dict], summary="create a scheduling task set")
-async def post_task_set(request: Request, body: TaskSetModel):
-    count = await TaskSet.objects.filter(name=body.name).count()
+async def load_task_set_json(task_set_id: int) -> Optional[str]:
+    detail = await load_task_set_detail(task_set_id)
+    return detail.json() if detail else None
+
+
+class IngestError(ValueError):
+    """invalid task set upload, the whole upload is rolled back"""
+
+
+def task_row(task_set_id: int, task: TaskModel) -> dict:
+    return {"task_set_id": task_set_id, "task_id": task.task_id, "cpu_dem": task.cpu_dem, "mem_dem": task.mem_dem,
+            "disk_dem": task.disk_dem, "delay_constraint": task.delay_constraint, "image_tag": task.image_tag}
+
+
+def itc_row(task_set_id: int, itc: InterTaskConstraintsModel) -> dict:
+    return {"task_set_id": task_set_id, "a_task_id": itc.a_task_id, "z_task_id": itc.z_task_id,
+            "bandwidth": itc.bandwidth, "delay": itc.delay}
+
+
+def constraint_stricter(old: InterTaskContraints, new: InterTaskConstraintsModel) -> bool:
+    """whether new asks for a lower delay or a higher bandwidth than old, None being no limit"""
+    delay = new.delay is not None and (old.delay is None or new.delay < old.delay)
+    bandwidth = new.bandwidth is not None and (old.bandwidth is None or new.bandwidth > old.bandwidth)
+    return delay or bandwidth
+
+
+async def create_task_set(creator_id: int, name: str, task_count: int, start_flag: bool) -> TaskSet:
+    count = await TaskSet.objects.filter(name=name).count()
     if count > 0:
-        return resp_400(msg="任务组标题已存在！")
+        raise IngestError("任务组标题已存在！")
 
-    task_set = TaskSet(name=body.name, creator_id=request.headers["user_id"], task_count=body.task_count)
-    if body.start_flag:
-        task_set.state = 1
+    task_set = TaskSet(name=name, creator_id=creator_id, task_count=task_count)
+    if start_flag:
+        task_set.state = TASK_SET_RUNNING
     else:
-        task_set.state = 0
+        task_set.state = TASK_SET_INCOMPLETE
 
     await task_set.save()
+    return task_set
 
-    tasks: List[Task] = []
-    for task in body.tasks:
-        task_orm = Task(
-            task_set_id=task_set.id,
-            task_id=task.task_id,
-            cpu_dem=task.cpu_dem,
-            mem_dem=task.mem_dem,
-            disk_dem=task.disk_dem,
-            delay_constraint=task.delay_constraint,
-            image_tag=task.image_tag,
-            task_set=task_set
-        )
-        tasks.append(task_orm)
-
-    await Task.objects.bulk_create(tasks)
-
-    inter_task_constraints: List[InterTaskContraints] = []
-    for itc in body.inter_task_constraints:
-        itc_orm = InterTaskContraints(
-            task_set_id=task_set.id,
-            a_task_id=itc.a_task_id,
-            z_task_id=itc.z_task_id,
-            bandwidth=itc.bandwidth,
-            delay=itc.delay,
-            task_set=task_set
-        )
-        inter_task_constraints.append(itc_orm)
-
-    await InterTaskContraints.objects.bulk_create(inter_task_constraints)
+
+@base_router.post("/task_set", response_model=ResultModel[Dict], summary="create a scheduling task set")
+async def post_task_set(request: Request, body: TaskSetModel):
+    try:
+        async with database.transaction():
+            task_set = await create_task_set(request.headers["user_id"], body.name, body.task_count,
+                                             body.start_flag)
+
+            tasks = BatchInserter(Task)
+            for task in body.tasks:
+                await tasks.add(task_row(task_set.id, task))
+            await tasks.flush()
+
+            inter_task_constraints = BatchInserter(InterTaskContraints)
+            for itc in body.inter_task_constraints:
+                await inter_task_constraints.add(itc_row(task_set.id, itc))
+            await inter_task_constraints.flush()
+    except IngestError as e:
+        return resp_400(msg=str(e))
+
+    if body.start_flag:
+        await enqueue_task_set(redis_client, task_set.id, body.time_budget)
 
     return resp_200(data={"id": task_set.id, "is_running": body.start_flag})
 
 
+@base_router.post("/task_set/dry_run", response_model=ResultModel[List[Dict]],
+                  summary="place candidate task sets against the current cluster without saving anything")
+async def dry_run_task_sets(body: DryRunModel):
+    candidates = []
+    for candidate in body.candidates:
+        task_ids = [task.task_id for task in candidate.tasks]
+        if len(set(task_ids)) != len(task_ids):
+            return resp_400(msg=f"duplicate task_id in candidate {candidate.name}")
+        candidates.append((
+            candidate.name,
+            [(task.task_id, task.cpu_dem, task.mem_dem, task.disk_dem, task.delay_constraint)
+             for task in candidate.tasks],
+            [(itc.a_task_id, itc.z_task_id, itc.bandwidth, itc.delay) for itc in candidate.inter_task_constraints],
+        ))
+    return resp_200_fast(data=await evaluate_all(candidates, budget=body.time_budget))
+
+
+async def ndjson_lines(request: Request) -> AsyncIterator[bytes]:
+    """non-empty lines of the request body, read chunk by chunk"""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+def parse_line(model, item: dict, line_no: int):
+    try:
+        return model.parse_obj(item)
+    except ValidationError as e:
+        raise IngestError(f"line {line_no}: {e}")
+
+
+async def ingest_task_set(creator_id: int, lines: AsyncIterator[bytes]) -> Tuple[TaskSet, TaskSetHeaderModel]:
+    """
+    validate a streamed task set line by line and write it in bounded batches,
+    must run inside a transaction
+
+    :param creator_id:
+    :param lines:
+    :return: the created task set, the header line
+    """
+    task_set, tasks, inter_task_constraints = None, None, None
+    header = None
+    # only task ids are kept, to check uniqueness and constraint references
+    task_ids = set()
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        try:
+            item = json.loads(line)
+        except ValueError:
+            raise IngestError(f"line {line_no}: invalid json")
+        if not isinstance(item, dict):
+            raise IngestError(f"line {line_no}: expect a json object")
+
+        if header is None:
+            header = parse_line(TaskSetHeaderModel, item, line_no)
+            task_set = await create_task_set(creator_id, header.name, header.task_count, header.start_flag)
+            tasks = BatchInserter(Task)
+            inter_task_constraints = BatchInserter(InterTaskContraints)
+            continue
+
+        item_type = item.pop("type", None)
+        if item_type == "task":
+            task = parse_line(TaskModel, item, line_no)
+            if task.task_id in task_ids:
+                raise IngestError(f"line {line_no}: duplicate task_id {task.task_id}")
+            task_ids.add(task.task_id)
+            await tasks.add(task_row(task_set.id, task))
+        elif item_type == "inter_task_constraint":
+            itc = parse_line(InterTaskConstraintsModel, item, line_no)
+            if itc.a_task_id not in task_ids or itc.z_task_id not in task_ids:
+                raise IngestError(f"line {line_no}: constraint refers to a task not sent before it")
+            await inter_task_constraints.add(itc_row(task_set.id, itc))
+        else:
+            raise IngestError(f"line {line_no}: unknown type {item_type}")
+
+    if header is None:
+        raise IngestError("empty upload")
+    if len(task_ids) != header.task_count:
+        raise IngestError(f"task_count is {header.task_count} but {len(task_ids)} tasks were sent")
+    await tasks.flush()
+    await inter_task_constraints.flush()
+    return task_set, header
+
+
+@base_router.post("/task_set/stream", response_model=ResultModel[Dict],
+                  summary="create a scheduling task set from a NDJSON stream")
+async def stream_task_set(request: Request):
+    """
+    The body is NDJSON, sent as one body or chunked. The first line is a
+    TaskSetHeaderModel, every other line a TaskModel with "type": "task" or an
+    InterTaskConstraintsModel with "type": "inter_task_constraint". A constraint
+    may only refer to tasks sent before it. Rows are written in bounded batches
+    in one transaction, nothing is kept when the upload fails.
+
+    :param request:
+    :return:
+    """
+    try:
+        async with database.transaction():
+            task_set, header = await ingest_task_set(request.headers["user_id"], ndjson_lines(request))
+    except IngestError as e:
+        return resp_400(msg=str(e))
+
+    is_running = task_set.state == TASK_SET_RUNNING
+    if is_running:
+        await enqueue_task_set(redis_client, task_set.id, header.time_budget)
+
+    return resp_200(data={"id": task_set.id, "is_running": is_running})
+
+
 @base_router.put("/task_set", response_model=ResultModel[Dict], summary="update a scheduling task set")
 async def put_task_set(request: Request, body: TaskSetModel = Body()):
+    """
+    apply the differences to the stored task set
+
+    The task set row is locked while editing. A placement computed meanwhile
+    notices the edit before it is written and places the task set again. A
+    finished task set keeps its placement: deleted and edited tasks give their
+    capacity back and the scheduler only places the tasks the edit touched,
+    with their constraint neighbours. A new image tag and constraints that got
+    looser leave the placement alone.
+
+    :param request:
+    :param body:
+    :return:
+    """
     if not body.task_set_id:
         return resp_404()
-    task_set = await TaskSet.objects.select_related(["all_tasks", "all_inter_task_constraints"]).get_or_none(
-        id=body.task_set_id)
-    if not task_set:
-        return resp_404()
-    if task_set.state == 2:
-        return resp_404()
-
-    if task_set.name != body.name:
-        count = await TaskSet.objects.filter(name=body.name).count()
-        if count > 0:
-            return resp_400()
-
-    # if request.headers["user_id"] != task_set.creator_id:
-    #     return resp_400()
-
-    if task_set.state == 1:
-        return resp_400()
-
-    raw_tasks = {task.task_id: task for task in task_set.all_tasks}
-    new_tasks = []
-    update_tasks = []
-    for task in body.tasks:
-        if task.task_id in raw_tasks:
-            raw_task = raw_tasks.pop(task.task_id)
-            if task.cpu_dem != raw_task.cpu_dem or task.mem_dem != raw_task.mem_dem \
-                    or task.disk_dem != raw_task.disk_dem or task.delay_constraint != raw_task.delay_constraint \
-                    or task.image_tag != raw_task.image_tag:
-                raw_task.cpu_dem = task.cpu_dem
-                raw_task.mem_dem = task.mem_dem
-                raw_task.disk_dem = task.disk_dem
-                raw_task.delay_constraint = task.delay_constraint
-                raw_task.image_tag = task.image_tag
-
-                update_tasks.append(raw_task)
+    async with database.transaction():
+        state = await lock_task_set_state(body.task_set_id)
+        if state is None:
+            return resp_404()
+        detail = await load_task_set_detail(body.task_set_id)
+        task_set = detail.task_set
+        placed = state == TASK_SET_FINISHED
+
+        if task_set.name != body.name:
+            count = await TaskSet.objects.filter(name=body.name).count()
+            if count > 0:
+                return resp_400()
+
+        # if request.headers["user_id"] != task_set.creator_id:
+        #     return resp_400()
+
+        # (node_id, cpu, mem, disk) of placed tasks that are deleted or edited
+        released = []
+        raw_tasks = {task.task_id: task for task in detail.tasks}
+        new_tasks = []
+        update_tasks = []
+        # tasks whose image tag is all that changed, it plays no part in placement so they stay where they are
+        retag_tasks = []
+        for task in body.tasks:
+            if task.task_id in raw_tasks:
+                raw_task = raw_tasks.pop(task.task_id)
+                if task.cpu_dem != raw_task.cpu_dem or task.mem_dem != raw_task.mem_dem \
+                        or task.disk_dem != raw_task.disk_dem or task.delay_constraint != raw_task.delay_constraint:
+                    if raw_task.node_id is not None:
+                        released.append((raw_task.node_id, raw_task.cpu_dem, raw_task.mem_dem, raw_task.disk_dem))
+                        raw_task.node_id = None
+                    raw_task.cpu_dem = task.cpu_dem
+                    raw_task.mem_dem = task.mem_dem
+                    raw_task.disk_dem = task.disk_dem
+                    raw_task.delay_constraint = task.delay_constraint
+                    raw_task.image_tag = task.image_tag
+
+                    update_tasks.append(raw_task)
+                elif task.image_tag != raw_task.image_tag:
+                    raw_task.image_tag = task.image_tag
+                    retag_tasks.append(raw_task)
                 continue
 
-        new_task = Task(
-            task_set_id=task_set.id,
-            task_id=task.task_id,
-            cpu_dem=task.cpu_dem,
-            mem_dem=task.mem_dem,
-            disk_dem=task.disk_dem,
-            delay_constraint=task.delay_constraint,
-            image_tag=task.image_tag,
-            task_set=task_set
-        )
-
-        new_tasks.append(new_task)
-
-    if new_tasks:
-        await Task.objects.bulk_create(new_tasks)
-    if update_tasks:
-        await Task.objects.bulk_update(update_tasks)
-    if raw_tasks:
-        await Task.objects.filter(id__in=[task.id for task in raw_tasks.values()]).delete()
-
-    raw_itcs = {(itc.a_task_id, itc.z_task_id): itc for itc in task_set.all_inter_task_constraints}
-    new_itcs = []
-    update_itcs = []
-    for itc in body.inter_task_constraints:
-        if (itc.a_task_id, itc.z_task_id) in raw_itcs:
-            raw_itc = raw_itcs.pop((itc.a_task_id, itc.z_task_id))
-            if itc.bandwidth != raw_itc.bandwidth or itc.delay != raw_itc.delay:
-                raw_itc.delay = itc.delay
-                raw_itc.bandwidth = itc.bandwidth
-
-                update_itcs.append(raw_itc)
+            new_task = Task(
+                task_set_id=task_set.id,
+                task_id=task.task_id,
+                cpu_dem=task.cpu_dem,
+                mem_dem=task.mem_dem,
+                disk_dem=task.disk_dem,
+                delay_constraint=task.delay_constraint,
+                image_tag=task.image_tag,
+                task_set=task_set
+            )
+
+            new_tasks.append(new_task)
+
+        if new_tasks:
+            await Task.objects.bulk_create(new_tasks)
+        if update_tasks:
+            await Task.objects.bulk_update(
+                update_tasks, columns=["cpu_dem", "mem_dem", "disk_dem", "delay_constraint", "image_tag", "node_id"])
+        if retag_tasks:
+            await Task.objects.bulk_update(retag_tasks, columns=["image_tag"])
+        if raw_tasks:
+            released.extend((task.node_id, task.cpu_dem, task.mem_dem, task.disk_dem)
+                            for task in raw_tasks.values() if task.node_id is not None)
+            await Task.objects.filter(id__in=[task.id for task in raw_tasks.values()]).delete()
+
+        raw_itcs = {(itc.a_task_id, itc.z_task_id): itc for itc in detail.inter_task_constraints}
+        new_itcs = []
+        update_itcs = []
+        # new constraints and updated ones that got stricter, they may not hold where their tasks are now
+        stricter_itcs = []
+        for itc in body.inter_task_constraints:
+            if (itc.a_task_id, itc.z_task_id) in raw_itcs:
+                raw_itc = raw_itcs.pop((itc.a_task_id, itc.z_task_id))
+                if itc.bandwidth != raw_itc.bandwidth or itc.delay != raw_itc.delay:
+                    if constraint_stricter(raw_itc, itc):
+                        stricter_itcs.append(raw_itc)
+                    raw_itc.delay = itc.delay
+                    raw_itc.bandwidth = itc.bandwidth
+
+                    update_itcs.append(raw_itc)
                 continue
 
-        new_itc = InterTaskContraints(
-            task_set_id=task_set.id,
-            a_task_id=itc.a_task_id,
-            z_task_id=itc.z_task_id,
-            bandwidth=itc.bandwidth,
-            delay=itc.delay,
-            task_set=task_set
-        )
-
-        new_itcs.append(new_itc)
-
-    if new_itcs:
-        await InterTaskContraints.objects.bulk_create(new_itcs)
-    if update_itcs:
-        await InterTaskContraints.objects.bulk_update(update_itcs)
-    if raw_itcs:
-        await InterTaskContraints.objects.filter(id__in=[itc.id for itc in raw_itcs.values()]).delete()
-
-    if body.start_flag == 1:
-        task_set.state = 1
-        await task_set.save()
-
-    return resp_200(data={"id": task_set.id, "is_running": body.start_flag})
+            new_itc = InterTaskContraints(
+                task_set_id=task_set.id,
+                a_task_id=itc.a_task_id,
+                z_task_id=itc.z_task_id,
+                bandwidth=itc.bandwidth,
+                delay=itc.delay,
+                task_set=task_set
+            )
+
+            new_itcs.append(new_itc)
+            stricter_itcs.append(new_itc)
+
+        if new_itcs:
+            await InterTaskContraints.objects.bulk_create(new_itcs)
+        if update_itcs:
+            await InterTaskContraints.objects.bulk_update(update_itcs, columns=["bandwidth", "delay"])
+        if raw_itcs:
+            await InterTaskContraints.objects.filter(id__in=[itc.id for itc in raw_itcs.values()]).delete()
+
+        if released:
+            rows = np.array(released, dtype=np.int64)
+            await release(rows[:, 0], rows[:, 1:])
+        changes = {}
+        if task_set.name != body.name:
+            changes["name"] = body.name
+        start = body.start_flag and state == TASK_SET_INCOMPLETE
+        if start:
+            changes["state"] = TASK_SET_RUNNING
+        if changes:
+            await task_set.update(**changes)
+    await task_set_cache.invalidate(task_set.id)
+
+    moved_task_ids = {task_id for itc in stricter_itcs for task_id in (itc.a_task_id, itc.z_task_id)}
+    if placed and (new_tasks or update_tasks or moved_task_ids):
+        await enqueue_reschedule(redis_client, task_set.id, moved_task_ids)
+    elif start:
+        await enqueue_task_set(redis_client, task_set.id, body.time_budget)
+
+    return resp_200(data={"id": task_set.id, "is_running": state == TASK_SET_RUNNING or start})
@@ -0,0 +1,207 @@
+"""
+scheduling benchmark
+
+Runs the placement engine on synthetic clusters and task sets of growing
+size, fully offline, and prints one JSON document:
+
+    python -m benchmark.run --tiers small,medium --output bench.json
+    python -m benchmark.run --baseline bench.json
+
+With --baseline the run exits with 1 when the median latency of a tier got
+slower than the tolerance allows, or its placed ratio dropped.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from benchmark.synthetic import generate_cluster, generate_task_set
+from scheduler.engine import UNPLACED, ClusterArrays, Placement, TaskArrays, build_cluster_arrays, \
+    build_task_arrays, place
+from scheduler.executor import SolverPool
+from scheduler.graph import ConstraintGraph, build_constraint_graph, connected_components
+from scheduler.topology import all_pairs
+
+# nodes, geo places, tasks and constraints per task of every tier
+TIERS = {
+    "small": dict(node_count=100, geo_place_count=5, task_count=500, density=1.0),
+    "medium": dict(node_count=500, geo_place_count=10, task_count=2500, density=1.0),
+    "large": dict(node_count=2000, geo_place_count=20, task_count=10000, density=1.0),
+}
+LINK_DEGREE = 3
+GROUP_SIZE = 8
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "max": float(max(samples))}
+
+
+def placement_quality(cluster: ClusterArrays, tasks: TaskArrays, graph: ConstraintGraph,
+                      placement: Placement) -> dict:
+    """
+    placed ratio, packing and constraint checks of a placement
+
+    :param cluster:
+    :param tasks:
+    :param graph:
+    :param placement:
+    :return:
+    """
+    placed = placement.node_index != UNPLACED
+    used = placement.used(tasks, cluster.node_count)
+    used_nodes = used.any(axis=1)
+    utilization = used[used_nodes] / np.maximum(cluster.capacity[used_nodes], 1)
+
+    node_delay = cluster.max_delay()[placement.node_index[placed]]
+    delay_violations = int((node_delay > tasks.delay_constraint[placed]).sum())
+
+    src, dst = graph.sources(), graph.indices
+    both = placed[src] & placed[dst]
+    a, z = placement.node_index[src[both]], placement.node_index[dst[both]]
+    pair_violations = int(((cluster.link_delay[a, z] > graph.delay[both])
+                           | (cluster.link_bandwidth[a, z] < graph.bandwidth[both])).sum()) // 2
+
+    return {
+        "placed_ratio": float(placed.mean()) if tasks.task_count else 1.0,
+        "nodes_used": int(used_nodes.sum()),
+        "mean_utilization": utilization.mean(axis=0).round(4).tolist() if used_nodes.any() else [0.0] * 3,
+        "delay_violations": delay_violations,
+        "pair_violations": pair_violations,
+        "overcommitted_nodes": int((used > cluster.capacity).any(axis=1).sum()),
+    }
+
+
+def run_tier(name: str, repeat: int, seed: int, processes: int) -> dict:
+    """
+    generate one tier and time repeated placements
+
+    :param name: key of TIERS
+    :param repeat: timed placement runs
+    :param seed:
+    :param processes: 0 runs the engine inline, else place_components on a pool of that size
+    :return:
+    """
+    tier = TIERS[name]
+    rng = np.random.default_rng(seed)
+    synthetic_cluster = generate_cluster(tier["node_count"], tier["geo_place_count"], LINK_DEGREE, rng)
+    synthetic_tasks = generate_task_set(tier["task_count"], tier["density"], GROUP_SIZE, rng)
+
+    started = time.perf_counter()
+    cluster = build_cluster_arrays(synthetic_cluster.nodes, synthetic_cluster.delays)
+    tasks = build_task_arrays(synthetic_tasks.tasks)
+    graph = build_constraint_graph(tasks, synthetic_tasks.constraints)
+    build_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    cluster.link_delay, cluster.link_bandwidth = all_pairs(synthetic_cluster.links).align(cluster.node_ids)
+    topology_seconds = time.perf_counter() - started
+
+    pool = SolverPool(max_workers=processes, timeout=3600) if processes else None
+    latencies, placement = [], None
+    tracemalloc.start()
+    try:
+        if pool:
+            pool.start()
+            # first run pays the worker start up
+            asyncio.run(pool.place_components(cluster, tasks, graph))
+        for _ in range(repeat):
+            tracemalloc.reset_peak()
+            started = time.perf_counter()
+            if pool:
+                placement = asyncio.run(pool.place_components(cluster, tasks, graph))
+            else:
+                placement = place(cluster, tasks, graph=graph)
+            latencies.append(time.perf_counter() - started)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        if pool:
+            pool.shutdown()
+
+    latency = percentiles(latencies)
+    return {
+        "tier": name,
+        **tier,
+        "constraint_count": graph.edge_count,
+        "component_count": int(len(np.unique(connected_components(graph)))),
+        "processes": processes,
+        "repeat": repeat,
+        "build_seconds": build_seconds,
+        "topology_seconds": topology_seconds,
+        "latency_seconds": latency,
+        "tasks_per_second": tasks.task_count / latency["p50"] if latency["p50"] else None,
+        # in the parent process only when a pool is used
+        "peak_memory_mb": peak / 2 ** 20,
+        "quality": placement_quality(cluster, tasks, graph, placement),
+    }
+
+
+def regressions(results: List[dict], baseline: dict, tolerance: float) -> List[str]:
+    """
+    tiers that got slower or place fewer tasks than in the baseline
+
+    :param results:
+    :param baseline: an earlier output of this script
+    :param tolerance: allowed relative slow down of the median latency
+    :return: human readable findings
+    """
+    before = {result["tier"]: result for result in baseline.get("results", [])}
+    findings = []
+    for result in results:
+        old = before.get(result["tier"])
+        if old is None:
+            continue
+        new_p50, old_p50 = result["latency_seconds"]["p50"], old["latency_seconds"]["p50"]
+        if new_p50 > old_p50 * (1 + tolerance):
+            findings.append(f"{result['tier']}: p50 {old_p50:.4f}s -> {new_p50:.4f}s")
+        new_ratio, old_ratio = result["quality"]["placed_ratio"], old["quality"]["placed_ratio"]
+        if new_ratio < old_ratio:
+            findings.append(f"{result['tier']}: placed ratio {old_ratio:.4f} -> {new_ratio:.4f}")
+    return findings
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="synthetic scheduling benchmark")
+    parser.add_argument("--tiers", default="small,medium", help=f"comma separated, of {', '.join(TIERS)}")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per tier")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=0, help="solver processes, 0 runs inline")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    parser.add_argument("--baseline", help="JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative p50 slow down")
+    args = parser.parse_args(argv)
+
+    results = [run_tier(name, args.repeat, args.seed, args.processes) for name in args.tiers.split(",")]
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            findings = regressions(results, json.load(f), args.tolerance)
+        for finding in findings:
+            print(f"regression {finding}", file=sys.stderr)
+        return 1 if findings else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
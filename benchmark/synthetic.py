@@ -0,0 +1,90 @@
+"""
+synthetic clusters and task sets
+
+Rows have the same shape as the columns the scheduler loads from MySQL, so
+they go through the same build_* functions as production data.
+"""
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+
+from scheduler.engine import DelayRow, NodeRow, TaskRow
+from scheduler.graph import ConstraintRow
+from scheduler.topology import LinkRow
+
+
+@dataclass
+class SyntheticCluster:
+    """ 合成集群 """
+    nodes: List[NodeRow]
+    delays: List[DelayRow]
+    links: List[LinkRow]
+
+
+@dataclass
+class SyntheticTaskSet:
+    """ 合成任务集 """
+    tasks: List[TaskRow]
+    constraints: List[ConstraintRow]
+
+
+def generate_cluster(node_count: int, geo_place_count: int, link_degree: int,
+                     rng: np.random.Generator) -> SyntheticCluster:
+    """
+    nodes with random capacity, a full node x geo place delay matrix and a
+    connected random link topology
+
+    :param node_count: network_node rows
+    :param geo_place_count: geo places every node has a delay to
+    :param link_degree: random links per node on top of a ring that keeps the topology connected
+    :param rng:
+    :return:
+    """
+    node_ids = np.arange(1, node_count + 1)
+    capacity = np.stack([rng.choice([16, 32, 64], node_count),
+                         rng.choice([64, 128, 256], node_count),
+                         rng.choice([500, 1000, 2000], node_count)], axis=1)
+    nodes = [(int(node_id), *map(int, row)) for node_id, row in zip(node_ids, capacity)]
+
+    delay = rng.integers(1, 200, (node_count, geo_place_count))
+    delays = [(int(node_ids[row]), geo_place_id + 1, int(delay[row, geo_place_id]))
+              for row in range(node_count) for geo_place_id in range(geo_place_count)]
+
+    a = np.concatenate([node_ids, np.repeat(node_ids, link_degree)])
+    z = np.concatenate([np.roll(node_ids, -1), rng.choice(node_ids, node_count * link_degree)])
+    keep = a != z
+    link_delay = rng.integers(1, 20, keep.sum())
+    link_bandwidth = rng.choice([100, 1000, 10000], keep.sum())
+    links = list(zip(a[keep].tolist(), z[keep].tolist(), link_delay.tolist(), link_bandwidth.tolist()))
+    return SyntheticCluster(nodes=nodes, delays=delays, links=links)
+
+
+def generate_task_set(task_count: int, density: float, group_size: int,
+                      rng: np.random.Generator) -> SyntheticTaskSet:
+    """
+    tasks with random demand and an inter task constraint graph
+
+    Constraints only join tasks of the same group of group_size consecutive
+    tasks, which gives the graph many components like real task sets.
+
+    :param task_count: task rows
+    :param density: inter task constraints per task
+    :param group_size: tasks per group that constraints are drawn from
+    :param rng:
+    :return:
+    """
+    demand = np.stack([rng.integers(1, 9, task_count), rng.integers(1, 17, task_count),
+                       rng.integers(1, 51, task_count)], axis=1)
+    delay_constraint = rng.integers(100, 300, task_count)
+    tasks = [(task_id, *map(int, row), int(limit))
+             for task_id, (row, limit) in enumerate(zip(demand, delay_constraint))]
+
+    edge_count = int(task_count * density)
+    a = rng.integers(0, task_count, edge_count)
+    z = (a // group_size) * group_size + rng.integers(0, group_size, edge_count)
+    keep = (z < task_count) & (a != z)
+    bandwidth = rng.choice([10, 50, 100], keep.sum())
+    delay = rng.integers(20, 80, keep.sum())
+    constraints = list(zip(a[keep].tolist(), z[keep].tolist(), bandwidth.tolist(), delay.tolist()))
+    return SyntheticTaskSet(tasks=tasks, constraints=constraints)
@@ -0,0 +1,126 @@
+"""
+versioned read-through cache
+
+Values live in redis under a key carrying a version number; writers bump the
+version instead of deleting, so a reader racing a writer can only fill a key
+nobody reads anymore. A small in-process LRU sits in front of redis and holds
+values for a short time only, which bounds how stale other processes can be.
+"""
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from aioredis.exceptions import RedisError
+
+from core import settings
+from db.redis import RedisPlus, redis_client
+
+logger = logging.getLogger("app")
+
+
+class LocalLRU:
+    """ 进程内带过期时间的 LRU """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expire_at, value = item
+        if expire_at < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+
+class VersionedCache:
+    """ redis 版本化读穿缓存 """
+
+    def __init__(self, redis: RedisPlus, namespace: str, ttl: int = settings.CACHE_TTL,
+                 local_size: int = settings.LOCAL_CACHE_SIZE, local_ttl: float = settings.LOCAL_CACHE_TTL):
+        self.redis = redis
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = LocalLRU(local_size, local_ttl)
+
+    def version_key(self, key: Hashable) -> str:
+        return f"{self.namespace}:{key}:ver"
+
+    def data_key(self, key: Hashable, version: int) -> str:
+        return f"{self.namespace}:{key}:v{version}"
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Optional[str]]]) -> Optional[Any]:
+        """
+        cached value of a key, loaded and cached on a miss
+
+        :param key:
+        :param loader: returns the json text of the value, None if it doesn't exist
+        :return: decoded value, None if the loader found nothing
+        """
+        text = await self.get_or_load_text(key, loader)
+        return None if text is None else json.loads(text)
+
+    async def get_or_load_text(self, key: Hashable, loader: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+        """
+        same as get_or_load but returns the json text as cached, for responses
+        that embed it without decoding
+
+        :param key:
+        :param loader: returns the json text of the value, None if it doesn't exist
+        :return: json text, None if the loader found nothing
+        """
+        text = self.local.get(key)
+        if text is not None:
+            return text
+
+        try:
+            version = int(await self.redis.get(self.version_key(key)) or 0)
+            text = await self.redis.get(self.data_key(key, version))
+        except RedisError:
+            logger.exception("read cache %s failed", key)
+            version, text = None, None
+
+        if text is None:
+            text = await loader()
+            if text is None:
+                return None
+            if version is not None:
+                try:
+                    await self.redis.set(self.data_key(key, version), text, ex=self.ttl)
+                except RedisError:
+                    logger.exception("write cache %s failed", key)
+        elif isinstance(text, bytes):
+            text = text.decode()
+
+        self.local.set(key, text)
+        return text
+
+    async def invalidate(self, key: Hashable):
+        """make every cached copy of a key unreachable"""
+        self.local.pop(key)
+        try:
+            await self.redis.incr(self.version_key(key))
+        except RedisError:
+            logger.exception("invalidate cache %s failed", key)
+
+
+task_set_cache = VersionedCache(redis_client, "tango:task_set")
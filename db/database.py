@@ -1,13 +1,41 @@
+import functools
+import time
 from datetime import datetime
-from typing import List, Any
+from typing import Any, Awaitable, Callable, List
 
 import ormar
 from databases import Database
 from sqlalchemy import Enum, MetaData
 
 from core import settings
+from utils.metrics import record_query
 
-database = Database(settings.DATABASE_URL, pool_recycle=300)
+
+def _timed(method: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """Database method recording the time of every call with record_query"""
+
+    @functools.wraps(method)
+    async def timed(self, *args: Any, **kwargs: Any):
+        started = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            record_query(time.perf_counter() - started)
+
+    return timed
+
+
+class InstrumentedDatabase(Database):
+    """Database accounting every query to the current request, see utils.metrics"""
+
+    fetch_all = _timed(Database.fetch_all)
+    fetch_one = _timed(Database.fetch_one)
+    fetch_val = _timed(Database.fetch_val)
+    execute = _timed(Database.execute)
+    execute_many = _timed(Database.execute_many)
+
+
+database = InstrumentedDatabase(settings.DATABASE_URL, pool_recycle=300)
 
 
 async def init_db_pool():
@@ -0,0 +1,49 @@
+"""bounded batch inserts for large task sets, and batched upserts"""
+from typing import List, Sequence, Type
+
+import ormar
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from core import settings
+from db.database import database
+
+
+class BatchInserter:
+    """
+    buffer rows and write them with multi-row INSERTs of at most batch_size rows
+
+    Rows are plain column dicts, no ormar model is built for them. Run it inside
+    a transaction to make the whole ingest atomic.
+    """
+
+    def __init__(self, model: Type[ormar.Model], batch_size: int = settings.INGEST_BATCH_SIZE):
+        self.table = model.Meta.table
+        self.batch_size = batch_size
+        self.count = 0
+        self._rows: List[dict] = []
+
+    async def add(self, row: dict):
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self._rows:
+            return
+        await database.execute(self.table.insert().values(self._rows))
+        self.count += len(self._rows)
+        self._rows = []
+
+
+async def upsert(model: Type[ormar.Model], rows: List[dict], update_columns: Sequence[str]):
+    """
+    one multi-row INSERT ... ON DUPLICATE KEY UPDATE
+
+    :param model:
+    :param rows: column dicts with the same keys, complete enough to be inserted
+    :param update_columns: columns overwritten on rows that already exist
+    :return:
+    """
+    statement = mysql_insert(model.Meta.table).values(rows)
+    statement = statement.on_duplicate_key_update({column: statement.inserted[column] for column in update_columns})
+    await database.execute(statement)
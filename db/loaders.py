@@ -0,0 +1,50 @@
+"""
+set based loading of task sets with their relations
+
+select_related on both one-to-many relations of TaskSet joins them into
+len(tasks) x len(constraints) rows. Loading each relation with its own query
+keeps the row count at len(tasks) + len(constraints).
+"""
+import asyncio
+import json
+from typing import List, NamedTuple, Optional
+
+from pydantic.json import pydantic_encoder
+
+from db.models import InterTaskContraints, Task, TaskSet
+
+RELATIONS = {"all_tasks", "all_inter_task_constraints"}
+
+
+class TaskSetDetail(NamedTuple):
+    task_set: TaskSet
+    tasks: List[Task]
+    inter_task_constraints: List[InterTaskContraints]
+
+    def dict(self) -> dict:
+        """same shape as the task set loaded with select_related"""
+        detail = self.task_set.dict(exclude=RELATIONS)
+        detail["all_tasks"] = [task.dict(exclude={"task_set"}) for task in self.tasks]
+        detail["all_inter_task_constraints"] = [itc.dict(exclude={"task_set"}) for itc in self.inter_task_constraints]
+        return detail
+
+    def json(self) -> str:
+        return json.dumps(self.dict(), default=pydantic_encoder)
+
+
+async def load_task_set_detail(task_set_id: int) -> Optional[TaskSetDetail]:
+    """
+    load a task set, its tasks and its inter task constraints with three
+    concurrent queries
+
+    :param task_set_id:
+    :return: None if there is no such task set
+    """
+    task_set, tasks, inter_task_constraints = await asyncio.gather(
+        TaskSet.objects.get_or_none(id=task_set_id),
+        Task.objects.filter(task_set_id=task_set_id).all(),
+        InterTaskContraints.objects.filter(task_set_id=task_set_id).all(),
+    )
+    if not task_set:
+        return None
+    return TaskSetDetail(task_set=task_set, tasks=tasks, inter_task_constraints=inter_task_constraints)
@@ -28,6 +28,9 @@ class NetworkNode(ormar.Model):
     cpu_rem: int = ormar.Integer()
     mem_rem: int = ormar.Integer()
     disk_rem: int = ormar.Integer()
+    mtime: datetime = ormar.DateTime(
+        server_default=func.now(),
+        default=datetime.now, timezone=True)
 
 
 class NetworkNodeDelay(ormar.Model):
@@ -38,6 +41,23 @@ class NetworkNodeDelay(ormar.Model):
     node_id: int = ormar.Integer()
     geo_place_id: int = ormar.Integer()
     delay: int = ormar.Integer()
+    mtime: datetime = ormar.DateTime(
+        server_default=func.now(),
+        default=datetime.now, timezone=True)
+
+
+class NetworkLink(ormar.Model):
+    class Meta(BaseMeta):
+        tablename = 'network_link'
+
+    id: int = ormar.Integer(primary_key=True)
+    a_node_id: int = ormar.Integer()
+    z_node_id: int = ormar.Integer()
+    delay: int = ormar.Integer()
+    bandwidth: int = ormar.Integer()
+    mtime: datetime = ormar.DateTime(
+        server_default=func.now(),
+        default=datetime.now, timezone=True)
 
 
 class TaskSet(ormar.Model):
@@ -0,0 +1,112 @@
+"""
+offset and keyset pagination of ormar query sets
+
+Keyset pages are addressed by an opaque cursor holding the (sort key, id) of the
+last row of the previous page, so deep pages cost the same as the first one.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Literal, Optional, Tuple, Type
+
+import ormar
+from ormar.queryset import QuerySet
+from ormar.queryset.clause import FilterGroup
+
+from db.database import database
+
+# how the total row count of a page is computed
+CountMode = Literal["exact", "approx", "none"]
+
+
+def encode_cursor(sort_value: Any, row_id: int) -> str:
+    """
+    build the opaque cursor pointing after a row
+
+    :param sort_value: value of the sort key of the row
+    :param row_id:
+    :return:
+    """
+    if isinstance(sort_value, datetime):
+        payload = {"dt": sort_value.isoformat(), "id": row_id}
+    else:
+        payload = {"v": sort_value, "id": row_id}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, int]:
+    """
+    read a cursor made by encode_cursor
+
+    :param cursor:
+    :return: (sort value, id)
+    :raise ValueError: if the cursor is malformed
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        sort_value = datetime.fromisoformat(payload["dt"]) if "dt" in payload else payload["v"]
+        return sort_value, int(payload["id"])
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError("invalid cursor") from e
+
+
+async def approximate_count(model: Type[ormar.Model]) -> Optional[int]:
+    """row count estimated by InnoDB table statistics, no table scan"""
+    return await database.fetch_val(
+        "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table",
+        {"table": model.Meta.tablename})
+
+
+async def count_rows(query_set: QuerySet, model: Type[ormar.Model], count_mode: CountMode) -> Optional[int]:
+    if count_mode == "exact":
+        return await query_set.count()
+    if count_mode == "approx":
+        return await approximate_count(model)
+    return None
+
+
+def keyset_filter(sort_by: str, order_by: str, after: Tuple[Any, int]) -> FilterGroup:
+    """rows strictly after the cursor in (sort key, id) order"""
+    sort_value, row_id = after
+    op = "lt" if order_by == "desc" else "gt"
+    if sort_by == "id":
+        return ormar.and_(**{f"id__{op}": row_id})
+    return ormar.or_(ormar.and_(**{f"{sort_by}__{op}": sort_value}),
+                     ormar.and_(**{sort_by: sort_value, f"id__{op}": row_id}))
+
+
+async def paginate(model: Type[ormar.Model], sort_by: str, order_by: str, page: int, page_size: int,
+                   after: Optional[str] = None, count_mode: CountMode = "exact") -> dict:
+    """
+    one page of a model ordered by (sort_by, id)
+
+    :param model:
+    :param sort_by:
+    :param order_by: desc or asc
+    :param page: offset page, ignored when after is given
+    :param page_size:
+    :param after: cursor returned as next_cursor by the previous page
+    :param count_mode: exact, approx or none
+    :return: {"count": ..., "items": [...], "next_cursor": ...}
+    :raise ValueError: if the cursor is malformed
+    """
+    query_set = model.objects
+    ordering = [getattr(getattr(model, sort_by), order_by)()]
+    if sort_by != "id":
+        ordering.append(getattr(model.id, order_by)())
+
+    page_query = query_set.order_by(ordering)
+    if after:
+        page_query = page_query.filter(keyset_filter(sort_by, order_by, decode_cursor(after)))
+    else:
+        page_query = page_query.offset((page - 1) * page_size)
+    # one extra row tells whether there is a next page
+    items: List[ormar.Model] = await page_query.limit(page_size + 1).all()
+
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(getattr(items[-1], sort_by), items[-1].id)
+
+    count = await count_rows(query_set, model, count_mode)
+    return {"count": count, "items": items, "next_cursor": next_cursor}
@@ -1,5 +1,5 @@
 import json
-from typing import Union
+from typing import Optional, Union
 
 from aioredis import Redis
 
@@ -58,6 +58,17 @@ class RedisPlus(Redis):
         value = await self.lindex(key, idx)
         return json.loads(value)
 
+    async def list_bmove(self, src: str, dst: str, timeout: int = 0) -> Optional[bytes]:
+        """
+        阻塞地从 src 列表右侧取出数据, 并插入 dst 列表左侧
+
+        :param src: 源列表的key
+        :param dst: 目标列表的key
+        :param timeout: 最长等待秒数(默认值 0-一直等待)
+        :return: 取出的原始值, 超时返回 None
+        """
+        return await self.brpoplpush(src, dst, timeout)
+
 
 redis_client = RedisPlus.from_url(settings.REDIS_URL)
 
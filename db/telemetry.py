@@ -0,0 +1,213 @@
+"""
+bulk network node inventory and telemetry writes
+
+Updates are held for a short window. Repeated updates of the same node, or of
+the same (node, geo place) delay, are merged and written once, and everything
+pending when the window closes is written by a single flush with multi-row
+INSERT ... ON DUPLICATE KEY UPDATE statements of bounded size. Thousands of
+pushes every few seconds then cost a handful of statements on one connection.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, Hashable, List, Optional, Tuple, Type
+
+import ormar
+
+from core import settings
+from db.ingest import upsert
+from db.models import NetworkNode, NetworkNodeDelay
+
+NODE_COLUMNS = ["id", "name", "cpu", "mem", "disk", "cpu_rem", "mem_rem", "disk_rem"]
+DELAY_COLUMNS = ["node_id", "geo_place_id", "delay"]
+# columns needed to add a node that doesn't exist yet
+INVENTORY_COLUMNS = ["name", "cpu", "mem", "disk"]
+# (total, remaining) column pairs
+REMAINING_COLUMNS = [("cpu", "cpu_rem"), ("mem", "mem_rem"), ("disk", "disk_rem")]
+
+# row results
+WRITTEN = "written"
+# merged into a later update of the same row in the same window, which was written
+COALESCED = "coalesced"
+REJECTED = "rejected"
+FAILED = "failed"
+
+logger = logging.getLogger("app")
+
+
+def row_result(status: str, msg: Optional[str] = None) -> dict:
+    return {"status": status, "msg": msg}
+
+
+class PendingRow:
+    """merged values of one row and the callers waiting for it, oldest first"""
+    __slots__ = ("values", "futures")
+
+    def __init__(self):
+        self.values: dict = {}
+        self.futures: List[asyncio.Future] = []
+
+    def settle(self, result: dict):
+        for future in self.futures[:-1]:
+            if not future.done():
+                future.set_result(row_result(COALESCED) if result["status"] == WRITTEN else result)
+        if not self.futures[-1].done():
+            self.futures[-1].set_result(result)
+
+
+def merge_node(current: Optional[dict], values: dict) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    full network_node row after an update
+
+    :param current: the row in database, None for new nodes
+    :param values: columns given by the update
+    :return: row, or None and why the update is rejected
+    """
+    if current is None:
+        missing = [column for column in INVENTORY_COLUMNS if column not in values]
+        if missing:
+            return None, f"unknown node, {', '.join(missing)} needed to add it"
+        row = dict(values)
+        # a new node without telemetry is empty
+        for total, remaining in REMAINING_COLUMNS:
+            row.setdefault(remaining, row[total])
+    else:
+        row = {**current, **values}
+    for total, remaining in REMAINING_COLUMNS:
+        if row[remaining] > row[total]:
+            return None, f"{remaining} above {total}"
+    return {column: row[column] for column in NODE_COLUMNS}, None
+
+
+class TelemetryCoalescer:
+    """ 节点遥测合并写入 """
+
+    def __init__(self, window: float = settings.TELEMETRY_COALESCE_WINDOW,
+                 batch_size: int = settings.TELEMETRY_BATCH_SIZE,
+                 max_pending: int = settings.TELEMETRY_MAX_PENDING):
+        self.window = window
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._nodes: Dict[int, PendingRow] = {}
+        self._delays: Dict[Tuple[int, int], PendingRow] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes = set()
+        # one flush at a time, so ingestion holds at most one connection
+        self._lock = asyncio.Lock()
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._nodes) + len(self._delays)
+
+    @staticmethod
+    def _add(pending: Dict[Hashable, PendingRow], key: Hashable, values: dict) -> asyncio.Future:
+        row = pending.get(key)
+        if row is None:
+            row = pending[key] = PendingRow()
+        row.values.update(values)
+        future = asyncio.get_running_loop().create_future()
+        row.futures.append(future)
+        return future
+
+    def _schedule(self, delay: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        self._timer = None
+        task = asyncio.create_task(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def submit(self, nodes: List[dict], delays: List[dict]) -> Tuple[List[dict], List[dict]]:
+        """
+        queue updates and wait until the window they fell into is written
+
+        :param nodes: network_node columns to write, id is required, other columns are optional
+        :param delays: node_id, geo_place_id and delay of network_node_delay rows
+        :return: result of every node and every delay, in order
+        """
+        node_futures = [self._add(self._nodes, node["id"], node) for node in nodes]
+        delay_futures = [self._add(self._delays, (delay["node_id"], delay["geo_place_id"]), delay)
+                         for delay in delays]
+        if self.pending_count >= self.max_pending:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.window)
+        return list(await asyncio.gather(*node_futures)), list(await asyncio.gather(*delay_futures))
+
+    async def flush(self):
+        """write everything pending now"""
+        async with self._lock:
+            nodes, self._nodes = self._nodes, {}
+            delays, self._delays = self._delays, {}
+            for write, pending in ((self._write_nodes, nodes), (self._write_delays, delays)):
+                if not pending:
+                    continue
+                try:
+                    await write(pending)
+                except Exception:
+                    logger.exception("write telemetry failed")
+                    for row in pending.values():
+                        row.settle(row_result(FAILED, "database error"))
+
+    async def close(self):
+        """write what is left, e.g. on shutdown"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+
+    async def _existing_nodes(self, node_ids: List[int]) -> Dict[int, dict]:
+        existing = {}
+        for start in range(0, len(node_ids), self.batch_size):
+            rows = await NetworkNode.objects.filter(
+                id__in=node_ids[start:start + self.batch_size]).values_list(NODE_COLUMNS)
+            existing.update((row[0], dict(zip(NODE_COLUMNS, row))) for row in rows)
+        return existing
+
+    async def _upsert(self, model: Type[ormar.Model], items: List[Tuple[PendingRow, dict]],
+                      update_columns: List[str]):
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            result = row_result(WRITTEN)
+            try:
+                await upsert(model, [row for _, row in batch], update_columns)
+            except Exception:
+                logger.exception("upsert %s %s rows failed", len(batch), model.Meta.tablename)
+                result = row_result(FAILED, "database error")
+            for pending, _ in batch:
+                pending.settle(result)
+
+    async def _write_nodes(self, nodes: Dict[int, PendingRow]):
+        existing = await self._existing_nodes(list(nodes))
+        # rows of one statement share the columns they update
+        groups: Dict[Tuple[str, ...], List[Tuple[PendingRow, dict]]] = defaultdict(list)
+        for node_id, pending in nodes.items():
+            row, error = merge_node(existing.get(node_id), pending.values)
+            if error:
+                pending.settle(row_result(REJECTED, error))
+                continue
+            update_columns = tuple(column for column in NODE_COLUMNS[1:] if column in pending.values)
+            if not update_columns:
+                # only the id of a known node, nothing to write
+                pending.settle(row_result(WRITTEN))
+                continue
+            groups[update_columns].append((pending, row))
+        for update_columns, items in groups.items():
+            await self._upsert(NetworkNode, items, list(update_columns))
+
+    async def _write_delays(self, delays: Dict[Tuple[int, int], PendingRow]):
+        # nodes written by this flush already exist
+        existing = await self._existing_nodes(list({node_id for node_id, _ in delays}))
+        items = []
+        for (node_id, _), pending in delays.items():
+            if node_id not in existing:
+                pending.settle(row_result(REJECTED, "unknown node"))
+                continue
+            items.append((pending, {column: pending.values[column] for column in DELAY_COLUMNS}))
+        await self._upsert(NetworkNodeDelay, items, ["delay"])
+
+
+telemetry_coalescer = TelemetryCoalescer()
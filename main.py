@@ -1,9 +1,18 @@
+import asyncio
+
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 
 from api import api_router
 from db.database import init_db_pool
 from db.redis import init_redis_pool
+from db.telemetry import telemetry_coalescer
+from scheduler.executor import solver_pool
+from scheduler.queue import SchedulingWorkerPool
+from scheduler.snapshot import cluster_snapshot
+from utils.metrics import MetricsMiddleware, registry
+import utils.logger  # noqa: F401, configures logging
 
 app = FastAPI()
 
@@ -15,6 +24,7 @@ allow_credentials=True,
 allow_methods=["*"],
 allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(router=api_router, prefix='/api')
 
@@ -29,14 +39,28 @@ async def say_hello(name: str):
     return {"message": f"Hello {name}"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.on_event("startup")
 async def startup_event():
     app.state.database = await init_db_pool()
     app.state.redis = await init_redis_pool()
+    solver_pool.start()
+    app.state.cluster_snapshot_refresher = asyncio.create_task(cluster_snapshot.run_refresher())
+    app.state.scheduling_workers = SchedulingWorkerPool(app.state.redis)
+    await app.state.scheduling_workers.start()
 
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
+    await app.state.scheduling_workers.stop()
+    app.state.cluster_snapshot_refresher.cancel()
+    await cluster_snapshot.save_if_due(force=True)
+    solver_pool.shutdown()
+    await telemetry_coalescer.close()
     await app.state.database.disconnect()
     await app.state.redis.close()
 
@@ -0,0 +1,63 @@
+"""
+compact binary encoding of named numpy arrays
+
+Used to ship engine inputs across process boundaries: the payload is a short
+json header followed by the raw array bytes, decoding is zero-copy. Arrays too
+large to ship with every job live in shared memory segments instead, which
+other processes map read-only.
+"""
+import json
+import mmap
+import os
+import struct
+from typing import Dict
+
+import numpy as np
+
+HEADER_SIZE = struct.Struct("<I")
+# where POSIX shared memory segments show up as files
+SHM_DIR = "/dev/shm"
+
+
+def pack_arrays(**arrays: np.ndarray) -> bytes:
+    """
+    encode arrays into one buffer
+
+    :param arrays: name -> array
+    :return:
+    """
+    header, chunks, offset = {}, [], 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        header[name] = [array.dtype.str, array.shape, offset]
+        chunks.append(array.tobytes())
+        offset += array.nbytes
+    header = json.dumps(header).encode()
+    return HEADER_SIZE.pack(len(header)) + header + b"".join(chunks)
+
+
+def unpack_arrays(buffer: bytes) -> Dict[str, np.ndarray]:
+    """
+    decode a buffer made by pack_arrays, arrays are read-only views on it
+
+    :param buffer:
+    :return: name -> array
+    """
+    (header_size,) = HEADER_SIZE.unpack_from(buffer)
+    start = HEADER_SIZE.size + header_size
+    header = json.loads(bytes(buffer[HEADER_SIZE.size:start]))
+    arrays = {}
+    for name, (dtype, shape, offset) in header.items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=start + offset).reshape(shape)
+    return arrays
+
+
+def map_read_only(name: str) -> mmap.mmap:
+    """read-only mapping of a shared memory segment, unmapped once the mapping and every array on it are gone"""
+    fd = os.open(os.path.join(SHM_DIR, name), os.O_RDONLY)
+    try:
+        return mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+    finally:
+        os.close(fd)
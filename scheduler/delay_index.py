@@ -0,0 +1,83 @@
+"""
+geo place delay index
+
+Answers "which nodes reach every geo place within X ms" with binary searches
+over presorted delays instead of scanning network_node_delay.
+"""
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+from scheduler.engine import ClusterArrays
+
+
+class DelayIndex:
+    """
+    node rows sorted by delay, once per geo place and once by the worst delay
+    over all geo places
+    """
+
+    def __init__(self, cluster: ClusterArrays):
+        self.node_ids = cluster.node_ids
+        self.geo_place_ids = cluster.geo_place_ids
+        self.delay = cluster.delay
+        self._columns = {int(geo_place_id): column for column, geo_place_id in enumerate(cluster.geo_place_ids)}
+
+        max_delay = cluster.max_delay()
+        self.max_order = np.argsort(max_delay, kind="stable")
+        self.max_sorted = max_delay[self.max_order]
+        self.geo_order = np.argsort(cluster.delay, axis=0, kind="stable")
+        self.geo_sorted = np.take_along_axis(cluster.delay, self.geo_order, axis=0)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """the presorted arrays, to persist the index"""
+        return {"max_order": self.max_order, "max_sorted": self.max_sorted,
+                "geo_order": self.geo_order, "geo_sorted": self.geo_sorted}
+
+    @classmethod
+    def from_arrays(cls, cluster: ClusterArrays, arrays: Dict[str, np.ndarray]) -> "DelayIndex":
+        """
+        index of a cluster from arrays saved by arrays(), without sorting again
+
+        :param cluster: the cluster the arrays were built from
+        :param arrays:
+        :return:
+        """
+        index = cls.__new__(cls)
+        index.node_ids = cluster.node_ids
+        index.geo_place_ids = cluster.geo_place_ids
+        index.delay = cluster.delay
+        index._columns = {int(geo_place_id): column for column, geo_place_id in enumerate(cluster.geo_place_ids)}
+        for name, array in arrays.items():
+            setattr(index, name, array)
+        return index
+
+    def rows_within(self, max_delay: float, geo_place_ids: Optional[Sequence[int]] = None) -> np.ndarray:
+        """
+        rows of the nodes whose delay to every geo place is at most max_delay
+
+        :param max_delay:
+        :param geo_place_ids: only check these geo places, default all of them
+        :return: node rows, nearest first
+        """
+        if geo_place_ids is None:
+            return self.max_order[:np.searchsorted(self.max_sorted, max_delay, side="right")]
+
+        columns = [self._columns.get(geo_place_id) for geo_place_id in geo_place_ids]
+        if None in columns:
+            # no node has a delay to an unknown geo place
+            return np.empty(0, dtype=np.int64)
+
+        within = np.ones(len(self.node_ids), dtype=bool)
+        for column in columns:
+            reached = np.zeros(len(self.node_ids), dtype=bool)
+            reached[self.geo_order[:np.searchsorted(self.geo_sorted[:, column], max_delay, side="right"), column]] = True
+            within &= reached
+        rows = within.nonzero()[0]
+        if not columns:
+            return rows
+        return rows[np.argsort(self.delay[np.ix_(rows, columns)].max(axis=1), kind="stable")]
+
+    def node_ids_within(self, max_delay: float, geo_place_ids: Optional[Sequence[int]] = None) -> np.ndarray:
+        """same as rows_within, as network node ids"""
+        return self.node_ids[self.rows_within(max_delay, geo_place_ids)]
@@ -0,0 +1,169 @@
+"""
+what-if placement
+
+Candidate task sets are placed against a copy of the cluster snapshot and
+nothing is written, so operators can check whether task sets would fit before
+creating them.
+"""
+import asyncio
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from scheduler.engine import UNPLACED, ClusterArrays, Placement, TaskArrays, TaskRow, build_task_arrays, \
+    feasibility_mask
+from scheduler.executor import SolverTimeout, solver_pool
+from scheduler.graph import ConstraintGraph, ConstraintRow, build_constraint_graph
+from scheduler.memo import placement_memo
+from scheduler.portfolio import place_portfolio
+from scheduler.snapshot import cluster_snapshot
+from scheduler.topology import topology_cache
+
+RESOURCES = ("cpu", "mem", "disk")
+
+
+async def load_read_only_cluster() -> Tuple[ClusterArrays, np.ndarray]:
+    """
+    copy of the cluster snapshot with its topology, only read from database
+
+    :return: cluster, (N, 3) total cpu / mem / disk of every node
+    """
+    if not cluster_snapshot.loaded:
+        await cluster_snapshot.refresh()
+    # no await in between, so both come from the same snapshot version
+    cluster, total = cluster_snapshot.cluster_arrays(), cluster_snapshot.total.copy()
+    await topology_cache.attach(cluster)
+    return cluster, total
+
+
+def unplaced_reason(cluster: ClusterArrays, total: np.ndarray, tasks: TaskArrays, placement: Placement,
+                    row: int) -> str:
+    """
+    why a task got no node
+
+    capacity: no node is big enough even when empty
+    delay_constraint: no node is close enough to every geo place
+    occupied: nodes that would do are taken, by the cluster or by other tasks
+    inter_task_constraint: no node that would do reaches the placed neighbours
+    """
+    one = tasks.subset(np.array([row]))
+    if not feasibility_mask(cluster, one, capacity=total).any():
+        if not (total >= one.demand[0]).all(axis=1).any():
+            return "capacity"
+        return "delay_constraint"
+    if not feasibility_mask(cluster, one, capacity=placement.capacity).any():
+        return "occupied"
+    return "inter_task_constraint"
+
+
+def unsatisfied_constraints(tasks: TaskArrays, graph: ConstraintGraph, placement: Placement,
+                            checked: bool) -> List[dict]:
+    """
+    inter task constraints that don't hold: an end is unplaced, or the
+    topology is unknown so they weren't checked at all
+
+    :param tasks:
+    :param graph:
+    :param placement:
+    :param checked: whether the cluster has a topology to check them against
+    :return:
+    """
+    src, dst = graph.sources(), graph.indices
+    once = src < dst
+    src, dst = src[once], dst[once]
+    bandwidth, delay = graph.bandwidth[once], graph.delay[once]
+    unplaced = (placement.node_index[src] == UNPLACED) | (placement.node_index[dst] == UNPLACED)
+    constrained = (bandwidth > 0) | np.isfinite(delay)
+    unchecked = ~unplaced & constrained & ~checked
+    result = []
+    for edge in (unplaced | unchecked).nonzero()[0]:
+        result.append({
+            "a_task_id": int(tasks.task_ids[src[edge]]),
+            "z_task_id": int(tasks.task_ids[dst[edge]]),
+            "bandwidth": float(bandwidth[edge]) or None,
+            "delay": float(delay[edge]) if np.isfinite(delay[edge]) else None,
+            "reason": "unplaced" if unplaced[edge] else "unchecked",
+        })
+    return result
+
+
+def utilisation(cluster: ClusterArrays, total: np.ndarray, capacity: np.ndarray) -> dict:
+    """share of every resource in use over the whole cluster"""
+    size = np.maximum(total.sum(axis=0), 1)
+    used = (total - capacity).sum(axis=0)
+    return {name: float(value) for name, value in zip(RESOURCES, used / size)}
+
+
+async def evaluate(cluster: ClusterArrays, total: np.ndarray, name: str, task_rows: List[TaskRow],
+                   constraint_rows: List[ConstraintRow], timeout: Optional[float] = None,
+                   budget: Optional[float] = None) -> dict:
+    """
+    place one candidate task set, nothing is written
+
+    :param cluster: read only
+    :param total: (N, 3) total capacity of every node
+    :param name: echoed back
+    :param task_rows: (task_id, cpu_dem, mem_dem, disk_dem, delay_constraint) rows
+    :param constraint_rows: (a_task_id, z_task_id, bandwidth, delay) rows
+    :param timeout: seconds, defaults to the solver pool timeout
+    :param budget: seconds for a portfolio of strategies instead of the default one,
+        the best placement found in time is returned
+    :return:
+    """
+    tasks = build_task_arrays(task_rows)
+    graph = build_constraint_graph(tasks, constraint_rows)
+    result = {"name": name, "task_count": tasks.task_count}
+    if budget is not None:
+        portfolio = await place_portfolio(cluster, tasks, budget, graph=graph)
+        result["strategy"] = portfolio.strategy
+        result["strategies"] = [strategy.stats() for strategy in portfolio.results]
+        if portfolio.placement is None:
+            return {**result, "fits": False, "error": "timeout"}
+        placement = portfolio.placement
+    else:
+        try:
+            placement = await placement_memo.place(
+                cluster, tasks, graph, lambda: solver_pool.place_components(cluster, tasks, graph, timeout=timeout))
+        except SolverTimeout:
+            return {**result, "fits": False, "error": "timeout"}
+
+    node_ids = placement.node_ids(cluster)
+    placed = placement.node_index != UNPLACED
+    used = placement.used(tasks, cluster.node_count)
+    used_rows = used.any(axis=1).nonzero()[0]
+    return {
+        **result,
+        "fits": bool(placed.all()),
+        "placed_count": placement.placed_count,
+        "assignments": [{"task_id": int(task_id), "node_id": int(node_id) if node_id != UNPLACED else None}
+                        for task_id, node_id in zip(tasks.task_ids, node_ids)],
+        "unplaced": [{"task_id": int(tasks.task_ids[row]),
+                      "reason": unplaced_reason(cluster, total, tasks, placement, row)}
+                     for row in (~placed).nonzero()[0]],
+        "unsatisfied_constraints": unsatisfied_constraints(tasks, graph, placement,
+                                                           checked=cluster.link_delay is not None),
+        "utilisation": {
+            "before": utilisation(cluster, total, cluster.capacity),
+            "after": utilisation(cluster, total, placement.capacity),
+        },
+        "nodes": [{"node_id": int(cluster.node_ids[row]),
+                   **{resource: float(1 - placement.capacity[row, column] / max(total[row, column], 1))
+                      for column, resource in enumerate(RESOURCES)}}
+                  for row in used_rows],
+    }
+
+
+async def evaluate_all(candidates: List[Tuple[str, List[TaskRow], List[ConstraintRow]]],
+                       timeout: Optional[float] = None, budget: Optional[float] = None) -> List[dict]:
+    """
+    evaluate candidates concurrently, each against the same cluster as if it
+    were the only one
+
+    :param candidates: (name, task rows, constraint rows)
+    :param timeout: seconds per candidate
+    :param budget: seconds per candidate for a portfolio of strategies
+    :return: one result per candidate, in order
+    """
+    cluster, total = await load_read_only_cluster()
+    return list(await asyncio.gather(*(evaluate(cluster, total, name, task_rows, constraint_rows, timeout, budget)
+                                       for name, task_rows, constraint_rows in candidates)))
@@ -0,0 +1,294 @@
+"""
+vectorized placement engine
+
+Everything in this module works on plain numpy arrays and has no dependency on
+FastAPI or ormar, so it can be benchmarked and called from worker processes.
+"""
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterable, Optional, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from scheduler.graph import ConstraintGraph
+
+# node index used for tasks that can not be placed anywhere
+UNPLACED = -1
+
+# number of tasks checked against every node at once in feasibility_mask
+MASK_CHUNK_SIZE = 1024
+
+# number of tasks placed between two deadline checks
+DEADLINE_CHECK_INTERVAL = 256
+
+# placement strategies: first fit in decreasing cpu demand, best fit by the dot product of the
+# demand and the capacity left, tightest delay constraint first onto the nearest node
+FIRST_FIT = "ffd_cpu"
+BEST_FIT_DOT = "best_fit_dot"
+DELAY_FIRST = "delay_first"
+STRATEGIES = (FIRST_FIT, BEST_FIT_DOT, DELAY_FIRST)
+
+NodeRow = Tuple[int, int, int, int]
+DelayRow = Tuple[int, int, int]
+TaskRow = Tuple[int, int, int, int, Optional[int]]
+
+
+@dataclass
+class ClusterArrays:
+    """
+    dense view of the cluster
+
+    node_ids: network node id of every row
+    capacity: (N, 3) remaining cpu / mem / disk of every node
+    geo_place_ids: geo place id of every delay column
+    delay: (N, G) delay from node to geo place, inf when not measured
+    link_delay: (N, N) shortest delay between nodes, None when the topology is unknown
+    link_bandwidth: (N, N) bottleneck bandwidth between nodes, None when the topology is unknown
+    link_segment: (name, node count, offset) of the shared memory segment both link matrices are
+        mapped from, None when they belong to this process
+    """
+    node_ids: np.ndarray
+    capacity: np.ndarray
+    geo_place_ids: np.ndarray
+    delay: np.ndarray
+    link_delay: Optional[np.ndarray] = None
+    link_bandwidth: Optional[np.ndarray] = None
+    link_segment: Optional[Tuple[str, int, int]] = None
+
+    @property
+    def node_count(self) -> int:
+        return len(self.node_ids)
+
+    def rows_of(self, node_ids: np.ndarray) -> np.ndarray:
+        """row of every network node id, UNPLACED for ids that are not in the cluster"""
+        rows = np.full(len(node_ids), UNPLACED, dtype=np.int64)
+        if self.node_count:
+            order = np.argsort(self.node_ids)
+            pos = np.searchsorted(self.node_ids, node_ids, sorter=order).clip(max=self.node_count - 1)
+            known = self.node_ids[order[pos]] == node_ids
+            rows[known] = order[pos[known]]
+        return rows
+
+    def max_delay(self) -> np.ndarray:
+        """worst delay from every node to any geo place"""
+        if self.delay.shape[1] == 0:
+            return np.zeros(self.node_count, dtype=np.float64)
+        return self.delay.max(axis=1)
+
+
+@dataclass
+class TaskArrays:
+    """
+    dense view of the tasks of one task set
+
+    task_ids: task id inside the task set
+    demand: (M, 3) required cpu / mem / disk
+    delay_constraint: (M,) max delay to all geo places, inf when unconstrained
+    """
+    task_ids: np.ndarray
+    demand: np.ndarray
+    delay_constraint: np.ndarray
+
+    @property
+    def task_count(self) -> int:
+        return len(self.task_ids)
+
+    def subset(self, rows: np.ndarray) -> "TaskArrays":
+        return TaskArrays(task_ids=self.task_ids[rows], demand=self.demand[rows],
+                          delay_constraint=self.delay_constraint[rows])
+
+
+@dataclass
+class Placement:
+    """
+    result of a placement run
+
+    node_index: (M,) row of the chosen node in ClusterArrays, UNPLACED if none fits
+    capacity: (N, 3) remaining capacity after all placed tasks are deducted
+    complete: False if the run hit its deadline before visiting every task
+    """
+    node_index: np.ndarray
+    capacity: np.ndarray
+    complete: bool = True
+
+    @property
+    def placed_count(self) -> int:
+        return int((self.node_index != UNPLACED).sum())
+
+    def used(self, tasks: TaskArrays, node_count: int) -> np.ndarray:
+        """(N, 3) capacity taken by the placed tasks on every node"""
+        used = np.zeros((node_count, 3), dtype=np.int64)
+        placed = self.node_index != UNPLACED
+        np.add.at(used, self.node_index[placed], tasks.demand[placed])
+        return used
+
+    def node_ids(self, cluster: ClusterArrays) -> np.ndarray:
+        """map node_index to network node ids, UNPLACED stays as is"""
+        node_ids = np.full(len(self.node_index), UNPLACED, dtype=np.int64)
+        placed = self.node_index != UNPLACED
+        node_ids[placed] = cluster.node_ids[self.node_index[placed]]
+        return node_ids
+
+
+def build_cluster_arrays(nodes: Iterable[NodeRow], delays: Iterable[DelayRow]) -> ClusterArrays:
+    """
+    build dense cluster arrays
+
+    :param nodes: (node_id, cpu_rem, mem_rem, disk_rem) rows
+    :param delays: (node_id, geo_place_id, delay) rows, rows of unknown nodes are ignored
+    :return:
+    """
+    node_rows = np.array(list(nodes), dtype=np.int64).reshape(-1, 4)
+    node_ids = node_rows[:, 0].copy()
+    capacity = node_rows[:, 1:].copy()
+
+    delay_rows = np.array(list(delays), dtype=np.int64).reshape(-1, 3)
+    geo_place_ids = np.unique(delay_rows[:, 1])
+    delay = np.full((len(node_ids), len(geo_place_ids)), np.inf, dtype=np.float64)
+    if len(delay_rows) and len(node_ids):
+        order = np.argsort(node_ids)
+        pos = np.searchsorted(node_ids, delay_rows[:, 0], sorter=order).clip(max=len(node_ids) - 1)
+        rows = order[pos]
+        known = node_ids[rows] == delay_rows[:, 0]
+        cols = np.searchsorted(geo_place_ids, delay_rows[:, 1])
+        delay[rows[known], cols[known]] = delay_rows[known, 2]
+
+    return ClusterArrays(node_ids=node_ids, capacity=capacity, geo_place_ids=geo_place_ids, delay=delay)
+
+
+def build_task_arrays(tasks: Iterable[TaskRow]) -> TaskArrays:
+    """
+    build dense task arrays
+
+    :param tasks: (task_id, cpu_dem, mem_dem, disk_dem, delay_constraint) rows
+    :return:
+    """
+    rows = list(tasks)
+    task_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    demand = np.array([row[1:4] for row in rows], dtype=np.int64).reshape(-1, 3)
+    delay_constraint = np.array([np.inf if row[4] is None else row[4] for row in rows], dtype=np.float64)
+    return TaskArrays(task_ids=task_ids, demand=demand, delay_constraint=delay_constraint)
+
+
+def feasibility_mask(cluster: ClusterArrays, tasks: TaskArrays,
+                     capacity: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    check every task against every node at once
+
+    :param cluster:
+    :param tasks:
+    :param capacity: capacity to check against, defaults to cluster.capacity
+    :return: (M, N) bool mask, True where the node can host the task
+    """
+    if capacity is None:
+        capacity = cluster.capacity
+    max_delay = cluster.max_delay()
+    mask = np.empty((tasks.task_count, cluster.node_count), dtype=bool)
+    for start in range(0, tasks.task_count, MASK_CHUNK_SIZE):
+        end = start + MASK_CHUNK_SIZE
+        fits = (tasks.demand[start:end, None, :] <= capacity[None, :, :]).all(axis=2)
+        mask[start:end] = fits & (max_delay[None, :] <= tasks.delay_constraint[start:end, None])
+    return mask
+
+
+def placement_order(tasks: TaskArrays) -> np.ndarray:
+    """order tasks by decreasing cpu, then mem, then disk demand"""
+    demand = tasks.demand
+    return np.lexsort((-demand[:, 2], -demand[:, 1], -demand[:, 0]))
+
+
+def strategy_order(tasks: TaskArrays, strategy: str) -> np.ndarray:
+    """order tasks are visited in by a strategy"""
+    if strategy == DELAY_FIRST:
+        demand = tasks.demand
+        return np.lexsort((-demand[:, 2], -demand[:, 1], -demand[:, 0], tasks.delay_constraint))
+    return placement_order(tasks)
+
+
+def pair_mask(cluster: ClusterArrays, graph: "ConstraintGraph", node_index: np.ndarray, task: int) -> np.ndarray:
+    """
+    nodes that reach every placed neighbour of a task within the inter task
+    delay and bandwidth, two lookups per neighbour in the topology matrices
+
+    :param cluster: with link_delay and link_bandwidth
+    :param graph:
+    :param node_index: current placement
+    :param task: task row
+    :return: (N,) bool mask
+    """
+    start, end = graph.indptr[task], graph.indptr[task + 1]
+    nodes = node_index[graph.indices[start:end]]
+    placed = nodes != UNPLACED
+    if not placed.any():
+        return np.ones(cluster.node_count, dtype=bool)
+    nodes = nodes[placed]
+    delay = graph.delay[start:end][placed]
+    bandwidth = graph.bandwidth[start:end][placed]
+    return ((cluster.link_delay[:, nodes] <= delay).all(axis=1)
+            & (cluster.link_bandwidth[:, nodes] >= bandwidth).all(axis=1))
+
+
+def place(cluster: ClusterArrays, tasks: TaskArrays, deadline: Optional[float] = None,
+          graph: Optional["ConstraintGraph"] = None, node_index: Optional[np.ndarray] = None,
+          strategy: str = FIRST_FIT) -> Placement:
+    """
+    greedy placement, first-fit decreasing by default
+
+    Tasks are visited in strategy_order and each one goes to a node whose
+    remaining capacity and delay satisfy it: the first one for FIRST_FIT, the
+    one left with the least capacity in the resources the task needs most for
+    BEST_FIT_DOT, the nearest one for DELAY_FIRST. Every visit is a single
+    vectorized check against all nodes. With a constraint graph and a cluster
+    topology, a task also has to reach its already placed neighbours within
+    their inter task delay and bandwidth.
+
+    :param cluster:
+    :param tasks:
+    :param deadline: time.time() after which the run stops with complete=False
+    :param graph: constraint graph over the rows of tasks
+    :param node_index: tasks already on a node stay there and only the UNPLACED
+        ones are placed, their demand has to be deducted from cluster.capacity already
+    :param strategy: one of STRATEGIES
+    :return:
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"unknown placement strategy {strategy}")
+    capacity = cluster.capacity.copy()
+    if node_index is None:
+        node_index = np.full(tasks.task_count, UNPLACED, dtype=np.int64)
+    else:
+        node_index = node_index.astype(np.int64, copy=True)
+    if tasks.task_count == 0 or cluster.node_count == 0:
+        return Placement(node_index=node_index, capacity=capacity)
+
+    max_delay = cluster.max_delay()
+    # resources weighted by the largest node, so cpu cores and GBs compare
+    scale = 1 / np.maximum(cluster.capacity.max(axis=0), 1)
+    pairwise = graph is not None and graph.edge_count > 0 and cluster.link_delay is not None
+    order = strategy_order(tasks, strategy)
+    order = order[node_index[order] == UNPLACED]
+    for visited, task in enumerate(order):
+        if deadline is not None and visited % DEADLINE_CHECK_INTERVAL == 0 and time.time() > deadline:
+            return Placement(node_index=node_index, capacity=capacity, complete=False)
+        demand = tasks.demand[task]
+        fits = (capacity >= demand).all(axis=1) & (max_delay <= tasks.delay_constraint[task])
+        if pairwise:
+            fits &= pair_mask(cluster, graph, node_index, task)
+        if strategy == FIRST_FIT:
+            node = int(fits.argmax())
+            if not fits[node]:
+                continue
+        else:
+            candidates = fits.nonzero()[0]
+            if not len(candidates):
+                continue
+            if strategy == BEST_FIT_DOT:
+                score = ((capacity[candidates] - demand) * scale) @ (demand * scale)
+            else:
+                score = max_delay[candidates]
+            node = int(candidates[score.argmin()])
+        capacity[node] -= demand
+        node_index[task] = node
+
+    return Placement(node_index=node_index, capacity=capacity)
@@ -0,0 +1,305 @@
+"""
+process pool for CPU bound placement
+
+Placement runs in worker processes so a large task set never blocks the event
+loop serving the API. Inputs and outputs cross the process boundary as
+pack_arrays buffers instead of pickled models. The (N, N) link matrices are
+too large for that: jobs only carry the name of a shared memory segment holding
+them and the workers map it read-only. Under serve.py that is the segment the
+refresher process published them in, otherwise they are copied once per
+topology into a segment of the serving process.
+"""
+import asyncio
+import itertools
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import replace
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+from core import settings
+from scheduler.buffers import map_read_only, pack_arrays, unpack_arrays
+from scheduler.engine import FIRST_FIT, UNPLACED, ClusterArrays, Placement, TaskArrays, place
+from scheduler.graph import ConstraintGraph, connected_components, group_components, split_components
+
+
+# shared topology segments a worker process keeps mapped, the previous one serves jobs queued before a switch
+MAPPED_TOPOLOGIES = 2
+
+# name, node count and byte offset of the link matrices in a shared memory segment
+TopologyHandle = Tuple[str, int, int]
+
+
+class SolverTimeout(Exception):
+    """placement did not finish within its timeout"""
+
+
+class SharedTopology:
+    """
+    link delay and bandwidth matrices of one topology in a shared memory
+    segment, made by the serving process
+
+    jobs: submitted jobs that may still map the segment, it is only unlinked
+    once it is retired and none is left
+    """
+
+    def __init__(self, name: str, link_delay: np.ndarray, link_bandwidth: np.ndarray):
+        node_count = len(link_delay)
+        self.link_delay = link_delay
+        self.handle: TopologyHandle = (name, node_count, 0)
+        self.jobs = 0
+        self.segment = SharedMemory(name=name, create=True, size=2 * node_count * node_count * 8)
+        delay, bandwidth = topology_views(self.segment.buf, node_count)
+        delay[:] = link_delay
+        bandwidth[:] = link_bandwidth
+        del delay, bandwidth
+
+    def unlink(self):
+        self.segment.close()
+        self.segment.unlink()
+
+
+def topology_views(buffer, node_count: int, offset: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """delay and bandwidth matrices stored one after the other from offset"""
+    shape = (node_count, node_count)
+    return np.ndarray(shape, dtype=np.float64, buffer=buffer, offset=offset), \
+        np.ndarray(shape, dtype=np.float64, buffer=buffer, offset=offset + node_count * node_count * 8)
+
+
+# worker side: mapped topology segments by name, most recent last
+_mapped_topologies: "OrderedDict[str, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+
+
+def map_topology(handle: TopologyHandle) -> Tuple[np.ndarray, np.ndarray]:
+    name, node_count, offset = handle
+    if name not in _mapped_topologies:
+        _mapped_topologies[name] = topology_views(map_read_only(name), node_count, offset)
+        while len(_mapped_topologies) > MAPPED_TOPOLOGIES:
+            _mapped_topologies.popitem(last=False)
+    return _mapped_topologies[name]
+
+
+def pack_inputs(cluster: ClusterArrays, tasks: TaskArrays, graph: Optional[ConstraintGraph] = None,
+                node_index: Optional[np.ndarray] = None, topology: Optional[TopologyHandle] = None) -> bytes:
+    arrays = dict(node_ids=cluster.node_ids, capacity=cluster.capacity,
+                  geo_place_ids=cluster.geo_place_ids, delay=cluster.delay,
+                  task_ids=tasks.task_ids, demand=tasks.demand, delay_constraint=tasks.delay_constraint)
+    if cluster.link_delay is not None and topology is None:
+        arrays.update(link_delay=cluster.link_delay, link_bandwidth=cluster.link_bandwidth)
+    if graph is not None:
+        arrays.update(indptr=graph.indptr, indices=graph.indices,
+                      edge_bandwidth=graph.bandwidth, edge_delay=graph.delay)
+    if node_index is not None:
+        arrays.update(node_index=node_index)
+    return pack_arrays(**arrays)
+
+
+def unpack_inputs(buffer: bytes, topology: Optional[TopologyHandle] = None):
+    arrays = unpack_arrays(buffer)
+    if topology is not None:
+        arrays["link_delay"], arrays["link_bandwidth"] = map_topology(topology)
+    cluster = ClusterArrays(node_ids=arrays["node_ids"], capacity=arrays["capacity"],
+                            geo_place_ids=arrays["geo_place_ids"], delay=arrays["delay"],
+                            link_delay=arrays.get("link_delay"), link_bandwidth=arrays.get("link_bandwidth"))
+    tasks = TaskArrays(task_ids=arrays["task_ids"], demand=arrays["demand"],
+                       delay_constraint=arrays["delay_constraint"])
+    graph = None
+    if "indptr" in arrays:
+        graph = ConstraintGraph(indptr=arrays["indptr"], indices=arrays["indices"],
+                                bandwidth=arrays["edge_bandwidth"], delay=arrays["edge_delay"])
+    return cluster, tasks, graph, arrays.get("node_index")
+
+
+def solve_packed(buffer: bytes, deadline: Optional[float] = None, strategy: str = FIRST_FIT,
+                 topology: Optional[TopologyHandle] = None) -> bytes:
+    """entry point run inside the worker processes"""
+    cluster, tasks, graph, node_index = unpack_inputs(buffer, topology)
+    placement = place(cluster, tasks, deadline=deadline, graph=graph, node_index=node_index, strategy=strategy)
+    return pack_arrays(node_index=placement.node_index, capacity=placement.capacity,
+                       complete=np.array(placement.complete))
+
+
+def unpack_placement(buffer: bytes) -> Placement:
+    arrays = unpack_arrays(buffer)
+    return Placement(node_index=arrays["node_index"], capacity=arrays["capacity"].copy(),
+                     complete=bool(arrays["complete"]))
+
+
+class SolverPool:
+    """ 放置计算进程池 """
+
+    def __init__(self, max_workers: int = settings.SOLVER_PROCESSES, timeout: float = settings.SOLVER_TIMEOUT):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._futures: Set[Future] = set()
+        self._topology: Optional[SharedTopology] = None
+        self._retired: List[SharedTopology] = []
+        self._generations = itertools.count(1)
+
+    @property
+    def started(self) -> bool:
+        return self._executor is not None
+
+    def start(self):
+        # spawn, so workers don't inherit the event loop, sockets or threads of the server
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self._executor is not None:
+            for future in list(self._futures):
+                future.cancel()
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        for topology in self._retired + ([self._topology] if self._topology else []):
+            topology.unlink()
+        self._topology, self._retired = None, []
+
+    async def place(self, cluster: ClusterArrays, tasks: TaskArrays, timeout: Optional[float] = None,
+                    graph: Optional[ConstraintGraph] = None, node_index: Optional[np.ndarray] = None,
+                    strategy: str = FIRST_FIT, partial: bool = False) -> Placement:
+        """
+        run placement in a worker process
+
+        The worker stops on its own once the timeout has passed, so a cancelled or
+        timed out job can't keep a process busy for long. Without a started pool
+        placement runs inline, which is what tests and benchmarks want.
+
+        :param cluster:
+        :param tasks:
+        :param timeout: seconds, defaults to the pool timeout
+        :param graph: constraint graph checked against the cluster topology
+        :param node_index: current placement, only its UNPLACED tasks are placed
+        :param strategy: one of engine.STRATEGIES
+        :param partial: return what was placed when the timeout passes, with
+            complete=False, instead of raising SolverTimeout
+        :return:
+        """
+        return await self._place(cluster, tasks, self._deadline(timeout), graph, node_index, strategy, partial)
+
+    async def place_components(self, cluster: ClusterArrays, tasks: TaskArrays, graph: ConstraintGraph,
+                               timeout: Optional[float] = None) -> Placement:
+        """
+        place the connected components of the constraint graph concurrently
+
+        Components are packed into one group per worker and every group is
+        solved against the whole cluster. The results are merged in order; when
+        a group no longer fits the capacity left by the groups before it, its
+        components touching an overcommitted node are solved again against what
+        is left.
+
+        :param cluster:
+        :param tasks:
+        :param graph: constraint graph over the rows of tasks
+        :param timeout: seconds, defaults to the pool timeout
+        :return:
+        """
+        deadline = self._deadline(timeout)
+        labels = connected_components(graph)
+        groups = group_components(split_components(labels), self.max_workers if self.started else 1)
+        if len(groups) <= 1:
+            return await self._place(cluster, tasks, deadline, graph)
+
+        results = await asyncio.gather(*(self._place(cluster, tasks.subset(rows), deadline, graph.subset(rows))
+                                         for rows in groups))
+
+        capacity = cluster.capacity.copy()
+        node_index = np.full(tasks.task_count, UNPLACED, dtype=np.int64)
+        retry = []
+        for rows, placement in zip(groups, results):
+            group_tasks = tasks.subset(rows)
+            used = placement.used(group_tasks, cluster.node_count)
+            over = (used > capacity).any(axis=1)
+            group_index = placement.node_index
+            if over.any():
+                on_over = np.zeros(len(rows), dtype=bool)
+                placed = group_index != UNPLACED
+                on_over[placed] = over[group_index[placed]]
+                conflicted = np.isin(labels[rows], labels[rows[on_over]])
+                retry.append(rows[conflicted])
+                group_index = np.where(conflicted, UNPLACED, group_index)
+                used = Placement(node_index=group_index, capacity=capacity).used(group_tasks, cluster.node_count)
+            capacity -= used
+            node_index[rows] = group_index
+
+        if retry:
+            rows = np.concatenate(retry)
+            residual = replace(cluster, capacity=capacity)
+            placement = await self._place(residual, tasks.subset(rows), deadline, graph.subset(rows))
+            node_index[rows] = placement.node_index
+            capacity = placement.capacity
+        return Placement(node_index=node_index, capacity=capacity)
+
+    def _deadline(self, timeout: Optional[float]) -> float:
+        return time.time() + (self.timeout if timeout is None else timeout)
+
+    def _share_topology(self, cluster: ClusterArrays) -> Optional[SharedTopology]:
+        """segment holding the link matrices of cluster, made when they are new"""
+        if cluster.link_delay is None or not cluster.node_count:
+            return None
+        # topology_cache hands out the same matrices until the links or the node order change
+        if self._topology is None or self._topology.link_delay is not cluster.link_delay:
+            if self._topology is not None:
+                self._retired.append(self._topology)
+            self._topology = SharedTopology(f"tango_topology_{os.getpid()}_{next(self._generations)}",
+                                            cluster.link_delay, cluster.link_bandwidth)
+            self._unlink_retired()
+        return self._topology
+
+    def _unlink_retired(self):
+        for topology in [topology for topology in self._retired if not topology.jobs]:
+            topology.unlink()
+            self._retired.remove(topology)
+
+    async def _place(self, cluster: ClusterArrays, tasks: TaskArrays, deadline: float,
+                     graph: Optional[ConstraintGraph] = None, node_index: Optional[np.ndarray] = None,
+                     strategy: str = FIRST_FIT, partial: bool = False) -> Placement:
+        if self._executor is None:
+            placement = place(cluster, tasks, deadline=deadline, graph=graph, node_index=node_index,
+                              strategy=strategy)
+        elif cluster.link_segment is not None:
+            try:
+                placement = await self._submit(cluster, tasks, deadline, graph, node_index, strategy)
+            except FileNotFoundError:
+                # unlinked by the refresher before a worker mapped it, ship the matrices instead
+                placement = await self._submit(replace(cluster, link_segment=None), tasks, deadline, graph,
+                                               node_index, strategy)
+        else:
+            topology = self._share_topology(cluster)
+            if topology is None:
+                placement = await self._submit(cluster, tasks, deadline, graph, node_index, strategy)
+            else:
+                topology.jobs += 1
+                try:
+                    placement = await self._submit(replace(cluster, link_segment=topology.handle), tasks,
+                                                   deadline, graph, node_index, strategy)
+                finally:
+                    topology.jobs -= 1
+                    self._unlink_retired()
+        if not placement.complete and not partial:
+            raise SolverTimeout(f"placement of {tasks.task_count} tasks timed out")
+        return placement
+
+    async def _submit(self, cluster: ClusterArrays, tasks: TaskArrays, deadline: float,
+                      graph: Optional[ConstraintGraph], node_index: Optional[np.ndarray], strategy: str) -> Placement:
+        timeout = deadline - time.time()
+        handle = cluster.link_segment
+        future = self._executor.submit(solve_packed, pack_inputs(cluster, tasks, graph, node_index, handle),
+                                       deadline, strategy, handle)
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        try:
+            # a little slack so the worker can return its partial result itself,
+            # cancelling the wrapper also cancels a job that is still queued
+            return unpack_placement(await asyncio.wait_for(asyncio.wrap_future(future), timeout + 1))
+        except asyncio.TimeoutError:
+            raise SolverTimeout(f"placement of {tasks.task_count} tasks timed out")
+
+
+solver_pool = SolverPool()
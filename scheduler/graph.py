@@ -0,0 +1,154 @@
+"""
+inter task constraint graph
+
+InterTaskContraints rows are turned into a CSR adjacency over task rows and
+split into connected components, which can be placed independently.
+"""
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from scheduler.engine import TaskArrays
+
+# (a_task_id, z_task_id, bandwidth, delay)
+ConstraintRow = Tuple[int, int, Optional[int], Optional[int]]
+
+
+@dataclass
+class ConstraintGraph:
+    """
+    undirected CSR adjacency, every constraint is stored in both directions
+
+    indptr: (M + 1,) neighbours of row i are indices[indptr[i]:indptr[i + 1]]
+    indices: (2E,) neighbour task rows
+    bandwidth: (2E,) required bandwidth of the edge, 0 when unconstrained
+    delay: (2E,) max delay of the edge, inf when unconstrained
+    """
+    indptr: np.ndarray
+    indices: np.ndarray
+    bandwidth: np.ndarray
+    delay: np.ndarray
+
+    @property
+    def task_count(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.indices) // 2
+
+    def neighbours(self, row: int) -> np.ndarray:
+        return self.indices[self.indptr[row]:self.indptr[row + 1]]
+
+    def sources(self) -> np.ndarray:
+        """task row every entry of indices starts from"""
+        return np.repeat(np.arange(self.task_count), np.diff(self.indptr))
+
+    def subset(self, rows: np.ndarray) -> "ConstraintGraph":
+        """
+        graph over the given rows, renumbered like TaskArrays.subset, edges
+        leaving the rows are dropped
+
+        :param rows:
+        :return:
+        """
+        renumber = np.full(self.task_count, -1, dtype=np.int64)
+        renumber[rows] = np.arange(len(rows))
+        src, dst = renumber[self.sources()], renumber[self.indices]
+        keep = (src >= 0) & (dst >= 0)
+        by_src = np.argsort(src[keep], kind="stable")
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src[keep], minlength=len(rows)), out=indptr[1:])
+        return ConstraintGraph(indptr=indptr, indices=dst[keep][by_src],
+                               bandwidth=self.bandwidth[keep][by_src], delay=self.delay[keep][by_src])
+
+
+def empty_graph(task_count: int) -> ConstraintGraph:
+    return ConstraintGraph(indptr=np.zeros(task_count + 1, dtype=np.int64), indices=np.empty(0, dtype=np.int64),
+                           bandwidth=np.empty(0, dtype=np.float64), delay=np.empty(0, dtype=np.float64))
+
+
+def build_constraint_graph(tasks: TaskArrays, constraints: Iterable[ConstraintRow]) -> ConstraintGraph:
+    """
+    build the graph over the rows of tasks, constraints on unknown tasks are dropped
+
+    :param tasks:
+    :param constraints: (a_task_id, z_task_id, bandwidth, delay) rows
+    :return:
+    """
+    rows = list(constraints)
+    if not rows or not tasks.task_count:
+        return empty_graph(tasks.task_count)
+
+    ends = np.array([row[:2] for row in rows], dtype=np.int64)
+    bandwidth = np.array([0 if row[2] is None else row[2] for row in rows], dtype=np.float64)
+    delay = np.array([np.inf if row[3] is None else row[3] for row in rows], dtype=np.float64)
+
+    order = np.argsort(tasks.task_ids)
+    pos = np.searchsorted(tasks.task_ids, ends, sorter=order).clip(max=tasks.task_count - 1)
+    task_rows = order[pos]
+    known = (tasks.task_ids[task_rows] == ends).all(axis=1)
+    a, z = task_rows[known, 0], task_rows[known, 1]
+    bandwidth, delay = bandwidth[known], delay[known]
+
+    src = np.concatenate([a, z])
+    dst = np.concatenate([z, a])
+    by_src = np.argsort(src, kind="stable")
+    indptr = np.zeros(tasks.task_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=tasks.task_count), out=indptr[1:])
+    return ConstraintGraph(indptr=indptr, indices=dst[by_src],
+                           bandwidth=np.concatenate([bandwidth, bandwidth])[by_src],
+                           delay=np.concatenate([delay, delay])[by_src])
+
+
+def connected_components(graph: ConstraintGraph) -> np.ndarray:
+    """
+    label every task row with the smallest row of its component
+
+    Labels are propagated along all edges at once and shortcut by pointer
+    jumping, so the number of rounds grows with log of the component diameter.
+
+    :param graph:
+    :return: (M,) component label of every row
+    """
+    labels = np.arange(graph.task_count)
+    src, dst = graph.sources(), graph.indices
+    while True:
+        hooked = labels.copy()
+        np.minimum.at(hooked, labels[src], labels[dst])
+        while True:
+            jumped = hooked[hooked]
+            if (jumped == hooked).all():
+                break
+            hooked = jumped
+        if (hooked == labels).all():
+            return labels
+        labels = hooked
+
+
+def split_components(labels: np.ndarray) -> List[np.ndarray]:
+    """task rows of every component, largest component first"""
+    order = np.argsort(labels, kind="stable")
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+    components = np.split(order, boundaries) if len(order) else []
+    components.sort(key=len, reverse=True)
+    return components
+
+
+def group_components(components: List[np.ndarray], group_count: int) -> List[np.ndarray]:
+    """
+    pack components into at most group_count groups of similar size, largest
+    first into the currently smallest group
+
+    :param components: task rows of every component
+    :param group_count:
+    :return: task rows of every non-empty group
+    """
+    groups: List[List[np.ndarray]] = [[] for _ in range(max(1, group_count))]
+    sizes = np.zeros(len(groups), dtype=np.int64)
+    for component in sorted(components, key=len, reverse=True):
+        smallest = int(sizes.argmin())
+        groups[smallest].append(component)
+        sizes[smallest] += len(component)
+    return [np.concatenate(group) for group in groups if group]
@@ -0,0 +1,68 @@
+"""load scheduling inputs from database into engine arrays"""
+from typing import List, Tuple
+
+import numpy as np
+
+from db.models import InterTaskContraints, NetworkNode, NetworkNodeDelay, Task
+from scheduler.engine import UNPLACED, ClusterArrays, TaskArrays, build_cluster_arrays, build_task_arrays
+from scheduler.graph import ConstraintRow
+from scheduler.snapshot import cluster_snapshot
+from scheduler.topology import topology_cache
+
+
+async def load_cluster_arrays(with_topology: bool = True) -> ClusterArrays:
+    """
+    load every network node and its delays without hydrating ormar models,
+    served from the cluster snapshot once it is loaded
+
+    :param with_topology: also attach the cached node to node delay / bandwidth matrices
+    :return:
+    """
+    if cluster_snapshot.loaded:
+        await cluster_snapshot.refresh()
+        cluster = cluster_snapshot.cluster_arrays()
+    else:
+        nodes = await NetworkNode.objects.values_list(["id", "cpu_rem", "mem_rem", "disk_rem"])
+        delays = await NetworkNodeDelay.objects.values_list(["node_id", "geo_place_id", "delay"])
+        cluster = build_cluster_arrays(nodes, delays)
+
+    if with_topology:
+        await topology_cache.attach(cluster)
+    return cluster
+
+
+async def load_task_arrays(task_set_id: int) -> TaskArrays:
+    """
+    load all tasks of a task set
+
+    :param task_set_id:
+    :return:
+    """
+    tasks = await Task.objects.filter(task_set_id=task_set_id).values_list(
+        ["task_id", "cpu_dem", "mem_dem", "disk_dem", "delay_constraint"])
+    return build_task_arrays(tasks)
+
+
+async def load_task_placement(task_set_id: int) -> Tuple[TaskArrays, np.ndarray]:
+    """
+    load all tasks of a task set with the node they are on
+
+    :param task_set_id:
+    :return: tasks, (M,) network node id of every task, UNPLACED for tasks without a node
+    """
+    # values_list returns columns in model field order, whatever order they are asked for
+    rows = await Task.objects.filter(task_set_id=task_set_id).values_list(
+        ["task_id", "node_id", "cpu_dem", "mem_dem", "disk_dem", "delay_constraint"])
+    node_ids = np.array([UNPLACED if row[1] is None else row[1] for row in rows], dtype=np.int64)
+    return build_task_arrays((row[0], *row[2:]) for row in rows), node_ids
+
+
+async def load_constraint_rows(task_set_id: int) -> List[ConstraintRow]:
+    """
+    load all inter task constraints of a task set
+
+    :param task_set_id:
+    :return: (a_task_id, z_task_id, bandwidth, delay) rows
+    """
+    return await InterTaskContraints.objects.filter(task_set_id=task_set_id).values_list(
+        ["a_task_id", "z_task_id", "bandwidth", "delay"])
@@ -0,0 +1,189 @@
+"""
+memoized placements
+
+Structurally identical task sets are placed once per cluster layout. A task
+set is reduced to a canonical hash of its demands and its constraint graph that
+ignores task ids and the name: tasks are coloured by their demand and delay
+constraint, and the colours are refined a few rounds with the colours and edge
+constraints of the neighbours (Weisfeiler-Lehman). The cluster layout is a hash
+of the node ids, geo place ids and the topology signature, the same in every
+process. Remaining capacities and delays are left out on purpose, every
+reservation and telemetry update changes them.
+
+Placements where every task got a node are kept in canonical task order as
+network node ids, in an in-process LRU and in redis. A hit is checked against
+the live capacities, delays and links like a fresh placement would be, so a
+placement that no longer fits, a hash collision or a differently ordered
+symmetric task set only costs a solver run.
+"""
+import hashlib
+import json
+import logging
+from typing import Awaitable, Callable, Optional, Tuple
+
+import numpy as np
+from aioredis.exceptions import RedisError
+
+from core import settings
+from db.cache import LocalLRU
+from db.redis import RedisPlus, redis_client
+from scheduler.engine import UNPLACED, ClusterArrays, Placement, TaskArrays
+from scheduler.graph import ConstraintGraph
+from scheduler.topology import topology_cache
+from utils.metrics import registry
+
+# colour refinement rounds of the canonical hash
+WL_ROUNDS = 3
+
+PLACEMENT_CACHE = registry.counter("placement_cache_lookups_total", "placement cache lookups by result",
+                                   ("result",))
+
+logger = logging.getLogger("app")
+
+
+def mix(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer over uint64 arrays, wraps around on purpose"""
+    with np.errstate(over="ignore"):
+        values = values + np.uint64(0x9E3779B97F4A7C15)
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def float_bits(values: np.ndarray) -> np.ndarray:
+    return np.ascontiguousarray(values, dtype=np.float64).view(np.uint64)
+
+
+def canonical_hash(tasks: TaskArrays, graph: ConstraintGraph) -> Tuple[str, np.ndarray]:
+    """
+    hash of a task set that ignores task ids and order
+
+    :param tasks:
+    :param graph: constraint graph over the rows of tasks
+    :return: hex digest, rows of tasks in canonical order
+    """
+    demand = tasks.demand.astype(np.uint64)
+    colours = mix(mix(mix(mix(demand[:, 0]) ^ demand[:, 1]) ^ demand[:, 2]) ^ float_bits(tasks.delay_constraint))
+    sources = graph.sources()
+    edges = mix(float_bits(graph.bandwidth)) ^ mix(mix(float_bits(graph.delay)))
+    for _ in range(WL_ROUNDS):
+        neighbours = np.zeros(tasks.task_count, dtype=np.uint64)
+        # a sum is order free, so every task gets the multiset of its neighbours
+        with np.errstate(over="ignore"):
+            np.add.at(neighbours, sources, mix(colours[graph.indices] ^ edges))
+        colours = mix(colours ^ mix(neighbours))
+
+    order = np.argsort(colours, kind="stable")
+    pairs = np.sort(np.stack([colours[sources], colours[graph.indices]], axis=1), axis=1)
+    edge_keys = np.stack([pairs[:, 0], pairs[:, 1], float_bits(graph.bandwidth), float_bits(graph.delay)], axis=1)
+    edge_keys = edge_keys[np.lexsort(edge_keys.T[::-1])]
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.array([tasks.task_count, graph.edge_count], dtype=np.uint64).tobytes())
+    digest.update(colours[order].tobytes())
+    digest.update(edge_keys.tobytes())
+    return digest.hexdigest(), order
+
+
+def cluster_fingerprint(cluster: ClusterArrays) -> str:
+    """hash of the cluster layout, stable across reservations and the same in every process"""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (cluster.node_ids, cluster.geo_place_ids):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    if cluster.link_delay is not None:
+        digest.update(topology_cache.fingerprint.encode())
+    return digest.hexdigest()
+
+
+def check_placement(cluster: ClusterArrays, tasks: TaskArrays, graph: ConstraintGraph,
+                    node_index: np.ndarray) -> Optional[Placement]:
+    """
+    placement of node_index if every task has a node and still fits there,
+    None otherwise
+
+    :param cluster:
+    :param tasks:
+    :param graph:
+    :param node_index: node row of every task, UNPLACED for tasks whose node is gone
+    :return:
+    """
+    if (node_index == UNPLACED).any():
+        return None
+    used = Placement(node_index=node_index, capacity=cluster.capacity).used(tasks, cluster.node_count)
+    if (used > cluster.capacity).any():
+        return None
+    if (cluster.max_delay()[node_index] > tasks.delay_constraint).any():
+        return None
+    if cluster.link_delay is not None and graph.edge_count:
+        a, z = node_index[graph.sources()], node_index[graph.indices]
+        if (cluster.link_delay[a, z] > graph.delay).any() or (cluster.link_bandwidth[a, z] < graph.bandwidth).any():
+            return None
+    return Placement(node_index=node_index, capacity=cluster.capacity - used)
+
+
+class PlacementMemo:
+    """ 放置结果缓存 """
+
+    def __init__(self, redis: RedisPlus, namespace: str, ttl: int = settings.CACHE_TTL,
+                 local_size: int = settings.PLACEMENT_CACHE_SIZE, local_ttl: float = settings.PLACEMENT_CACHE_TTL):
+        self.redis = redis
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = LocalLRU(local_size, local_ttl)
+
+    def key(self, task_hash: str, fingerprint: str) -> str:
+        return f"{self.namespace}:{task_hash}:{fingerprint}"
+
+    async def _lookup(self, key: str) -> Tuple[Optional[list], str]:
+        node_ids = self.local.get(key)
+        if node_ids is not None:
+            return node_ids, "local"
+        try:
+            text = await self.redis.get(key)
+        except RedisError:
+            logger.exception("read placement cache failed")
+            return None, "miss"
+        if text is None:
+            return None, "miss"
+        node_ids = json.loads(text)
+        self.local.set(key, node_ids)
+        return node_ids, "redis"
+
+    async def _store(self, key: str, node_ids: list):
+        self.local.set(key, node_ids)
+        try:
+            await self.redis.set(key, json.dumps(node_ids), ex=self.ttl)
+        except RedisError:
+            logger.exception("write placement cache failed")
+
+    async def place(self, cluster: ClusterArrays, tasks: TaskArrays, graph: ConstraintGraph,
+                    solve: Callable[[], Awaitable[Placement]]) -> Placement:
+        """
+        cached placement of a task set, solved and cached on a miss
+
+        :param cluster:
+        :param tasks:
+        :param graph: constraint graph over the rows of tasks
+        :param solve: runs the solver, only placements where every task got a node are cached
+        :return:
+        """
+        task_hash, order = canonical_hash(tasks, graph)
+        key = self.key(task_hash, cluster_fingerprint(cluster))
+        node_ids, result = await self._lookup(key)
+        if node_ids is not None:
+            node_index = np.full(tasks.task_count, UNPLACED, dtype=np.int64)
+            node_index[order] = cluster.rows_of(np.array(node_ids, dtype=np.int64))
+            placement = check_placement(cluster, tasks, graph, node_index) \
+                if len(node_ids) == tasks.task_count else None
+            if placement is not None:
+                PLACEMENT_CACHE.inc(f"hit_{result}")
+                return placement
+            result = "rejected"
+        PLACEMENT_CACHE.inc(result)
+
+        placement = await solve()
+        if placement.complete and placement.placed_count == tasks.task_count:
+            await self._store(key, placement.node_ids(cluster)[order].tolist())
+        return placement
+
+
+placement_memo = PlacementMemo(redis_client, "tango:placement")
@@ -0,0 +1,108 @@
+"""
+portfolio placement under a time budget
+
+Several strategies place the same task set concurrently on the solver pool,
+each against the same cluster and all with the same deadline. A strategy that
+runs out of time hands back what it placed so far, every placed task of it
+still fits, so the best placement found within the budget is always returned
+and a larger budget buys a better one.
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from scheduler.engine import STRATEGIES, ClusterArrays, Placement, TaskArrays
+from scheduler.executor import SolverPool, SolverTimeout, solver_pool
+from scheduler.graph import ConstraintGraph
+
+
+@dataclass
+class StrategyResult:
+    """
+    how one strategy did
+
+    seconds: wall time until its placement came back
+    complete: whether it visited every task before the deadline
+    nodes_used: nodes hosting at least one task
+    utilisation: mean cpu / mem / disk share in use on those nodes, after placement
+    error: set when the strategy returned nothing at all
+    """
+    strategy: str
+    seconds: float
+    complete: bool = False
+    placed_count: int = 0
+    nodes_used: int = 0
+    utilisation: List[float] = field(default_factory=list)
+    error: Optional[str] = None
+    placement: Optional[Placement] = field(default=None, repr=False)
+
+    def key(self) -> Tuple:
+        """larger is better: most tasks placed, then finished, then fewest nodes"""
+        return self.placed_count, self.complete, -self.nodes_used
+
+    def stats(self) -> dict:
+        return {"strategy": self.strategy, "seconds": self.seconds, "complete": self.complete,
+                "placed_count": self.placed_count, "nodes_used": self.nodes_used,
+                "utilisation": self.utilisation, "error": self.error}
+
+
+@dataclass
+class PortfolioResult:
+    """best placement over all strategies, None only if every strategy failed"""
+    strategy: Optional[str]
+    placement: Optional[Placement]
+    results: List[StrategyResult]
+
+
+def score(cluster: ClusterArrays, tasks: TaskArrays, result: StrategyResult, placement: Placement):
+    used = placement.used(tasks, cluster.node_count)
+    used_nodes = used.any(axis=1)
+    result.placement = placement
+    result.complete = placement.complete
+    result.placed_count = placement.placed_count
+    result.nodes_used = int(used_nodes.sum())
+    if result.nodes_used:
+        # share of the capacity these nodes had before placement
+        share = 1 - placement.capacity[used_nodes] / np.maximum(cluster.capacity[used_nodes], 1)
+        result.utilisation = share.mean(axis=0).round(4).tolist()
+
+
+async def run_strategy(pool: SolverPool, cluster: ClusterArrays, tasks: TaskArrays,
+                       graph: Optional[ConstraintGraph], strategy: str, budget: float) -> StrategyResult:
+    started = time.perf_counter()
+    result = StrategyResult(strategy=strategy, seconds=0.0)
+    try:
+        placement = await pool.place(cluster, tasks, timeout=budget, graph=graph, strategy=strategy, partial=True)
+    except SolverTimeout:
+        # the worker didn't even get to start before the deadline
+        result.error = "timeout"
+    else:
+        score(cluster, tasks, result, placement)
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+async def place_portfolio(cluster: ClusterArrays, tasks: TaskArrays, budget: float,
+                          graph: Optional[ConstraintGraph] = None, strategies: Sequence[str] = STRATEGIES,
+                          pool: SolverPool = solver_pool) -> PortfolioResult:
+    """
+    run strategies concurrently and keep the best placement
+
+    :param cluster:
+    :param tasks:
+    :param budget: seconds every strategy may take
+    :param graph: constraint graph checked against the cluster topology
+    :param strategies: of engine.STRATEGIES
+    :param pool:
+    :return:
+    """
+    results = await asyncio.gather(*(run_strategy(pool, cluster, tasks, graph, strategy, budget)
+                                     for strategy in strategies))
+    done = [result for result in results if result.placement is not None]
+    if not done:
+        return PortfolioResult(strategy=None, placement=None, results=list(results))
+    best = max(done, key=StrategyResult.key)
+    return PortfolioResult(strategy=best.strategy, placement=best.placement, results=list(results))
@@ -0,0 +1,221 @@
+"""
+redis backed scheduling job queue
+
+Handlers only push a job and return, placement happens in a pool of asyncio
+workers. Every pool is a consumer with its own processing list, a job stays in
+it until its worker is done with it. A consumer holds a lease it renews by
+heartbeat; once a lease ran out, e.g. because its process crashed, any other
+consumer pushes the jobs of its processing list back to the queue. Jobs of
+consumers that are alive are never taken back.
+
+A job whose handler raises goes back to the queue with its attempt counted.
+After SCHEDULING_JOB_ATTEMPTS it moves to the dead letter list and its task
+set back to incomplete, so it can be started again.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+from core import settings
+from db.redis import RedisPlus
+from scheduler.service import abandon_task_set, place_task_set, reschedule_task_set
+
+logger = logging.getLogger("app")
+
+JobHandler = Callable[[dict], Awaitable]
+
+
+async def enqueue_task_set(redis: RedisPlus, task_set_id: int, time_budget: Optional[float] = None):
+    """
+    ask the workers to place a running task set
+
+    :param redis:
+    :param task_set_id:
+    :param time_budget: seconds for a portfolio of strategies instead of the default one
+    :return:
+    """
+    job = {"task_set_id": task_set_id}
+    if time_budget is not None:
+        job["time_budget"] = time_budget
+    await redis.cus_lpush(settings.SCHEDULING_QUEUE_KEY, job)
+
+
+async def enqueue_reschedule(redis: RedisPlus, task_set_id: int, task_ids: Iterable[int] = ()):
+    """
+    ask the workers to place the tasks an edit of a finished task set touched
+
+    :param redis:
+    :param task_set_id:
+    :param task_ids: tasks to move even though they still have a node
+    :return:
+    """
+    await redis.cus_lpush(settings.SCHEDULING_QUEUE_KEY,
+                          {"task_set_id": task_set_id, "kind": "incremental", "task_ids": sorted(set(task_ids))})
+
+
+async def handle_job(job: dict):
+    if job.get("kind") == "incremental":
+        await reschedule_task_set(job["task_set_id"], job.get("task_ids", ()))
+    else:
+        await place_task_set(job["task_set_id"], job.get("time_budget"))
+
+
+async def give_up_job(job: dict):
+    # a finished task set keeps its placement, the next edit places what is left without a node
+    if job.get("kind") != "incremental":
+        await abandon_task_set(job["task_set_id"])
+
+
+class SchedulingWorkerPool:
+    """
+    消费调度队列的协程池
+
+    :param consumer: name of the consumer, unique per pool, defaults to host, pid and a random part
+    """
+
+    def __init__(self, redis: RedisPlus, handler: JobHandler = handle_job, give_up: JobHandler = give_up_job,
+                 concurrency: int = settings.SCHEDULING_WORKERS,
+                 queue_key: str = settings.SCHEDULING_QUEUE_KEY,
+                 processing_key: str = settings.SCHEDULING_PROCESSING_KEY,
+                 consumers_key: str = settings.SCHEDULING_CONSUMERS_KEY,
+                 lease: float = settings.SCHEDULING_LEASE,
+                 dead_letter_key: str = settings.SCHEDULING_DEAD_LETTER_KEY,
+                 attempts: int = settings.SCHEDULING_JOB_ATTEMPTS,
+                 poll_timeout: int = 1, consumer: Optional[str] = None):
+        self.redis = redis
+        self.handler = handler
+        self.give_up = give_up
+        self.concurrency = concurrency
+        self.queue_key = queue_key
+        self.processing_prefix = processing_key
+        self.consumers_key = consumers_key
+        self.lease = lease
+        self.dead_letter_key = dead_letter_key
+        self.attempts = max(1, attempts)
+        self.poll_timeout = poll_timeout
+        self.consumer = consumer or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.processing_key = self.processing_key_of(self.consumer)
+        self._workers: List[asyncio.Task] = []
+
+    def processing_key_of(self, consumer: str) -> str:
+        return f"{self.processing_prefix}:{consumer}"
+
+    async def now(self) -> float:
+        # the redis clock, the same for consumers on every host
+        seconds, microseconds = await self.redis.time()
+        return seconds + microseconds / 1e6
+
+    async def heartbeat(self):
+        """renew the lease of this consumer"""
+        await self.redis.zadd(self.consumers_key, {self.consumer: await self.now() + self.lease})
+
+    async def requeue(self, consumer: str) -> int:
+        """
+        push the jobs in the processing list of a consumer back to the queue
+
+        :param consumer:
+        :return: number of jobs pushed back
+        """
+        requeued = 0
+        # one entry at a time, so consumers recovering the same list never push a job twice
+        while await self.redis.rpoplpush(self.processing_key_of(consumer), self.queue_key) is not None:
+            requeued += 1
+        return requeued
+
+    async def recover(self) -> int:
+        """
+        push the jobs of consumers whose lease ran out back to the queue
+
+        :return: number of recovered jobs
+        """
+        recovered = 0
+        for consumer in await self.redis.zrangebyscore(self.consumers_key, "-inf", await self.now()):
+            consumer = consumer.decode() if isinstance(consumer, bytes) else consumer
+            if consumer == self.consumer:
+                continue
+            recovered += await self.requeue(consumer)
+            await self.redis.zrem(self.consumers_key, consumer)
+        if recovered:
+            logger.info("recovered %s unfinished scheduling jobs", recovered)
+        return recovered
+
+    async def start(self):
+        await self.heartbeat()
+        await self.recover()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+        self._workers.append(asyncio.create_task(self._keep_lease()))
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # jobs of cancelled workers are nobody's now, no need to wait for the lease to run out
+        await self.requeue(self.consumer)
+        await self.redis.zrem(self.consumers_key, self.consumer)
+
+    async def run_once(self) -> Optional[dict]:
+        """
+        wait for one job and handle it
+
+        :return: the handled job, None if the queue stayed empty for poll_timeout or the job isn't valid json
+        """
+        raw = await self.redis.list_bmove(self.queue_key, self.processing_key, self.poll_timeout)
+        if raw is None:
+            return None
+        # a cancelled worker leaves its job in the processing list for stop or recover
+        job = None
+        try:
+            job = json.loads(raw)
+            await self.handler(job)
+        except Exception:
+            logger.exception("scheduling job %s failed", raw)
+            await self.failed(raw, job)
+        await self.redis.lrem(self.processing_key, 1, raw)
+        return job
+
+    async def failed(self, raw: bytes, job: Optional[dict]):
+        """
+        push a failed job back to the queue, or to the dead letter list once it
+        used up its attempts
+
+        :param raw: the job as it is in the processing list
+        :param job: the parsed job, None if it isn't valid json
+        :return:
+        """
+        attempt = job.get("attempt", 1) if isinstance(job, dict) else self.attempts
+        if attempt < self.attempts:
+            await self.redis.lpush(self.queue_key, json.dumps({**job, "attempt": attempt + 1}))
+            return
+        await self.redis.lpush(self.dead_letter_key, raw)
+        logger.error("scheduling job %s failed %s times, moved to %s", raw, attempt, self.dead_letter_key)
+        if isinstance(job, dict):
+            try:
+                await self.give_up(job)
+            except Exception:
+                logger.exception("giving up scheduling job %s failed", raw)
+
+    async def _work(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("scheduling worker error")
+                await asyncio.sleep(self.poll_timeout)
+
+    async def _keep_lease(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self.heartbeat()
+                await self.recover()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("scheduling lease heartbeat failed")
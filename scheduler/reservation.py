@@ -0,0 +1,141 @@
+"""
+batch reservation of node capacity
+
+A placement is committed for a whole task set at once: the touched node rows
+are locked in id order, so concurrent schedulers in any process queue up
+instead of deadlocking, checked against the capacity read under the lock and
+only then decremented. Nodes that can't take their share are reported one by
+one, so the caller can move just the tasks that were on them.
+"""
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+from sqlalchemy import select
+
+from db.database import database
+from db.models import NetworkNode
+from scheduler.engine import ClusterArrays, Placement, TaskArrays
+
+
+@dataclass
+class NodeConflict:
+    """ 节点资源冲突 """
+    node_id: int
+    requested: List[int]
+    remaining: List[int]
+
+
+@dataclass
+class Reservation:
+    """
+    outcome of one reservation attempt
+
+    node_ids: nodes that were locked
+    remaining: (K, 3) cpu / mem / disk of the locked nodes read under the lock,
+        before any deduction
+    conflicts: nodes whose remaining capacity is below the requested one
+    """
+    node_ids: np.ndarray
+    remaining: np.ndarray
+    conflicts: List[NodeConflict]
+
+    @property
+    def ok(self) -> bool:
+        return not self.conflicts
+
+
+async def reserve(node_ids: np.ndarray, requested: np.ndarray) -> Reservation:
+    """
+    lock the nodes and deduct the requested capacity, all or nothing
+
+    Has to run inside a transaction, the locks are held until it ends. Nothing
+    is written when any node conflicts.
+
+    :param node_ids: (K,) network node ids
+    :param requested: (K, 3) cpu / mem / disk to deduct from every node
+    :return:
+    """
+    order = np.argsort(node_ids)
+    node_ids, requested = node_ids[order], requested[order]
+    if not len(node_ids):
+        return Reservation(node_ids=node_ids, remaining=np.empty((0, 3), dtype=np.int64), conflicts=[])
+
+    table = NetworkNode.Meta.table
+    rows = await database.fetch_all(
+        select(table.c.id, table.c.cpu_rem, table.c.mem_rem, table.c.disk_rem)
+        .where(table.c.id.in_([int(node_id) for node_id in node_ids]))
+        .order_by(table.c.id).with_for_update())
+    locked = {row[0]: row[1:] for row in rows}
+    # a node deleted meanwhile has nothing left
+    remaining = np.array([locked.get(int(node_id), (0, 0, 0)) for node_id in node_ids], dtype=np.int64)
+
+    short = (requested > remaining).any(axis=1)
+    conflicts = [NodeConflict(node_id=int(node_ids[row]), requested=requested[row].tolist(),
+                              remaining=remaining[row].tolist()) for row in short.nonzero()[0]]
+    if not conflicts:
+        # guarded as well, in case a writer ignores the locks
+        await database.execute_many(
+            "UPDATE network_node SET cpu_rem = cpu_rem - :cpu, mem_rem = mem_rem - :mem, "
+            "disk_rem = disk_rem - :disk "
+            "WHERE id = :id AND cpu_rem >= :cpu AND mem_rem >= :mem AND disk_rem >= :disk",
+            values=[{"id": int(node_id), "cpu": int(cpu), "mem": int(mem), "disk": int(disk)}
+                    for node_id, (cpu, mem, disk) in zip(node_ids, requested)])
+    return Reservation(node_ids=node_ids, remaining=remaining, conflicts=conflicts)
+
+
+async def release(node_ids: np.ndarray, released: np.ndarray):
+    """
+    give capacity back to nodes, e.g. of deleted or moved tasks
+
+    :param node_ids: (K,) network node ids, may repeat
+    :param released: (K, 3) cpu / mem / disk to add back, summed per node
+    :return:
+    """
+    node_ids, inverse = np.unique(np.asarray(node_ids, dtype=np.int64), return_inverse=True)
+    total = np.zeros((len(node_ids), 3), dtype=np.int64)
+    np.add.at(total, inverse.reshape(-1), np.asarray(released, dtype=np.int64).reshape(-1, 3))
+    rows = total.any(axis=1).nonzero()[0]
+    if not len(rows):
+        return
+    # ascending ids, the same lock order as reserve
+    await database.execute_many(
+        "UPDATE network_node SET cpu_rem = cpu_rem + :cpu, mem_rem = mem_rem + :mem, "
+        "disk_rem = disk_rem + :disk WHERE id = :id",
+        values=[{"id": int(node_ids[row]), "cpu": int(total[row, 0]), "mem": int(total[row, 1]),
+                 "disk": int(total[row, 2])} for row in rows])
+
+
+async def reserve_placement(cluster: ClusterArrays, tasks: TaskArrays, placement: Placement) -> Reservation:
+    """
+    reserve the capacity a placement takes on every node
+
+    The capacity read under the lock is written back into cluster.capacity, so
+    a retry works with the numbers the next attempt will be checked against.
+
+    :param cluster:
+    :param tasks:
+    :param placement:
+    :return:
+    """
+    used = placement.used(tasks, cluster.node_count)
+    rows = used.any(axis=1).nonzero()[0]
+    reservation = await reserve(cluster.node_ids[rows], used[rows])
+
+    order = np.argsort(cluster.node_ids)
+    locked = order[np.searchsorted(cluster.node_ids, reservation.node_ids, sorter=order)]
+    cluster.capacity[locked] = reservation.remaining
+    return reservation
+
+
+def conflicting_rows(cluster: ClusterArrays, placement: Placement, reservation: Reservation) -> np.ndarray:
+    """
+    task rows placed on a conflicting node
+
+    :param cluster:
+    :param placement:
+    :param reservation:
+    :return:
+    """
+    node_ids = placement.node_ids(cluster)
+    return np.isin(node_ids, [conflict.node_id for conflict in reservation.conflicts]).nonzero()[0]
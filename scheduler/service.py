@@ -0,0 +1,387 @@
+"""
+run placement for task sets and persist the result
+
+The solver runs outside of any transaction. What it placed is written in a
+short transaction that locks the task set row again and checks the task set
+is still the one that was placed, so an edit doesn't wait for the solver and a
+placement is never written for a task set that changed meanwhile.
+"""
+import logging
+from collections import Counter
+from dataclasses import dataclass, replace
+from typing import Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy import select
+
+from core import settings
+from db.cache import task_set_cache
+from db.database import database
+from db.models import TaskSet
+from scheduler.engine import UNPLACED, ClusterArrays, Placement, TaskArrays
+from scheduler.executor import SolverTimeout, solver_pool
+from scheduler.graph import ConstraintGraph, ConstraintRow, build_constraint_graph, connected_components
+from scheduler.loader import load_cluster_arrays, load_constraint_rows, load_task_placement
+from scheduler.memo import placement_memo
+from scheduler.portfolio import place_portfolio
+from scheduler.reservation import Reservation, conflicting_rows, release, reserve_placement
+
+logger = logging.getLogger("app")
+
+# TaskSet.state values
+TASK_SET_INCOMPLETE = 0
+TASK_SET_RUNNING = 1
+TASK_SET_FINISHED = 2
+
+
+class TaskSetChanged(Exception):
+    """the task set was edited, placed or deleted while its placement was computed"""
+
+    def __init__(self, state: Optional[int]):
+        super().__init__(state)
+        self.state = state
+
+
+class ReservationConflict(Exception):
+    """raised inside a reservation transaction to roll it back"""
+
+    def __init__(self, reservation: Reservation):
+        super().__init__([conflict.node_id for conflict in reservation.conflicts])
+        self.reservation = reservation
+
+
+@dataclass
+class TaskSetInputs:
+    """
+    what a placement of a task set is computed from
+
+    node_ids: (M,) network node of every task, UNPLACED for tasks without one
+    """
+    tasks: TaskArrays
+    node_ids: np.ndarray
+    constraint_rows: List[ConstraintRow]
+    graph: ConstraintGraph
+
+    def same_as(self, other: "TaskSetInputs") -> bool:
+        order, other_order = np.argsort(self.tasks.task_ids), np.argsort(other.tasks.task_ids)
+        return np.array_equal(self.tasks.task_ids[order], other.tasks.task_ids[other_order]) \
+            and np.array_equal(self.tasks.demand[order], other.tasks.demand[other_order]) \
+            and np.array_equal(self.tasks.delay_constraint[order], other.tasks.delay_constraint[other_order]) \
+            and np.array_equal(self.node_ids[order], other.node_ids[other_order]) \
+            and Counter(map(tuple, self.constraint_rows)) == Counter(map(tuple, other.constraint_rows))
+
+
+async def load_inputs(task_set_id: int) -> TaskSetInputs:
+    """
+    load tasks, their nodes and constraints of a task set
+
+    :param task_set_id:
+    :return:
+    """
+    tasks, node_ids = await load_task_placement(task_set_id)
+    constraint_rows = await load_constraint_rows(task_set_id)
+    return TaskSetInputs(tasks=tasks, node_ids=node_ids, constraint_rows=constraint_rows,
+                         graph=build_constraint_graph(tasks, constraint_rows))
+
+
+async def read_task_set_state(task_set_id: int) -> Optional[int]:
+    """
+    state of a task set without locking it
+
+    :param task_set_id:
+    :return: None if there is no such task set
+    """
+    task_set_table = TaskSet.Meta.table
+    return await database.fetch_val(select(task_set_table.c.state).where(task_set_table.c.id == task_set_id))
+
+
+async def lock_task_set_state(task_set_id: int) -> Optional[int]:
+    """
+    lock the task set row until the current transaction ends
+
+    :param task_set_id:
+    :return: its state, None if there is no such task set
+    """
+    task_set_table = TaskSet.Meta.table
+    return await database.fetch_val(
+        select(task_set_table.c.state).where(task_set_table.c.id == task_set_id).with_for_update())
+
+
+async def lock_unchanged(task_set_id: int, state: int, inputs: TaskSetInputs):
+    """
+    lock the task set row again and check nothing changed since inputs were
+    loaded, has to run inside a transaction
+
+    :param task_set_id:
+    :param state: state the task set had when inputs were loaded
+    :param inputs:
+    :return:
+    :raise TaskSetChanged:
+    """
+    current = await lock_task_set_state(task_set_id)
+    if current != state or not inputs.same_as(await load_inputs(task_set_id)):
+        raise TaskSetChanged(current)
+
+
+async def save_placement(task_set_id: int, cluster: ClusterArrays, tasks: TaskArrays, placement: Placement):
+    """
+    write Task.node_id, the node capacity is taken by reserve_placement before
+
+    :param task_set_id:
+    :param cluster:
+    :param tasks:
+    :param placement:
+    :return:
+    """
+    await database.execute_many(
+        "UPDATE task SET node_id = :node_id WHERE task_set_id = :task_set_id AND task_id = :task_id",
+        values=[{"task_set_id": task_set_id, "task_id": int(task_id), "node_id": int(node_id)}
+                for task_id, node_id in zip(tasks.task_ids, placement.node_ids(cluster))])
+
+
+async def commit_placement(task_set_id: int, cluster: ClusterArrays, inputs: TaskSetInputs,
+                           placement: Placement) -> Optional[Placement]:
+    """
+    reserve node capacity for a placement and save it, moving the tasks of
+    conflicting nodes
+
+    Every attempt is a short transaction that checks the task set is
+    unchanged, reserves, saves the placement and finishes the task set. On a
+    conflict nothing is written and only the constraint graph components with a
+    task on a conflicting node are placed again, outside of the transaction,
+    against the capacity read under the reservation locks minus what the other
+    tasks take.
+
+    :param task_set_id:
+    :param cluster: capacity is updated with what the reservations read
+    :param inputs: the running task set placement is computed for
+    :param placement: complete placement
+    :return: the placement that got saved, None if it couldn't be reserved
+    :raise TaskSetChanged:
+    :raise SolverTimeout:
+    """
+    tasks, graph = inputs.tasks, inputs.graph
+    labels = connected_components(graph)
+    for attempt in range(settings.RESERVATION_RETRIES + 1):
+        try:
+            async with database.transaction():
+                await lock_unchanged(task_set_id, TASK_SET_RUNNING, inputs)
+                reservation = await reserve_placement(cluster, tasks, placement)
+                if not reservation.ok:
+                    raise ReservationConflict(reservation)
+                await save_placement(task_set_id, cluster, tasks, placement)
+                await TaskSet.objects.filter(id=task_set_id).update(state=TASK_SET_FINISHED)
+            return placement
+        except ReservationConflict as e:
+            reservation = e.reservation
+        logger.info("task set %s: reservation attempt %s conflicts on nodes %s", task_set_id, attempt,
+                    [conflict.node_id for conflict in reservation.conflicts])
+        if attempt == settings.RESERVATION_RETRIES:
+            break
+
+        rows = np.isin(labels, labels[conflicting_rows(cluster, placement, reservation)]).nonzero()[0]
+        kept = Placement(node_index=placement.node_index.copy(), capacity=cluster.capacity)
+        kept.node_index[rows] = UNPLACED
+        residual = replace(cluster, capacity=cluster.capacity - kept.used(tasks, cluster.node_count))
+        moved = await solver_pool.place(residual, tasks.subset(rows), graph=graph.subset(rows))
+        if moved.placed_count < len(rows):
+            return None
+        kept.node_index[rows] = moved.node_index
+        placement = kept
+    return None
+
+
+async def place_task_set(task_set_id: int, time_budget: Optional[float] = None) -> Optional[bool]:
+    """
+    place all tasks of a running task set and move it to finished
+
+    The state is checked again under the row lock before anything is written,
+    so a job delivered twice is placed only once. A task set edited while it
+    was placed is placed again. A task set that doesn't fit is put back to
+    incomplete and nothing is written.
+
+    :param task_set_id:
+    :param time_budget: seconds for a portfolio of strategies, the best placement
+        found in time is kept, instead of the default strategy
+    :return: None if the task set is not running, else whether every task got a node
+    """
+    placed = await _place_task_set(task_set_id, time_budget)
+    if placed is not None:
+        # only after commit, or a reader could cache the old rows under the new version
+        await task_set_cache.invalidate(task_set_id)
+    return placed
+
+
+async def solve(cluster: ClusterArrays, tasks: TaskArrays, graph: ConstraintGraph,
+                time_budget: Optional[float] = None) -> Placement:
+    """
+    run the solver, the best of a portfolio of strategies when there is a time budget
+
+    :param cluster:
+    :param tasks:
+    :param graph:
+    :param time_budget: seconds every strategy of the portfolio may take
+    :return:
+    :raise SolverTimeout: no strategy returned anything in time
+    """
+    if time_budget is None:
+        return await solver_pool.place_components(cluster, tasks, graph)
+    portfolio = await place_portfolio(cluster, tasks, time_budget, graph=graph)
+    if portfolio.placement is None:
+        raise SolverTimeout(f"no strategy placed {tasks.task_count} tasks in {time_budget}s")
+    logger.info("placed %s of %s tasks with strategy %s", portfolio.placement.placed_count, tasks.task_count,
+                portfolio.strategy)
+    return portfolio.placement
+
+
+async def _solve_and_commit(task_set_id: int, cluster: ClusterArrays, inputs: TaskSetInputs,
+                            time_budget: Optional[float]) -> Optional[Placement]:
+    tasks, graph = inputs.tasks, inputs.graph
+    try:
+        # structurally identical task sets skip the solver while their cached placement still fits
+        placement = await placement_memo.place(cluster, tasks, graph,
+                                               lambda: solve(cluster, tasks, graph, time_budget))
+        if placement.placed_count < tasks.task_count:
+            logger.warning("task set %s: %s of %s tasks can't be placed", task_set_id,
+                           tasks.task_count - placement.placed_count, tasks.task_count)
+            return None
+        placement = await commit_placement(task_set_id, cluster, inputs, placement)
+    except SolverTimeout:
+        logger.exception("task set %s: placement timed out", task_set_id)
+        return None
+    if placement is None:
+        logger.warning("task set %s: node capacity taken by concurrent placements", task_set_id)
+    return placement
+
+
+async def _place_task_set(task_set_id: int, time_budget: Optional[float]) -> Optional[bool]:
+    for _ in range(settings.SCHEDULING_EDIT_RETRIES + 1):
+        if await read_task_set_state(task_set_id) != TASK_SET_RUNNING:
+            return None
+        cluster = await load_cluster_arrays()
+        inputs = await load_inputs(task_set_id)
+        try:
+            if await _solve_and_commit(task_set_id, cluster, inputs, time_budget) is not None:
+                return True
+            async with database.transaction():
+                await lock_unchanged(task_set_id, TASK_SET_RUNNING, inputs)
+                await TaskSet.objects.filter(id=task_set_id).update(state=TASK_SET_INCOMPLETE)
+            return False
+        except TaskSetChanged as e:
+            if e.state != TASK_SET_RUNNING:
+                return None
+            logger.info("task set %s: edited while being placed, placing it again", task_set_id)
+
+    logger.warning("task set %s: edited during every placement attempt", task_set_id)
+    async with database.transaction():
+        if await lock_task_set_state(task_set_id) != TASK_SET_RUNNING:
+            return None
+        await TaskSet.objects.filter(id=task_set_id).update(state=TASK_SET_INCOMPLETE)
+    return False
+
+
+async def abandon_task_set(task_set_id: int) -> bool:
+    """
+    put a running task set whose scheduling job keeps failing back to incomplete,
+    so it can be started again
+
+    :param task_set_id:
+    :return: whether the task set was running
+    """
+    async with database.transaction():
+        if await lock_task_set_state(task_set_id) != TASK_SET_RUNNING:
+            return False
+        await TaskSet.objects.filter(id=task_set_id).update(state=TASK_SET_INCOMPLETE)
+    await task_set_cache.invalidate(task_set_id)
+    return True
+
+
+async def reschedule_task_set(task_set_id: int, task_ids: Iterable[int] = ()) -> Optional[bool]:
+    """
+    place what an edit of a finished task set left without a node
+
+    Tasks without a node (new, edited, or on a node that is gone) and the
+    given tasks are placed again together with their constraint neighbours,
+    every other task stays where it is. If they can't be placed the whole task
+    set is released and put back to incomplete.
+
+    :param task_set_id:
+    :param task_ids: tasks to move even though they have a node, e.g. ends of changed constraints
+    :return: None if the task set is not finished, else whether every task has a node
+    """
+    placed = await _reschedule_task_set(task_set_id, list(task_ids))
+    if placed is not None:
+        await task_set_cache.invalidate(task_set_id)
+    return placed
+
+
+async def _reschedule_task_set(task_set_id: int, task_ids: list) -> Optional[bool]:
+    for _ in range(settings.SCHEDULING_EDIT_RETRIES + 1):
+        # a task set still running gets a full placement anyway
+        if await read_task_set_state(task_set_id) != TASK_SET_FINISHED:
+            return None
+        cluster = await load_cluster_arrays()
+        inputs = await load_inputs(task_set_id)
+        try:
+            return await _place_again(task_set_id, cluster, inputs, task_ids)
+        except TaskSetChanged as e:
+            if e.state != TASK_SET_FINISHED:
+                return None
+            logger.info("task set %s: edited while being placed, placing it again", task_set_id)
+
+    # the job of the last edit places what is left without a node
+    logger.warning("task set %s: edited during every placement attempt", task_set_id)
+    return None
+
+
+async def _place_again(task_set_id: int, cluster: ClusterArrays, inputs: TaskSetInputs, task_ids: list) -> bool:
+    tasks, graph = inputs.tasks, inputs.graph
+    node_index = cluster.rows_of(inputs.node_ids)
+    held = Placement(node_index=node_index, capacity=cluster.capacity).used(tasks, cluster.node_count)
+
+    seed = (node_index == UNPLACED) | np.isin(tasks.task_ids, task_ids)
+    affected = seed.copy()
+    affected[graph.indices[seed[graph.sources()]]] = True
+    rows = affected.nonzero()[0]
+    if not len(rows):
+        return True
+
+    # neighbours give their capacity back before being placed again, written together with the reservation
+    released = Placement(node_index=np.where(affected, node_index, UNPLACED),
+                         capacity=cluster.capacity).used(tasks, cluster.node_count)
+    cluster.capacity += released
+    node_index = np.where(affected, UNPLACED, node_index)
+    logger.info("task set %s: placing %s of %s tasks again", task_set_id, len(rows), tasks.task_count)
+
+    for attempt in range(settings.RESERVATION_RETRIES + 1):
+        try:
+            placement = await solver_pool.place(cluster, tasks, graph=graph, node_index=node_index)
+        except SolverTimeout:
+            logger.exception("task set %s: placement timed out", task_set_id)
+            break
+        if placement.placed_count < tasks.task_count:
+            logger.warning("task set %s: %s tasks can't be placed", task_set_id,
+                           tasks.task_count - placement.placed_count)
+            break
+        changed = Placement(node_index=placement.node_index[rows], capacity=placement.capacity)
+        try:
+            async with database.transaction():
+                await lock_unchanged(task_set_id, TASK_SET_FINISHED, inputs)
+                await release(cluster.node_ids, released)
+                reservation = await reserve_placement(cluster, tasks.subset(rows), changed)
+                if not reservation.ok:
+                    raise ReservationConflict(reservation)
+                await save_placement(task_set_id, cluster, tasks.subset(rows), changed)
+            return True
+        except ReservationConflict as e:
+            logger.info("task set %s: reservation attempt %s conflicts on nodes %s", task_set_id, attempt,
+                        [conflict.node_id for conflict in e.reservation.conflicts])
+
+    async with database.transaction():
+        await lock_unchanged(task_set_id, TASK_SET_FINISHED, inputs)
+        # keep the invariant that only finished task sets hold capacity
+        await release(cluster.node_ids, held)
+        await database.execute("UPDATE task SET node_id = NULL WHERE task_set_id = :task_set_id",
+                               values={"task_set_id": task_set_id})
+        await TaskSet.objects.filter(id=task_set_id).update(state=TASK_SET_INCOMPLETE)
+    return False
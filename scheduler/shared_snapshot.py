@@ -0,0 +1,412 @@
+"""
+cluster snapshot shared between processes
+
+One refresher process keeps a ClusterSnapshot up to date and publishes every
+new version into its own shared memory segment. Serving workers map the latest
+segment and read the arrays in place, so the snapshot exists once per host
+whatever the number of workers.
+
+A small header segment names the latest segment. The header is written under a
+sequence counter, odd while a write is in progress, so readers never see a half
+written header. The previous segment is only unlinked once a newer one exists.
+Workers map segments read-only with mmap, so a mapping lives exactly as long as
+the numpy arrays pointing into it, also after the worker switched to a newer
+segment. POSIX shared memory is expected under /dev/shm.
+
+The refresher also computes the node to node topology and publishes its link
+matrices, aligned to the node order of the snapshot, in a topology segment of
+their own. A snapshot segment names the topology segment that goes with it; a
+new one is only made after the links or the set of nodes change. Workers map it
+like the snapshot, and hand its name to their solver processes, which map it
+too, so the (N, N) matrices exist once per host as well.
+"""
+import asyncio
+import json
+import logging
+import mmap
+import os
+import signal
+import sys
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from core import settings
+from db.database import database
+from scheduler.buffers import map_read_only
+from scheduler.executor import TopologyHandle, topology_views
+from scheduler.snapshot import ClusterSnapshot
+from scheduler.topology import TopologyCache
+
+# header: sequence, generation of the latest segment
+HEADER_FIELDS = 2
+# segment meta: node count, geo place count, version, delay version, byte length of the names,
+# generation of its topology segment
+META_FIELDS = 6
+# topology segment meta: node count, whether there are any links, byte length of the fingerprint
+TOPOLOGY_META_FIELDS = 3
+# reads of a header being written before a reader keeps the segment it has
+HEADER_READ_ATTEMPTS = 100
+# segments kept besides the latest one, for workers still switching over
+RETAINED_SEGMENTS = 1
+
+logger = logging.getLogger("app")
+
+
+def segment_name(name: str, generation: int) -> str:
+    return f"{name}_{generation}"
+
+
+def attach(name: str) -> SharedMemory:
+    """open an existing segment without registering it with the resource tracker, which unlinks it on exit"""
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:  # python < 3.13
+        pass
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def layout(buffer, node_count: int, geo_place_count: int, names_length: int) -> Dict[str, np.ndarray]:
+    """
+    numpy views of the arrays of a segment
+
+    :param buffer: segment buffer, starting with the meta fields
+    :param node_count:
+    :param geo_place_count:
+    :param names_length: byte length of the JSON encoded node names
+    :return: node_ids, total, capacity, geo_place_ids, delay and the raw names
+    """
+    shapes = [("node_ids", np.int64, (node_count,)), ("total", np.int64, (node_count, 3)),
+              ("capacity", np.int64, (node_count, 3)), ("geo_place_ids", np.int64, (geo_place_count,)),
+              ("delay", np.float64, (node_count, geo_place_count)), ("names", np.uint8, (names_length,))]
+    views, offset = {}, META_FIELDS * 8
+    for field, dtype, shape in shapes:
+        views[field] = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        offset += views[field].nbytes
+    return views
+
+
+def segment_size(node_count: int, geo_place_count: int, names_length: int) -> int:
+    return META_FIELDS * 8 + node_count * (1 + 3 + 3 + geo_place_count) * 8 + geo_place_count * 8 + names_length
+
+
+def topology_segment_name(name: str, generation: int) -> str:
+    return f"{name}_topology_{generation}"
+
+
+def topology_layout(buffer, node_count: int, linked: bool, fingerprint_length: int) -> Dict[str, np.ndarray]:
+    """
+    numpy views of the arrays of a topology segment
+
+    :param buffer: segment buffer, starting with the topology meta fields
+    :param node_count:
+    :param linked: whether the link matrices are there, there are none while no link exists
+    :param fingerprint_length: byte length of TopologyCache.fingerprint
+    :return: node_ids, link_delay and link_bandwidth when linked, and the raw fingerprint
+    """
+    views = {"node_ids": np.ndarray(node_count, dtype=np.int64, buffer=buffer, offset=TOPOLOGY_META_FIELDS * 8)}
+    offset = links_offset(node_count)
+    if linked:
+        views["link_delay"], views["link_bandwidth"] = topology_views(buffer, node_count, offset)
+        offset += 2 * node_count * node_count * 8
+    views["fingerprint"] = np.ndarray(fingerprint_length, dtype=np.uint8, buffer=buffer, offset=offset)
+    return views
+
+
+def links_offset(node_count: int) -> int:
+    """byte offset of the link matrices in a topology segment, after the meta fields and the node ids"""
+    return (TOPOLOGY_META_FIELDS + node_count) * 8
+
+
+def create_header(name: str) -> SharedMemory:
+    """header segment, created by the launcher before the refresher and the workers start"""
+    header = SharedMemory(name=name, create=True, size=HEADER_FIELDS * 8)
+    np.ndarray(HEADER_FIELDS, dtype=np.int64, buffer=header.buf)[:] = 0
+    return header
+
+
+class SnapshotPublisher:
+    """
+    writes snapshots into shared memory, run by the refresher process only
+
+    :param name: name of the header segment made by create_header
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.header = attach(name)
+        self._fields = np.ndarray(HEADER_FIELDS, dtype=np.int64, buffer=self.header.buf)
+        self.generation = int(self._fields[1])
+        self.version = -1
+        self._segments: List[SharedMemory] = []
+        self.topology_generation = 0
+        self.topology_version = -1
+        self._topology_node_ids: Optional[np.ndarray] = None
+        self._topology_segments: List[SharedMemory] = []
+
+    def publish_topology(self, node_ids: np.ndarray, topology: TopologyCache):
+        """copy the link matrices, aligned to node_ids, into a new topology segment"""
+        fingerprint = topology.fingerprint.encode()
+        linked = topology.topology is not None and len(topology.topology.node_ids) > 0
+        node_count = len(node_ids)
+        generation = self.topology_generation + 1
+        size = links_offset(node_count) + (2 * node_count * node_count * 8 if linked else 0) + len(fingerprint)
+        segment = SharedMemory(name=topology_segment_name(self.name, generation), create=True, size=size)
+        np.ndarray(TOPOLOGY_META_FIELDS, dtype=np.int64, buffer=segment.buf)[:] = [
+            node_count, int(linked), len(fingerprint)]
+        views = topology_layout(segment.buf, node_count, linked, len(fingerprint))
+        views["node_ids"][:] = node_ids
+        if linked:
+            delay, bandwidth = topology.topology.align(node_ids)
+            views["link_delay"][:] = delay
+            views["link_bandwidth"][:] = bandwidth
+            del delay, bandwidth
+        views["fingerprint"][:] = np.frombuffer(fingerprint, dtype=np.uint8)
+        del views
+
+        self.topology_generation = generation
+        self.topology_version = topology.version
+        self._topology_node_ids = node_ids.copy()
+        # the retained snapshot segments name at most the previous one
+        self._topology_segments.append(segment)
+        while len(self._topology_segments) > RETAINED_SEGMENTS + 1:
+            old = self._topology_segments.pop(0)
+            old.close()
+            old.unlink()
+
+    def publish(self, snapshot: ClusterSnapshot, topology: TopologyCache):
+        """copy the snapshot into a new segment and point the header at it"""
+        if topology.version != self.topology_version or self._topology_node_ids is None \
+                or not np.array_equal(snapshot.node_ids, self._topology_node_ids):
+            self.publish_topology(snapshot.node_ids, topology)
+        names = json.dumps(snapshot.names).encode()
+        node_count, geo_place_count = snapshot.node_count, len(snapshot.geo_place_ids)
+        generation = self.generation + 1
+        segment = SharedMemory(name=segment_name(self.name, generation), create=True,
+                               size=segment_size(node_count, geo_place_count, len(names)))
+        np.ndarray(META_FIELDS, dtype=np.int64, buffer=segment.buf)[:] = [
+            node_count, geo_place_count, snapshot.version, snapshot.delay_version, len(names),
+            self.topology_generation]
+        views = layout(segment.buf, node_count, geo_place_count, len(names))
+        views["node_ids"][:] = snapshot.node_ids
+        views["total"][:] = snapshot.total
+        views["capacity"][:] = snapshot.capacity
+        views["geo_place_ids"][:] = snapshot.geo_place_ids
+        views["delay"][:] = snapshot.delay
+        views["names"][:] = np.frombuffer(names, dtype=np.uint8)
+        del views
+
+        self._fields[0] += 1
+        self._fields[1] = generation
+        self._fields[0] += 1
+        self.generation = generation
+        self.version = snapshot.version
+
+        self._segments.append(segment)
+        while len(self._segments) > RETAINED_SEGMENTS + 1:
+            old = self._segments.pop(0)
+            old.close()
+            old.unlink()
+
+    def close(self):
+        """unlink every segment this publisher made"""
+        for segment in self._segments + self._topology_segments:
+            segment.close()
+            segment.unlink()
+        self._segments, self._topology_segments = [], []
+        del self._fields
+        self.header.close()
+
+
+class SharedClusterSnapshot(ClusterSnapshot):
+    """
+    read-only snapshot of a serving worker, mapped from the segments of the
+    refresher process
+
+    Until the first segment is published it loads its own copy from database
+    like a plain ClusterSnapshot.
+    """
+
+    def __init__(self, name: str):
+        super().__init__()
+        self.name = name
+        self.generation = 0
+        self._header: Optional[mmap.mmap] = None
+        # topology segment named by the mapped snapshot segment, 0 while none is mapped
+        self.topology_generation = 0
+        self.topology_fingerprint: Optional[str] = None
+        self.topology_handle: Optional[TopologyHandle] = None
+        self.link_node_ids: Optional[np.ndarray] = None
+        self.link_delay: Optional[np.ndarray] = None
+        self.link_bandwidth: Optional[np.ndarray] = None
+
+    def _latest_generation(self) -> int:
+        if self._header is None:
+            try:
+                self._header = map_read_only(self.name)
+            except FileNotFoundError:
+                return 0
+        fields = np.frombuffer(self._header, dtype=np.int64, count=HEADER_FIELDS)
+        for _ in range(HEADER_READ_ATTEMPTS):
+            sequence, generation = int(fields[0]), int(fields[1])
+            if sequence % 2 == 0 and int(fields[0]) == sequence:
+                return generation
+            # the refresher is between the two increments, let it run
+            os.sched_yield()
+        # keep the mapped segment, the next refresh looks again
+        return self.generation
+
+    def _map(self, generation: int) -> Optional[Tuple[Dict[str, np.ndarray], List[int]]]:
+        try:
+            segment = map_read_only(segment_name(self.name, generation))
+        except FileNotFoundError:
+            # unlinked already, a newer one is published
+            return None
+        meta = np.frombuffer(segment, dtype=np.int64, count=META_FIELDS).tolist()
+        return layout(segment, meta[0], meta[1], meta[4]), meta
+
+    def _map_topology(self, generation: int):
+        name = topology_segment_name(self.name, generation)
+        try:
+            segment = map_read_only(name)
+        except FileNotFoundError:
+            # the topology cache computes its own until a newer segment is mapped
+            self.topology_generation, self.topology_fingerprint = 0, None
+            return
+        node_count, linked, fingerprint_length = np.frombuffer(
+            segment, dtype=np.int64, count=TOPOLOGY_META_FIELDS).tolist()
+        views = topology_layout(segment, node_count, bool(linked), fingerprint_length)
+        self.link_node_ids = views["node_ids"]
+        self.link_delay = views.get("link_delay")
+        self.link_bandwidth = views.get("link_bandwidth")
+        self.topology_handle = (name, node_count, links_offset(node_count)) if linked else None
+        self.topology_fingerprint = views["fingerprint"].tobytes().decode()
+        self.topology_generation = generation
+
+    def switch(self) -> bool:
+        """
+        map the latest published segment if it is newer than the mapped one
+
+        :return: whether any published segment is mapped
+        """
+        generation = self._latest_generation()
+        if generation in (0, self.generation):
+            return self.generation > 0
+        mapped = self._map(generation)
+        if mapped is None:
+            return self.generation > 0
+        views, (_, _, version, delay_version, _, topology_generation) = mapped
+
+        if self.generation == 0 or delay_version != self.delay_version:
+            self._delay_index_version = -1
+        # the arrays of the previous segment stay valid for whoever still holds them
+        self.node_ids = views["node_ids"]
+        self.total = views["total"]
+        self.capacity = views["capacity"]
+        self.geo_place_ids = views["geo_place_ids"]
+        self.delay = views["delay"]
+        self.names = json.loads(views["names"].tobytes())
+        self._rows = {node_id: row for row, node_id in enumerate(self.node_ids.tolist())}
+        self._columns = {geo_place_id: column for column, geo_place_id in enumerate(self.geo_place_ids.tolist())}
+        self.version = version
+        self.delay_version = delay_version
+        self.loaded = True
+        self.generation = generation
+        if topology_generation != self.topology_generation:
+            self._map_topology(topology_generation)
+        return True
+
+    async def load(self):
+        await self.refresh()
+
+    async def refresh(self):
+        if not self.switch():
+            await super().refresh()
+
+    async def run_refresher(self, interval: float = settings.SHARED_SNAPSHOT_POLL_INTERVAL):
+        await super().run_refresher(interval)
+
+    async def save_if_due(self, force: bool = False):
+        # the refresher process saves the snapshot
+        pass
+
+
+class SharedTopologyCache(TopologyCache):
+    """
+    topology of a serving worker, the link matrices the refresher process
+    published with the shared snapshot
+
+    Until a topology segment is mapped, or for a node order other than the
+    snapshot's, it computes its own like a plain TopologyCache.
+    """
+
+    def __init__(self, snapshot: SharedClusterSnapshot):
+        super().__init__()
+        self.snapshot = snapshot
+
+    @property
+    def fingerprint(self) -> str:
+        if self.snapshot.topology_fingerprint is not None:
+            return self.snapshot.topology_fingerprint
+        return super().fingerprint
+
+    async def aligned(self, node_ids: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        snapshot = self.snapshot
+        if snapshot.switch() and snapshot.topology_fingerprint is not None \
+                and np.array_equal(node_ids, snapshot.link_node_ids):
+            return snapshot.link_delay, snapshot.link_bandwidth
+        return await super().aligned(node_ids)
+
+    def segment_of(self, link_delay: Optional[np.ndarray]) -> Optional[TopologyHandle]:
+        if link_delay is not None and link_delay is self.snapshot.link_delay:
+            return self.snapshot.topology_handle
+        return None
+
+
+async def publish_forever(publisher: SnapshotPublisher, interval: float):
+    snapshot = ClusterSnapshot()
+    topology = TopologyCache()
+    await database.connect()
+    try:
+        while True:
+            try:
+                await snapshot.refresh()
+                await topology.load()
+                if snapshot.version != publisher.version or topology.version != publisher.topology_version:
+                    publisher.publish(snapshot, topology)
+                await snapshot.save_if_due()
+            except Exception:
+                # workers keep the last published snapshot, the next round retries
+                logger.exception("publish cluster snapshot failed")
+            await asyncio.sleep(interval)
+    finally:
+        await snapshot.save_if_due(force=True)
+        await database.disconnect()
+
+
+def run_publisher(name: str, interval: float = settings.CLUSTER_SNAPSHOT_REFRESH_INTERVAL):
+    """
+    entry point of the refresher process
+
+    :param name: header segment made by create_header
+    :param interval: seconds between two refreshes
+    :return:
+    """
+    import utils.logger  # noqa: F401, configures logging
+
+    # terminate() of the launcher unwinds through the finally below
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    publisher = SnapshotPublisher(name)
+    try:
+        asyncio.run(publish_forever(publisher, interval))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close()
@@ -0,0 +1,398 @@
+"""
+process-wide in-memory snapshot of the cluster
+
+Node capacities and the node x geo place delay matrix are kept as compact numpy
+arrays tagged with a version number, so reads and scheduling runs don't need
+to hit MySQL. The snapshot is refreshed incrementally from rows whose mtime
+moved since the last refresh.
+
+The snapshot is saved to a file now and then. A restarting process maps that
+file and only applies the rows changed since it was saved, instead of loading
+every node and delay again. The file also keeps the max id and max mtime of
+both tables when it was saved; a database where either went back, e.g.
+restored from an older backup, truncated or seeded again, is loaded cold.
+"""
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from core import settings
+from db.database import database
+from db.models import NetworkNode, NetworkNodeDelay
+from scheduler.delay_index import DelayIndex
+from scheduler.engine import ClusterArrays, DelayRow
+from scheduler.snapshot_file import SnapshotFileError, database_marker, read_snapshot_file, write_snapshot_file
+
+# (id, name, cpu, mem, disk, cpu_rem, mem_rem, disk_rem)
+NodeInfoRow = Tuple[int, str, int, int, int, int, int, int]
+
+NODE_FIELDS = ["id", "name", "cpu", "mem", "disk", "cpu_rem", "mem_rem", "disk_rem"]
+DELAY_FIELDS = ["id", "node_id", "geo_place_id", "delay"]
+# tables the snapshot is made from, their signatures are saved with it
+SNAPSHOT_TABLES = ("network_node", "network_node_delay")
+
+logger = logging.getLogger("app")
+
+
+def _as_datetime(value) -> Optional[datetime]:
+    # sqlite hands MAX(mtime) back as text
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+async def table_signatures() -> Dict[str, List]:
+    """count, max id and max mtime of the snapshot tables, JSON ready"""
+    signatures = {}
+    for table in SNAPSHOT_TABLES:
+        count, max_id, max_mtime = await database.fetch_one(f"SELECT COUNT(*), MAX(id), MAX(mtime) FROM {table}")
+        max_mtime = _as_datetime(max_mtime)
+        signatures[table] = [count, max_id, max_mtime.isoformat() if max_mtime else None]
+    return signatures
+
+
+def went_back(saved: Dict[str, List], current: Dict[str, List]) -> bool:
+    """
+    whether max id or max mtime of a table is below the saved one, which rows
+    changed after a save never cause
+
+    :param saved: table_signatures when a snapshot was saved
+    :param current: table_signatures now
+    :return:
+    """
+    for table in SNAPSHOT_TABLES:
+        _, saved_id, saved_mtime = saved[table]
+        _, max_id, max_mtime = current[table]
+        if saved_id is not None and (max_id is None or max_id < saved_id):
+            return True
+        if saved_mtime is not None and (max_mtime is None or _as_datetime(max_mtime) < _as_datetime(saved_mtime)):
+            return True
+    return False
+
+
+class ClusterSnapshot:
+    """ 集群状态快照 """
+
+    def __init__(self):
+        self.version = 0
+        # bumped only when delays or the set of nodes change
+        self.delay_version = 0
+        self._delay_index: Optional[DelayIndex] = None
+        self._delay_index_version = -1
+        self._saved_version = None
+        self._saved_at = 0.0
+        # table_signatures of the file the snapshot was restored from
+        self._restored_tables: Optional[Dict[str, List]] = None
+        self._lock = asyncio.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.loaded = False
+        self.node_ids = np.empty(0, dtype=np.int64)
+        self.names: List[str] = []
+        self.total = np.empty((0, 3), dtype=np.int64)
+        self.capacity = np.empty((0, 3), dtype=np.int64)
+        self.geo_place_ids = np.empty(0, dtype=np.int64)
+        self.delay = np.empty((0, 0), dtype=np.float64)
+        self._rows: Dict[int, int] = {}
+        self._columns: Dict[int, int] = {}
+        self._sorted_version = -1
+        self._sorted_rows = np.empty(0, dtype=np.int64)
+        self._watermark: Optional[datetime] = None
+        # delay rows may repeat a (node, geo place) cell, so deletions are
+        # detected from row counts instead of the matrix
+        self._delay_row_count = 0
+        self._delay_max_id = 0
+
+    @property
+    def node_count(self) -> int:
+        return len(self.node_ids)
+
+    def apply_nodes(self, rows: Iterable[NodeInfoRow]) -> int:
+        """
+        insert or update network nodes
+
+        :param rows: (id, name, cpu, mem, disk, cpu_rem, mem_rem, disk_rem) rows
+        :return: number of changed nodes
+        """
+        changed = 0
+        new_ids, new_names, new_values = [], [], []
+        for node_id, name, *values in rows:
+            row = self._rows.get(node_id)
+            if row is None:
+                self._rows[node_id] = self.node_count + len(new_ids)
+                new_ids.append(node_id)
+                new_names.append(name)
+                new_values.append(values)
+                changed += 1
+                continue
+            if self.names[row] != name or self.total[row].tolist() + self.capacity[row].tolist() != values:
+                self.names[row] = name
+                self.total[row] = values[:3]
+                self.capacity[row] = values[3:]
+                changed += 1
+
+        if new_ids:
+            new_values = np.array(new_values, dtype=np.int64).reshape(-1, 6)
+            self.node_ids = np.concatenate([self.node_ids, np.array(new_ids, dtype=np.int64)])
+            self.names.extend(new_names)
+            self.total = np.concatenate([self.total, new_values[:, :3]])
+            self.capacity = np.concatenate([self.capacity, new_values[:, 3:]])
+            self.delay = np.concatenate(
+                [self.delay, np.full((len(new_ids), len(self.geo_place_ids)), np.inf)])
+            self.delay_version += 1
+
+        if changed:
+            self.version += 1
+        return changed
+
+    def apply_delays(self, rows: Iterable[DelayRow]) -> int:
+        """
+        insert or update node to geo place delays, rows of unknown nodes are skipped
+
+        :param rows: (node_id, geo_place_id, delay) rows
+        :return: number of changed cells
+        """
+        changed = 0
+        for node_id, geo_place_id, delay in rows:
+            row = self._rows.get(node_id)
+            if row is None:
+                continue
+            column = self._columns.get(geo_place_id)
+            if column is None:
+                column = self._columns[geo_place_id] = len(self.geo_place_ids)
+                self.geo_place_ids = np.append(self.geo_place_ids, geo_place_id)
+                self.delay = np.concatenate([self.delay, np.full((self.node_count, 1), np.inf)], axis=1)
+            if self.delay[row, column] != delay:
+                self.delay[row, column] = delay
+                changed += 1
+
+        if changed:
+            self.version += 1
+            self.delay_version += 1
+        return changed
+
+    async def load(self):
+        """reload the whole snapshot from database"""
+        async with self._lock:
+            await self._load()
+
+    async def _load(self):
+        started_at = await self._db_now()
+        nodes = await NetworkNode.objects.values_list(NODE_FIELDS)
+        delays = await NetworkNodeDelay.objects.values_list(DELAY_FIELDS)
+        version = self.version
+        self._clear()
+        self.apply_nodes(nodes)
+        self.apply_delays(row[1:] for row in delays)
+        self.version = version + 1
+        self.delay_version += 1
+        self._delay_row_count = len(delays)
+        self._delay_max_id = max((row[0] for row in delays), default=0)
+        self._watermark = started_at
+        self.loaded = True
+
+    def _restore(self, path: str) -> bool:
+        """
+        take the snapshot, its refresh state and the delay index from a saved file
+
+        :param path:
+        :return: whether the file was usable
+        """
+        try:
+            meta, arrays = read_snapshot_file(path)
+        except SnapshotFileError as e:
+            logger.info("cluster snapshot starts cold: %s", e)
+            return False
+        if meta["database"] != database_marker() or "tables" not in meta:
+            logger.info("cluster snapshot starts cold: file of another database")
+            return False
+
+        self._clear()
+        # copied out of the mapping, refreshes update them in place
+        self.node_ids = arrays["node_ids"].copy()
+        self.total = arrays["total"].copy()
+        self.capacity = arrays["capacity"].copy()
+        self.geo_place_ids = arrays["geo_place_ids"].copy()
+        self.delay = arrays["delay"].copy()
+        self.names = json.loads(arrays["names"].tobytes())
+        self._rows = {node_id: row for row, node_id in enumerate(self.node_ids.tolist())}
+        self._columns = {geo_place_id: column for column, geo_place_id in enumerate(self.geo_place_ids.tolist())}
+        self.version = max(self.version, meta["version"]) + 1
+        self.delay_version = max(self.delay_version, meta["delay_version"]) + 1
+        if meta["delay_index"]:
+            index = {name[len("index_"):]: array.copy() for name, array in arrays.items() if name.startswith("index_")}
+            self._delay_index = DelayIndex.from_arrays(self.cluster_arrays(), index)
+            self._delay_index_version = self.delay_version
+        self._delay_row_count = meta["delay_row_count"]
+        self._delay_max_id = meta["delay_max_id"]
+        self._watermark = datetime.fromisoformat(meta["watermark"])
+        self._restored_tables = meta["tables"]
+        self._saved_version = self.version
+        self.loaded = True
+        logger.info("cluster snapshot restored from %s: %s nodes", path, self.node_count)
+        return True
+
+    async def save(self, path: str = settings.CLUSTER_SNAPSHOT_FILE):
+        """write the snapshot, its refresh state and the delay index to a file"""
+        if not self.loaded:
+            return
+        # copied at once, so the file matches one version whatever refreshes run while it is written
+        arrays = {"node_ids": self.node_ids.copy(), "total": self.total.copy(), "capacity": self.capacity.copy(),
+                  "geo_place_ids": self.geo_place_ids.copy(), "delay": self.delay.copy(),
+                  "names": np.frombuffer(json.dumps(self.names).encode(), dtype=np.uint8)}
+        with_index = self._delay_index is not None and self._delay_index_version == self.delay_version
+        if with_index:
+            arrays.update((f"index_{name}", array) for name, array in self._delay_index.arrays().items())
+        meta = {"database": database_marker(), "version": self.version, "delay_version": self.delay_version,
+                "delay_index": with_index, "delay_row_count": self._delay_row_count,
+                "delay_max_id": self._delay_max_id, "watermark": self._watermark.isoformat()}
+        version = self.version
+        # read after the copy, so it is never behind what the file holds
+        meta["tables"] = await table_signatures()
+        await asyncio.get_running_loop().run_in_executor(None, write_snapshot_file, path, meta, arrays)
+        self._saved_version = version
+        self._saved_at = time.monotonic()
+
+    async def save_if_due(self, force: bool = False):
+        """save a changed snapshot at most every CLUSTER_SNAPSHOT_SAVE_INTERVAL seconds"""
+        if self.version == self._saved_version:
+            return
+        if force or time.monotonic() - self._saved_at >= settings.CLUSTER_SNAPSHOT_SAVE_INTERVAL:
+            await self.save()
+
+    async def refresh(self):
+        """apply rows changed since the last refresh, fall back to a full load on deletions"""
+        async with self._lock:
+            if not self.loaded:
+                restored = await asyncio.get_running_loop().run_in_executor(
+                    None, self._restore, settings.CLUSTER_SNAPSHOT_FILE)
+                if restored and went_back(self._restored_tables, await table_signatures()):
+                    logger.info("cluster snapshot starts cold: database went back since the file was saved")
+                    restored = False
+                if not restored:
+                    return await self._load()
+
+            started_at = await self._db_now()
+            nodes = await NetworkNode.objects.filter(mtime__gte=self._watermark).values_list(NODE_FIELDS)
+            delays = await NetworkNodeDelay.objects.filter(
+                mtime__gte=self._watermark).values_list(DELAY_FIELDS)
+            self.apply_nodes(nodes)
+            self.apply_delays(row[1:] for row in delays)
+            self._watermark = started_at
+            self._delay_row_count += sum(1 for row in delays if row[0] > self._delay_max_id)
+            self._delay_max_id = max([self._delay_max_id] + [row[0] for row in delays])
+
+            # deleted rows leave no mtime behind, only the counts tell
+            if await NetworkNode.objects.count() != self.node_count \
+                    or await NetworkNodeDelay.objects.count() != self._delay_row_count:
+                await self._load()
+
+    async def run_refresher(self, interval: float = settings.CLUSTER_SNAPSHOT_REFRESH_INTERVAL):
+        """refresh the snapshot forever, meant to run as a background task"""
+        while True:
+            try:
+                await self.refresh()
+                await self.save_if_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # keep serving the last good snapshot, the next round retries
+                logger.exception("refresh cluster snapshot failed")
+            await asyncio.sleep(interval)
+
+    @staticmethod
+    async def _db_now() -> datetime:
+        # use the database clock so the watermark matches the mtime it writes
+        return await database.fetch_val("SELECT CURRENT_TIMESTAMP")
+
+    def cluster_arrays(self) -> ClusterArrays:
+        """
+        engine input built from the snapshot, arrays are copied so later
+        refreshes don't change them under a running placement
+        """
+        return ClusterArrays(node_ids=self.node_ids.copy(), capacity=self.capacity.copy(),
+                             geo_place_ids=self.geo_place_ids.copy(), delay=self.delay.copy())
+
+    def delay_index(self) -> DelayIndex:
+        """geo place delay index, rebuilt lazily after delays change"""
+        if self._delay_index_version != self.delay_version:
+            self._delay_index = DelayIndex(self.cluster_arrays())
+            self._delay_index_version = self.delay_version
+        return self._delay_index
+
+    def sorted_rows(self) -> np.ndarray:
+        """rows ordered by node id, cached per version"""
+        if self._sorted_version != self.version:
+            self._sorted_rows = np.argsort(self.node_ids, kind="stable")
+            self._sorted_version = self.version
+        return self._sorted_rows
+
+    def node_info(self, row: int) -> dict:
+        """network node fields of a row, same shape as NetworkNode.dict()"""
+        cpu, mem, disk = self.total[row].tolist()
+        cpu_rem, mem_rem, disk_rem = self.capacity[row].tolist()
+        return {"id": int(self.node_ids[row]), "name": self.names[row], "cpu": cpu, "mem": mem, "disk": disk,
+                "cpu_rem": cpu_rem, "mem_rem": mem_rem, "disk_rem": disk_rem}
+
+    def node_delays(self, row: int) -> List[dict]:
+        measured = np.flatnonzero(np.isfinite(self.delay[row]))
+        return [{"geo_place_id": int(self.geo_place_ids[column]), "delay": int(self.delay[row, column])}
+                for column in measured]
+
+    def get_node(self, node_id: int) -> Optional[dict]:
+        """
+        detail of a network node with its delays
+
+        :param node_id:
+        :return: None if node is unknown
+        """
+        row = self._rows.get(node_id)
+        if row is None:
+            return None
+        detail = self.node_info(row)
+        detail["delay"] = self.node_delays(row)
+        return detail
+
+    def list_nodes(self, order_by: str = "desc", page: int = 1, page_size: int = 20,
+                   after_id: Optional[int] = None, include_delay: bool = False) -> Tuple[List[dict], bool]:
+        """
+        page of network nodes ordered by id
+
+        :param order_by: desc or asc
+        :param page: offset page, ignored when after_id is given
+        :param page_size:
+        :param after_id: return nodes after this id in the given order
+        :param include_delay: add the delays of every node
+        :return: (nodes, whether there is a next page)
+        """
+        rows = self.sorted_rows()
+        if order_by == "desc":
+            rows = rows[::-1]
+        if after_id is None:
+            start = (page - 1) * page_size
+        else:
+            ids = self.node_ids[rows]
+            start = np.searchsorted(-ids, -after_id, side="right") if order_by == "desc" \
+                else np.searchsorted(ids, after_id, side="right")
+        items = []
+        for row in rows[start:start + page_size]:
+            item = self.node_info(row)
+            if include_delay:
+                item["delay"] = self.node_delays(row)
+            items.append(item)
+        return items, start + page_size < len(rows)
+
+
+def process_snapshot() -> ClusterSnapshot:
+    """snapshot of this process, mapped from shared memory in the workers of serve.py"""
+    if settings.SHARED_SNAPSHOT:
+        from scheduler.shared_snapshot import SharedClusterSnapshot
+        return SharedClusterSnapshot(settings.SHARED_SNAPSHOT)
+    return ClusterSnapshot()
+
+
+cluster_snapshot = process_snapshot()
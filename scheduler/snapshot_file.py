@@ -0,0 +1,120 @@
+"""
+versioned binary files of numpy arrays, read back through mmap
+
+Layout: magic, format version, length of a JSON meta block, the meta block,
+then every array 8 byte aligned. The meta block describes the arrays and
+carries a crc32 of the array bytes, so a truncated or foreign file is rejected
+instead of half loaded. Files are written to a temporary name and renamed, a
+reader never sees a file being written.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import zlib
+from typing import Dict, Tuple
+
+import numpy as np
+
+from core import settings
+
+MAGIC = b"TANGOSNP"
+FORMAT_VERSION = 1
+# magic, format version, meta length
+PREAMBLE = struct.Struct("<8sQQ")
+ALIGNMENT = 8
+
+
+class SnapshotFileError(ValueError):
+    """missing, foreign, outdated or damaged snapshot file"""
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_snapshot_file(path: str, meta: dict, arrays: Dict[str, np.ndarray]):
+    """
+    write arrays and meta atomically
+
+    :param path:
+    :param meta: JSON serializable, returned as is by read_snapshot_file
+    :param arrays: by name
+    :return:
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout, offset, crc = {}, 0, 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _aligned(offset + array.nbytes)
+        crc = zlib.crc32(array.data, crc)
+    header = json.dumps({"meta": meta, "arrays": layout, "crc32": crc}).encode()
+    data_start = _aligned(PREAMBLE.size + len(header))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "wb") as f:
+            f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+            f.write(header)
+            for name, array in arrays.items():
+                f.seek(data_start + layout[name]["offset"])
+                f.write(array.data)
+            f.truncate(data_start + offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def read_snapshot_file(path: str) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """
+    map a file written by write_snapshot_file
+
+    :param path:
+    :return: meta, read-only arrays backed by the mapping
+    :raise SnapshotFileError:
+    """
+    try:
+        with open(path, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+    except (FileNotFoundError, ValueError) as e:
+        # ValueError: empty file
+        raise SnapshotFileError(f"no snapshot file: {e}") from None
+
+    if len(mapping) < PREAMBLE.size:
+        raise SnapshotFileError("truncated snapshot file")
+    magic, format_version, header_length = PREAMBLE.unpack_from(mapping)
+    if magic != MAGIC:
+        raise SnapshotFileError("not a snapshot file")
+    if format_version != FORMAT_VERSION:
+        raise SnapshotFileError(f"snapshot file format {format_version}, expected {FORMAT_VERSION}")
+    try:
+        header = json.loads(mapping[PREAMBLE.size:PREAMBLE.size + header_length])
+    except ValueError:
+        raise SnapshotFileError("damaged snapshot file header") from None
+
+    data_start = _aligned(PREAMBLE.size + header_length)
+    arrays, crc = {}, 0
+    for name, spec in header["arrays"].items():
+        dtype, shape = np.dtype(spec["dtype"]), tuple(spec["shape"])
+        start = data_start + spec["offset"]
+        if start + dtype.itemsize * int(np.prod(shape)) > len(mapping):
+            raise SnapshotFileError("truncated snapshot file")
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=mapping, offset=start)
+        crc = zlib.crc32(arrays[name].data, crc)
+    if crc != header["crc32"]:
+        raise SnapshotFileError("snapshot file checksum mismatch")
+    return header["meta"], arrays
+
+
+def database_marker() -> str:
+    """
+    identifies the database a snapshot file was made from by its URL, callers
+    check the data they depend on themselves
+    """
+    return hashlib.sha1(settings.DATABASE_URL.encode()).hexdigest()
@@ -0,0 +1,216 @@
+"""
+node to node topology
+
+network_link rows are turned into all pairs matrices of the shortest delay and
+the widest bottleneck bandwidth between network nodes, so a pairwise inter task
+constraint becomes two array lookups. The matrices are cached against the link
+table and only recomputed after links change, and saved to a file so a restart
+doesn't recompute them for an unchanged link table. Under serve.py the
+refresher process computes them once and the workers map its copy.
+"""
+import asyncio
+import json
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from core import settings
+from db.database import database
+from db.models import NetworkLink
+from scheduler.engine import ClusterArrays
+from scheduler.snapshot_file import SnapshotFileError, database_marker, read_snapshot_file, write_snapshot_file
+
+# (a_node_id, z_node_id, delay, bandwidth)
+LinkRow = Tuple[int, int, int, int]
+
+LINK_FIELDS = ["a_node_id", "z_node_id", "delay", "bandwidth"]
+
+logger = logging.getLogger("app")
+
+
+@dataclass
+class Topology:
+    """
+    all pairs matrices over the nodes that appear in any link
+
+    node_ids: network node id of every row / column
+    delay: (K, K) shortest path delay, 0 on the diagonal, inf when unreachable
+    bandwidth: (K, K) widest path bottleneck bandwidth, inf on the diagonal, 0 when unreachable
+    """
+    node_ids: np.ndarray
+    delay: np.ndarray
+    bandwidth: np.ndarray
+
+    def align(self, node_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        matrices reindexed to the given node order, nodes without links only
+        reach themselves
+
+        :param node_ids: e.g. ClusterArrays.node_ids
+        :return: (N, N) delay and bandwidth
+        """
+        count = len(node_ids)
+        delay = np.full((count, count), np.inf, dtype=np.float64)
+        bandwidth = np.zeros((count, count), dtype=np.float64)
+        if len(self.node_ids) and count:
+            order = np.argsort(self.node_ids)
+            pos = np.searchsorted(self.node_ids, node_ids, sorter=order).clip(max=len(self.node_ids) - 1)
+            rows = order[pos]
+            known = (self.node_ids[rows] == node_ids).nonzero()[0]
+            delay[np.ix_(known, known)] = self.delay[np.ix_(rows[known], rows[known])]
+            bandwidth[np.ix_(known, known)] = self.bandwidth[np.ix_(rows[known], rows[known])]
+        np.fill_diagonal(delay, 0)
+        np.fill_diagonal(bandwidth, np.inf)
+        return delay, bandwidth
+
+
+def all_pairs(links: Iterable[LinkRow]) -> Topology:
+    """
+    vectorized Floyd-Warshall over undirected links
+
+    Delay and bandwidth are relaxed independently: delay is the shortest path,
+    bandwidth is the best bottleneck over any path. Parallel links keep the
+    lowest delay and the highest bandwidth.
+
+    :param links: (a_node_id, z_node_id, delay, bandwidth) rows
+    :return:
+    """
+    rows = np.array(list(links), dtype=np.int64).reshape(-1, 4)
+    node_ids = np.unique(rows[:, :2])
+    count = len(node_ids)
+    delay = np.full((count, count), np.inf, dtype=np.float64)
+    bandwidth = np.zeros((count, count), dtype=np.float64)
+
+    a = np.searchsorted(node_ids, rows[:, 0])
+    z = np.searchsorted(node_ids, rows[:, 1])
+    src, dst = np.concatenate([a, z]), np.concatenate([z, a])
+    np.minimum.at(delay, (src, dst), np.concatenate([rows[:, 2], rows[:, 2]]))
+    np.maximum.at(bandwidth, (src, dst), np.concatenate([rows[:, 3], rows[:, 3]]))
+    np.fill_diagonal(delay, 0)
+    np.fill_diagonal(bandwidth, np.inf)
+
+    for k in range(count):
+        np.minimum(delay, delay[:, k, None] + delay[None, k, :], out=delay)
+        np.maximum(bandwidth, np.minimum(bandwidth[:, k, None], bandwidth[None, k, :]), out=bandwidth)
+
+    return Topology(node_ids=node_ids, delay=delay, bandwidth=bandwidth)
+
+
+def signature_marker(signature: tuple) -> List:
+    """JSON form of a link table signature"""
+    return [value.isoformat() if isinstance(value, datetime) else value for value in signature]
+
+
+def save_topology(path: str, topology: Topology, signature: tuple):
+    write_snapshot_file(path, {"database": database_marker(), "signature": signature_marker(signature)},
+                        {"node_ids": topology.node_ids, "delay": topology.delay, "bandwidth": topology.bandwidth})
+
+
+def restore_topology(path: str, signature: tuple) -> Optional[Topology]:
+    """
+    topology saved for the same link table
+
+    :param path:
+    :param signature: of the link table now
+    :return: None when there is no usable file
+    """
+    try:
+        meta, arrays = read_snapshot_file(path)
+    except SnapshotFileError:
+        return None
+    if meta["database"] != database_marker() or meta["signature"] != signature_marker(signature):
+        return None
+    return Topology(node_ids=arrays["node_ids"].copy(), delay=arrays["delay"].copy(),
+                    bandwidth=arrays["bandwidth"].copy())
+
+
+class TopologyCache:
+    """ 节点拓扑缓存 """
+
+    def __init__(self):
+        self.version = 0
+        self.topology: Optional[Topology] = None
+        self._signature = None
+        self._aligned_key = None
+        self._aligned: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._lock = asyncio.Lock()
+
+    async def _link_signature(self):
+        # deletions change the count, inserts the max id, updates the max mtime
+        return tuple(await database.fetch_one(
+            "SELECT COUNT(*), MAX(id), MAX(mtime) FROM network_link"))
+
+    async def load(self) -> Topology:
+        """
+        current topology, recomputed only when network_link changed
+
+        :return:
+        """
+        async with self._lock:
+            signature = await self._link_signature()
+            if self.topology is None or signature != self._signature:
+                loop = asyncio.get_running_loop()
+                topology = None
+                if self.topology is None:
+                    topology = await loop.run_in_executor(None, restore_topology, settings.TOPOLOGY_FILE, signature)
+                if topology is None:
+                    links = await NetworkLink.objects.values_list(LINK_FIELDS)
+                    # O(K^3), keep it off the event loop
+                    topology = await loop.run_in_executor(None, all_pairs, links)
+                    logger.info("topology computed: %s nodes, %s links", len(topology.node_ids), len(links))
+                    try:
+                        await loop.run_in_executor(None, save_topology, settings.TOPOLOGY_FILE, topology, signature)
+                    except OSError:
+                        logger.exception("save topology failed")
+                self.topology = topology
+                self._signature = signature
+                self.version += 1
+                logger.info("topology v%s: %s nodes", self.version, len(self.topology.node_ids))
+            return self.topology
+
+    @property
+    def fingerprint(self) -> str:
+        """identifies the link table the topology was computed from, the same in every process"""
+        return json.dumps(signature_marker(self._signature)) if self._signature is not None else ""
+
+    async def aligned(self, node_ids: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """
+        delay and bandwidth matrices in the given node order, cached for the
+        last node order asked for
+
+        :param node_ids:
+        :return: (None, None) while there are no links at all, so pairwise
+            constraints stay unchecked instead of forcing co-location
+        """
+        topology = await self.load()
+        if not len(topology.node_ids):
+            return None, None
+        key = (self.version, node_ids.tobytes())
+        if key != self._aligned_key:
+            self._aligned = topology.align(node_ids)
+            self._aligned_key = key
+        return self._aligned
+
+    def segment_of(self, link_delay: Optional[np.ndarray]) -> Optional[Tuple[str, int, int]]:
+        """shared memory segment the matrices handed out by aligned are mapped from, None when they are private"""
+        return None
+
+    async def attach(self, cluster: ClusterArrays):
+        """set the link matrices of cluster for its node order"""
+        cluster.link_delay, cluster.link_bandwidth = await self.aligned(cluster.node_ids)
+        cluster.link_segment = self.segment_of(cluster.link_delay)
+
+
+def process_topology_cache() -> TopologyCache:
+    """topology cache of this process, mapped from shared memory in the workers of serve.py"""
+    if settings.SHARED_SNAPSHOT:
+        from scheduler.shared_snapshot import SharedTopologyCache
+        from scheduler.snapshot import cluster_snapshot
+        return SharedTopologyCache(cluster_snapshot)
+    return TopologyCache()
+
+
+topology_cache = process_topology_cache()
@@ -0,0 +1,54 @@
+"""
+production launcher
+
+    python serve.py --workers 4 --port 2333
+
+Runs uvicorn with several worker processes and one refresher process. The
+refresher publishes the cluster snapshot and the topology link matrices into
+shared memory, the workers and their solver processes map them read-only
+instead of each computing its own copy. `python main.py` stays the single
+process development server with reload.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+from typing import List, Optional
+
+import uvicorn
+
+from core import settings
+from scheduler.shared_snapshot import create_header, run_publisher
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    cpu_count = os.cpu_count() or 2
+    parser = argparse.ArgumentParser(description="run TanGo with several worker processes")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=2333)
+    parser.add_argument("--workers", type=int, default=cpu_count, help="serving processes")
+    parser.add_argument("--solver-processes", type=int, default=0,
+                        help="placement processes of every worker, default spreads the cores over the workers")
+    args = parser.parse_args(argv)
+
+    name = f"tango_snapshot_{os.getpid()}"
+    header = create_header(name)
+    refresher = multiprocessing.get_context("spawn").Process(
+        target=run_publisher, args=(name,), name="snapshot-refresher", daemon=True)
+    refresher.start()
+
+    # read by the settings of the workers uvicorn spawns
+    os.environ[settings.SHARED_SNAPSHOT_ENV] = name
+    os.environ["TANGO_SOLVER_PROCESSES"] = str(args.solver_processes or max(1, (cpu_count - 1) // args.workers))
+    try:
+        uvicorn.run(app="main:app", host=args.host, port=args.port, workers=args.workers)
+    finally:
+        refresher.terminate()
+        refresher.join()
+        header.close()
+        header.unlink()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
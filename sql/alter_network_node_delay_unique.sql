@@ -0,0 +1,10 @@
+-- ----------------------------
+-- one delay row per (node, geo place), the key bulk telemetry upserts hit;
+-- keeps the newest of any duplicated rows
+-- ----------------------------
+DELETE older FROM `network_node_delay` older
+  JOIN `network_node_delay` newer
+    ON older.node_id = newer.node_id AND older.geo_place_id = newer.geo_place_id AND older.id < newer.id;
+
+ALTER TABLE `network_node_delay`
+  ADD UNIQUE KEY `node_geo_place` (`node_id`, `geo_place_id`);
@@ -0,0 +1,11 @@
+-- ----------------------------
+-- track modify time of network nodes and delays, used by the incremental
+-- refresh of the in-memory cluster snapshot
+-- ----------------------------
+ALTER TABLE `network_node`
+  ADD COLUMN `mtime` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'modify time',
+  ADD KEY `mtime` (`mtime`);
+
+ALTER TABLE `network_node_delay`
+  ADD COLUMN `mtime` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'modify time',
+  ADD KEY `mtime` (`mtime`);
@@ -0,0 +1,6 @@
+-- ----------------------------
+-- (sort key, id) indexes backing keyset pagination of task sets
+-- ----------------------------
+ALTER TABLE `task_set`
+  ADD KEY `ctime_id` (`ctime`, `id`),
+  ADD KEY `mtime_id` (`mtime`, `id`);
@@ -0,0 +1,19 @@
+-- ----------------------------
+-- node to node links, the scheduler derives all pairs delay and bandwidth
+-- between network nodes from them
+-- ----------------------------
+CREATE TABLE `network_link` (
+  `id` int(10) unsigned NOT NULL AUTO_INCREMENT COMMENT 'network link id',
+  `a_node_id` int(10) unsigned NOT NULL COMMENT 'one end of the link',
+  `z_node_id` int(10) unsigned NOT NULL COMMENT 'another end of the link',
+  `delay` int(10) unsigned NOT NULL COMMENT 'link delay',
+  `bandwidth` int(10) unsigned NOT NULL COMMENT 'link bandwidth',
+  `mtime` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'modify time',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `id` (`id`),
+  KEY `a_node` (`a_node_id`),
+  KEY `z_node` (`z_node_id`),
+  KEY `mtime` (`mtime`),
+  CONSTRAINT `link a node` FOREIGN KEY (`a_node_id`) REFERENCES `network_node` (`id`),
+  CONSTRAINT `link z node` FOREIGN KEY (`z_node_id`) REFERENCES `network_node` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='links between network nodes';
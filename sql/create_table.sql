@@ -47,10 +47,32 @@ CREATE TABLE `network_node` (
   `cpu_rem` int(11) NOT NULL COMMENT 'remain cpu resource/cores',
   `mem_rem` int(11) NOT NULL COMMENT 'remain mem resource/GB',
   `disk_rem` int(11) NOT NULL COMMENT 'remain disk resource/GB',
+  `mtime` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'modify time',
   PRIMARY KEY (`id`),
-  UNIQUE KEY `id` (`id`)
+  UNIQUE KEY `id` (`id`),
+  KEY `mtime` (`mtime`)
 ) ENGINE=InnoDB AUTO_INCREMENT=11 DEFAULT CHARSET=utf8mb4 COMMENT='network node table';
 
+-- ----------------------------
+-- Table structure for network_link
+-- ----------------------------
+DROP TABLE IF EXISTS `network_link`;
+CREATE TABLE `network_link` (
+  `id` int(10) unsigned NOT NULL AUTO_INCREMENT COMMENT 'network link id',
+  `a_node_id` int(10) unsigned NOT NULL COMMENT 'one end of the link',
+  `z_node_id` int(10) unsigned NOT NULL COMMENT 'another end of the link',
+  `delay` int(10) unsigned NOT NULL COMMENT 'link delay',
+  `bandwidth` int(10) unsigned NOT NULL COMMENT 'link bandwidth',
+  `mtime` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'modify time',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `id` (`id`),
+  KEY `a_node` (`a_node_id`),
+  KEY `z_node` (`z_node_id`),
+  KEY `mtime` (`mtime`),
+  CONSTRAINT `link a node` FOREIGN KEY (`a_node_id`) REFERENCES `network_node` (`id`),
+  CONSTRAINT `link z node` FOREIGN KEY (`z_node_id`) REFERENCES `network_node` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='links between network nodes';
+
 -- ----------------------------
 -- Table structure for network_node_delay
 -- ----------------------------
@@ -60,9 +82,12 @@ CREATE TABLE `network_node_delay` (
   `node_id` int(10) unsigned NOT NULL COMMENT 'network node id',
   `geo_place_id` int(10) unsigned NOT NULL COMMENT 'geographic place id',
   `delay` int(10) unsigned NOT NULL COMMENT 'node to geo place delay',
+  `mtime` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'modify time',
   PRIMARY KEY (`id`),
   UNIQUE KEY `id` (`id`),
+  UNIQUE KEY `node_geo_place` (`node_id`, `geo_place_id`),
   KEY `node foreign key` (`node_id`),
+  KEY `mtime` (`mtime`),
   CONSTRAINT `node foreign key` FOREIGN KEY (`node_id`) REFERENCES `network_node` (`id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=4 DEFAULT CHARSET=utf8mb4 COMMENT='record delay info';
 
@@ -99,7 +124,9 @@ CREATE TABLE `task_set` (
   `ctime` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT 'create time',
   `mtime` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'modify time',
   PRIMARY KEY (`id`),
-  UNIQUE KEY `id` (`id`)
+  UNIQUE KEY `id` (`id`),
+  KEY `ctime_id` (`ctime`, `id`),
+  KEY `mtime_id` (`mtime`, `id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=10 DEFAULT CHARSET=utf8mb4 COMMENT='task set';
 
 -- ----------------------------
@@ -0,0 +1,120 @@
+"""placement engine on small hand made clusters"""
+import numpy as np
+import pytest
+
+from scheduler.engine import (BEST_FIT_DOT, DELAY_FIRST, FIRST_FIT, STRATEGIES, UNPLACED, Placement,
+                              build_cluster_arrays, build_task_arrays, feasibility_mask, place)
+from scheduler.graph import build_constraint_graph
+
+
+def make_cluster(capacity, delays=None):
+    """nodes 1..N with the given capacity rows, every node 10 away from geo place 1 unless given"""
+    nodes = [(node_id, *row) for node_id, row in enumerate(capacity, start=1)]
+    delays = delays or [10] * len(capacity)
+    return build_cluster_arrays(nodes, [(node_id, 1, delay) for node_id, delay in enumerate(delays, start=1)])
+
+
+def assert_within_capacity(cluster, tasks, placement):
+    used = placement.used(tasks, cluster.node_count)
+    assert (used <= cluster.capacity).all()
+    assert (placement.capacity == cluster.capacity - used).all()
+
+
+def test_feasibility_mask_checks_capacity_and_delay():
+    cluster = make_cluster([(4, 4, 4), (8, 8, 8), (8, 8, 8)], delays=[10, 10, 50])
+    tasks = build_task_arrays([(0, 2, 2, 2, None), (1, 6, 1, 1, 20), (2, 9, 1, 1, None)])
+
+    assert feasibility_mask(cluster, tasks).tolist() == [
+        [True, True, True],
+        [False, True, False],
+        [False, False, False],
+    ]
+    capacity = np.array([[4, 4, 4], [1, 1, 1], [8, 8, 8]])
+    assert feasibility_mask(cluster, tasks, capacity)[0].tolist() == [True, False, True]
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+def test_place_never_exceeds_capacity(strategy):
+    rng = np.random.default_rng(7)
+    cluster = make_cluster(rng.integers(4, 16, (20, 3)).tolist())
+    tasks = build_task_arrays((task_id, *rng.integers(1, 6, 3).tolist(), None) for task_id in range(120))
+
+    placement = place(cluster, tasks, strategy=strategy)
+
+    assert 0 < placement.placed_count < tasks.task_count
+    assert_within_capacity(cluster, tasks, placement)
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+def test_place_respects_delay_constraint(strategy):
+    cluster = make_cluster([(8, 8, 8)] * 3, delays=[40, 5, 20])
+    tasks = build_task_arrays([(0, 1, 1, 1, 10), (1, 1, 1, 1, 25), (2, 1, 1, 1, 1)])
+
+    placement = place(cluster, tasks, strategy=strategy)
+
+    assert placement.node_index[0] == 1
+    assert placement.node_index[1] in (1, 2)
+    assert placement.node_index[2] == UNPLACED
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+def test_tasks_that_do_not_fit_stay_unplaced(strategy):
+    cluster = make_cluster([(4, 4, 4), (4, 4, 4)])
+    tasks = build_task_arrays([(0, 3, 3, 3, None), (1, 3, 3, 3, None), (2, 3, 3, 3, None), (3, 5, 1, 1, None)])
+
+    placement = place(cluster, tasks, strategy=strategy)
+
+    assert placement.placed_count == 2
+    assert sorted(placement.node_index[:3].tolist()) == [UNPLACED, 0, 1]
+    assert placement.node_index[3] == UNPLACED
+    assert_within_capacity(cluster, tasks, placement)
+
+
+def test_strategies_pick_their_node():
+    cluster = make_cluster([(8, 8, 8), (3, 3, 3), (8, 8, 8)], delays=[30, 20, 5])
+    tasks = build_task_arrays([(0, 2, 2, 2, None)])
+
+    assert place(cluster, tasks, strategy=FIRST_FIT).node_index.tolist() == [0]
+    assert place(cluster, tasks, strategy=BEST_FIT_DOT).node_index.tolist() == [1]
+    assert place(cluster, tasks, strategy=DELAY_FIRST).node_index.tolist() == [2]
+
+
+def test_place_only_places_unplaced_tasks():
+    cluster = make_cluster([(8, 8, 8), (8, 8, 8)])
+    tasks = build_task_arrays([(0, 4, 4, 4, None), (1, 4, 4, 4, None)])
+    held = Placement(node_index=np.array([1, UNPLACED]), capacity=cluster.capacity)
+    cluster.capacity = cluster.capacity - held.used(tasks, cluster.node_count)
+
+    placement = place(cluster, tasks, node_index=held.node_index)
+
+    assert placement.node_index.tolist() == [1, 0]
+    assert placement.capacity.tolist() == [[4, 4, 4], [4, 4, 4]]
+
+
+def test_place_keeps_inter_task_constraints():
+    cluster = make_cluster([(4, 4, 4)] * 3)
+    cluster.link_delay = np.array([[0, 5, 30], [5, 0, 30], [30, 30, 0]], dtype=np.float64)
+    cluster.link_bandwidth = np.array([[np.inf, 10, 100], [10, np.inf, 10], [100, 10, np.inf]])
+    tasks = build_task_arrays([(0, 4, 4, 4, None), (1, 4, 4, 4, None), (2, 4, 4, 4, None)])
+    # 0 and 1 close to each other, 2 needs a wide link to 1, which the only node left doesn't have
+    graph = build_constraint_graph(tasks, [(0, 1, 1, 10), (1, 2, 50, None)])
+
+    placement = place(cluster, tasks, graph=graph)
+
+    assert placement.placed_count == 2
+    assert placement.node_index.tolist() == [0, 1, UNPLACED]
+
+
+def test_place_stops_at_deadline():
+    cluster = make_cluster([(8, 8, 8)])
+    tasks = build_task_arrays([(0, 1, 1, 1, None)])
+
+    placement = place(cluster, tasks, deadline=0)
+
+    assert not placement.complete
+    assert placement.node_index.tolist() == [UNPLACED]
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        place(make_cluster([(8, 8, 8)]), build_task_arrays([]), strategy="random")
@@ -0,0 +1,56 @@
+"""constraint graph components and their concurrent placement on an inline solver pool"""
+import asyncio
+
+from scheduler.engine import build_cluster_arrays, build_task_arrays
+from scheduler.executor import SolverPool
+from scheduler.graph import build_constraint_graph, connected_components, group_components, split_components
+
+
+class InlinePool(SolverPool):
+    """solver pool that places inline but splits work like a started pool of max_workers"""
+    started = True
+
+
+def make_cluster(capacity):
+    nodes = [(node_id, *row) for node_id, row in enumerate(capacity, start=1)]
+    return build_cluster_arrays(nodes, [(node_id, 1, 10) for node_id in range(1, len(capacity) + 1)])
+
+
+def test_components_are_split_and_grouped():
+    tasks = build_task_arrays([(task_id, 1, 1, 1, None) for task_id in range(7)])
+    graph = build_constraint_graph(tasks, [(0, 3, 1, None), (3, 5, 1, None), (1, 2, 1, None)])
+
+    labels = connected_components(graph)
+    components = split_components(labels)
+    groups = group_components(components, 2)
+
+    assert labels.tolist() == [0, 1, 1, 0, 4, 0, 6]
+    assert [component.tolist() for component in components] == [[0, 3, 5], [1, 2], [4], [6]]
+    assert sorted(sorted(group.tolist()) for group in groups) == [[0, 3, 5, 6], [1, 2, 4]]
+    assert len(group_components(components, 8)) == 4
+
+
+def test_place_components_merges_and_solves_conflicts_again():
+    # both components fit on node 1 alone, solved concurrently they both pick it
+    cluster = make_cluster([(4, 4, 4), (4, 4, 4)])
+    tasks = build_task_arrays([(task_id, 2, 2, 2, None) for task_id in range(4)])
+    graph = build_constraint_graph(tasks, [(0, 1, 1, None), (2, 3, 1, None)])
+
+    placement = asyncio.run(InlinePool(max_workers=2).place_components(cluster, tasks, graph))
+
+    assert placement.placed_count == 4
+    assert placement.node_index[0] == placement.node_index[1]
+    assert placement.node_index[2] == placement.node_index[3] != placement.node_index[0]
+    assert placement.capacity.tolist() == [[0, 0, 0], [0, 0, 0]]
+
+
+def test_place_components_leaves_what_does_not_fit_after_a_conflict():
+    cluster = make_cluster([(4, 4, 4), (2, 2, 2)])
+    tasks = build_task_arrays([(task_id, 2, 2, 2, None) for task_id in range(4)])
+    graph = build_constraint_graph(tasks, [(0, 1, 1, None), (2, 3, 1, None)])
+
+    placement = asyncio.run(InlinePool(max_workers=2).place_components(cluster, tasks, graph))
+
+    assert placement.placed_count == 3
+    assert (placement.used(tasks, cluster.node_count) <= cluster.capacity).all()
+    assert (placement.capacity >= 0).all()
@@ -0,0 +1,110 @@
+"""canonical task set hash and memoized placements"""
+import asyncio
+
+import numpy as np
+
+from scheduler.engine import UNPLACED, build_cluster_arrays, build_task_arrays, place
+from scheduler.graph import build_constraint_graph
+from scheduler.memo import PlacementMemo, canonical_hash, check_placement
+
+TASKS = [(0, 4, 2, 1, 30), (1, 2, 2, 2, None), (2, 1, 1, 1, 50), (3, 2, 2, 2, None)]
+CONSTRAINTS = [(0, 1, 10, 20), (1, 2, 5, None), (2, 3, 1, 40)]
+
+
+class FakeRedis:
+    """get and set of redis the memo uses"""
+
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.values[key] = value
+
+
+def task_set(tasks, constraints):
+    arrays = build_task_arrays(tasks)
+    return arrays, build_constraint_graph(arrays, constraints)
+
+
+def relabelled(tasks, constraints, ids):
+    """the same task set with task i renamed to ids[i] and the rows reversed"""
+    return task_set([(ids[task_id], *rest) for task_id, *rest in reversed(tasks)],
+                    [(ids[a], ids[z], bandwidth, delay) for a, z, bandwidth, delay in constraints])
+
+
+def make_cluster(capacity):
+    nodes = [(node_id, *row) for node_id, row in enumerate(capacity, start=1)]
+    cluster = build_cluster_arrays(nodes, [(node_id, 1, 10) for node_id in range(1, len(capacity) + 1)])
+    count = len(capacity)
+    cluster.link_delay = np.where(np.eye(count, dtype=bool), 0.0, 15.0)
+    cluster.link_bandwidth = np.where(np.eye(count, dtype=bool), np.inf, 20.0)
+    return cluster
+
+
+def test_hash_ignores_task_ids_and_order():
+    ids = {0: 17, 1: 3, 2: 99, 3: 40}
+
+    assert canonical_hash(*task_set(TASKS, CONSTRAINTS))[0] == canonical_hash(*relabelled(TASKS, CONSTRAINTS, ids))[0]
+
+
+def test_hash_changes_with_the_task_set():
+    task_hash = canonical_hash(*task_set(TASKS, CONSTRAINTS))[0]
+    more_cpu = [(0, 5, 2, 1, 30)] + TASKS[1:]
+    tighter = CONSTRAINTS[:2] + [(2, 3, 1, 35)]
+    moved = CONSTRAINTS[:2] + [(0, 3, 1, 40)]
+
+    for tasks, constraints in ((more_cpu, CONSTRAINTS), (TASKS, tighter), (TASKS, moved), (TASKS[:3], CONSTRAINTS[:2])):
+        assert canonical_hash(*task_set(tasks, constraints))[0] != task_hash
+
+
+def test_check_placement_rejects_what_no_longer_fits():
+    tasks, graph = task_set(TASKS, CONSTRAINTS)
+    cluster = make_cluster([(8, 8, 8), (8, 8, 8)])
+    node_index = np.array([0, 0, 1, 1])
+
+    placement = check_placement(cluster, tasks, graph, node_index)
+    assert placement is not None
+    assert placement.capacity.tolist() == [[2, 4, 5], [5, 5, 5]]
+
+    cluster.capacity = np.array([[8, 8, 8], [2, 8, 8]])
+    assert check_placement(cluster, tasks, graph, node_index) is None
+
+    cluster.capacity = np.array([[8, 8, 8], [8, 8, 8]])
+    assert check_placement(cluster, tasks, graph, np.array([0, UNPLACED, 1, 1])) is None
+    # 0 and 1 are 15 apart on different nodes, their constraint allows 20 but needs bandwidth 10 of 20
+    assert check_placement(cluster, tasks, graph, np.array([0, 1, 1, 1])) is not None
+    cluster.link_bandwidth[0, 1] = cluster.link_bandwidth[1, 0] = 5
+    assert check_placement(cluster, tasks, graph, np.array([0, 1, 1, 1])) is None
+
+
+def test_memo_serves_relabelled_task_sets_and_solves_again_when_capacity_is_gone():
+    memo = PlacementMemo(FakeRedis(), "test")
+    cluster = make_cluster([(8, 8, 8), (8, 8, 8)])
+    solved = []
+
+    def solver(tasks, graph):
+        async def solve():
+            solved.append(tasks.task_count)
+            return place(cluster, tasks, graph=graph)
+        return solve
+
+    async def run():
+        tasks, graph = task_set(TASKS, CONSTRAINTS)
+        first = await memo.place(cluster, tasks, graph, solver(tasks, graph))
+
+        tasks, graph = relabelled(TASKS, CONSTRAINTS, {0: 17, 1: 3, 2: 99, 3: 40})
+        second = await memo.place(cluster, tasks, graph, solver(tasks, graph))
+
+        cluster.capacity = np.array([[8, 8, 8], [0, 8, 8]])
+        third = await memo.place(cluster, tasks, graph, solver(tasks, graph))
+        return first, second, third, tasks
+
+    first, second, third, tasks = asyncio.run(run())
+    assert solved == [4, 4]
+    assert first.placed_count == second.placed_count == 4
+    # the hit keeps every task on the node of its counterpart
+    assert second.node_index.tolist() == first.node_index[[3, 2, 1, 0]].tolist()
+    assert (third.used(tasks, 2) <= np.array([[8, 8, 8], [0, 8, 8]])).all()
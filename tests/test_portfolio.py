@@ -0,0 +1,87 @@
+"""portfolio placement against scripted and inline solver pools"""
+import asyncio
+
+import numpy as np
+
+from scheduler.engine import (BEST_FIT_DOT, DELAY_FIRST, FIRST_FIT, STRATEGIES, UNPLACED, Placement,
+                              build_cluster_arrays, build_task_arrays)
+from scheduler.executor import SolverPool, SolverTimeout
+from scheduler.portfolio import place_portfolio
+
+
+class ScriptedPool:
+    """returns a fixed placement, or raises SolverTimeout for None, per strategy"""
+
+    def __init__(self, placements):
+        self.placements = placements
+        self.timeouts = []
+
+    async def place(self, cluster, tasks, timeout=None, graph=None, strategy=FIRST_FIT, partial=False):
+        self.timeouts.append(timeout)
+        placement = self.placements[strategy]
+        if placement is None:
+            raise SolverTimeout(strategy)
+        return placement
+
+
+def make_cluster(capacity):
+    nodes = [(node_id, *row) for node_id, row in enumerate(capacity, start=1)]
+    return build_cluster_arrays(nodes, [(node_id, 1, 10) for node_id in range(1, len(capacity) + 1)])
+
+
+def scripted(cluster, tasks, node_index, complete=True):
+    placement = Placement(node_index=np.array(node_index), capacity=cluster.capacity, complete=complete)
+    placement.capacity = cluster.capacity - placement.used(tasks, cluster.node_count)
+    return placement
+
+
+def test_portfolio_keeps_the_best_placement():
+    cluster = make_cluster([(8, 8, 8)] * 3)
+    tasks = build_task_arrays([(task_id, 2, 2, 2, None) for task_id in range(3)])
+    pool = ScriptedPool({
+        FIRST_FIT: scripted(cluster, tasks, [0, 1, 2]),
+        BEST_FIT_DOT: scripted(cluster, tasks, [0, 0, 0], complete=False),
+        DELAY_FIRST: scripted(cluster, tasks, [0, 0, 1]),
+    })
+
+    result = asyncio.run(place_portfolio(cluster, tasks, 0.5, pool=pool))
+
+    # every strategy placed all tasks, finished ones first, then the fewest nodes
+    assert result.strategy == DELAY_FIRST
+    assert result.placement.node_index.tolist() == [0, 0, 1]
+    assert [item.nodes_used for item in result.results] == [3, 1, 2]
+    assert pool.timeouts == [0.5] * len(STRATEGIES)
+
+
+def test_portfolio_prefers_more_placed_tasks_and_skips_timeouts():
+    cluster = make_cluster([(8, 8, 8)] * 2)
+    tasks = build_task_arrays([(task_id, 2, 2, 2, None) for task_id in range(3)])
+    pool = ScriptedPool({
+        FIRST_FIT: scripted(cluster, tasks, [0, 0, UNPLACED]),
+        BEST_FIT_DOT: None,
+        DELAY_FIRST: scripted(cluster, tasks, [0, 1, 1], complete=False),
+    })
+
+    result = asyncio.run(place_portfolio(cluster, tasks, 0.5, pool=pool))
+
+    assert result.strategy == DELAY_FIRST
+    assert [item.error for item in result.results] == [None, "timeout", None]
+
+
+def test_portfolio_without_any_placement():
+    cluster = make_cluster([(8, 8, 8)])
+    tasks = build_task_arrays([(0, 2, 2, 2, None)])
+
+    result = asyncio.run(place_portfolio(cluster, tasks, 0.5, pool=ScriptedPool(dict.fromkeys(STRATEGIES))))
+
+    assert result.strategy is None and result.placement is None
+
+
+def test_portfolio_on_an_inline_pool():
+    cluster = make_cluster([(8, 8, 8), (4, 4, 4)])
+    tasks = build_task_arrays([(task_id, 3, 3, 3, None) for task_id in range(3)])
+
+    result = asyncio.run(place_portfolio(cluster, tasks, 5, pool=SolverPool()))
+
+    assert result.placement.placed_count == 3
+    assert (result.placement.capacity >= 0).all()
@@ -0,0 +1,181 @@
+"""scheduling job queue against an in-memory redis stand-in"""
+import asyncio
+import json
+
+from scheduler.queue import SchedulingWorkerPool
+
+
+class FakeRedis:
+    """the list and sorted set commands of redis the queue uses, with a settable clock"""
+
+    def __init__(self):
+        self.lists = {}
+        self.zsets = {}
+        self.clock = 1000.0
+
+    async def time(self):
+        return int(self.clock), int(self.clock % 1 * 1e6)
+
+    async def lpush(self, key, *values):
+        for value in values:
+            self.lists.setdefault(key, []).insert(0, value.encode() if isinstance(value, str) else value)
+        return len(self.lists[key])
+
+    async def cus_lpush(self, key, value):
+        await self.lpush(key, json.dumps(value))
+
+    async def rpoplpush(self, src, dst):
+        items = self.lists.get(src)
+        if not items:
+            return None
+        value = items.pop()
+        self.lists.setdefault(dst, []).insert(0, value)
+        return value
+
+    async def list_bmove(self, src, dst, timeout=0):
+        return await self.rpoplpush(src, dst)
+
+    async def lrem(self, key, count, value):
+        items = self.lists.get(key, [])
+        if value in items:
+            items.remove(value)
+            return 1
+        return 0
+
+    async def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    async def zrangebyscore(self, key, low, high):
+        low = float(low)
+        return [member.encode() for member, score in sorted(self.zsets.get(key, {}).items(), key=lambda item: item[1])
+                if low <= score <= float(high)]
+
+    async def zrem(self, key, *members):
+        for member in members:
+            self.zsets.get(key, {}).pop(member, None)
+
+
+def make_pool(redis, consumer, handler=None, lease=30, give_up=None):
+    async def record(job):
+        pass
+
+    return SchedulingWorkerPool(redis, handler=handler or record, give_up=give_up or record, concurrency=1,
+                                queue_key="queue", processing_key="processing", consumers_key="consumers",
+                                lease=lease, dead_letter_key="dead", attempts=3, poll_timeout=0,
+                                consumer=consumer)
+
+
+def test_run_once_keeps_job_in_own_processing_list_while_handled():
+    redis = FakeRedis()
+    seen = []
+
+    async def handler(job):
+        seen.append((job, list(redis.lists["processing:a"])))
+
+    async def run():
+        pool = make_pool(redis, "a", handler)
+        await redis.cus_lpush("queue", {"task_set_id": 1})
+        return await pool.run_once(), await pool.run_once()
+
+    handled, empty = asyncio.run(run())
+    assert handled == {"task_set_id": 1}
+    assert empty is None
+    assert seen == [({"task_set_id": 1}, [b'{"task_set_id": 1}'])]
+    assert redis.lists["processing:a"] == []
+
+
+def test_failed_job_is_retried_then_dead_lettered_and_its_task_set_released():
+    redis = FakeRedis()
+    states = {1: 1}
+    calls = []
+
+    async def handler(job):
+        calls.append(job.get("attempt", 1))
+        raise RuntimeError("boom")
+
+    async def give_up(job):
+        states[job["task_set_id"]] = 0
+
+    async def run():
+        pool = make_pool(redis, "a", handler, give_up=give_up)
+        await redis.cus_lpush("queue", {"task_set_id": 1})
+        while await pool.run_once() is not None:
+            pass
+
+    asyncio.run(run())
+    assert calls == [1, 2, 3]
+    assert states == {1: 0}
+    assert redis.lists["queue"] == [] and redis.lists["processing:a"] == []
+    assert redis.lists["dead"] == [b'{"task_set_id": 1, "attempt": 3}']
+
+
+def test_job_that_is_not_json_goes_to_dead_letter_list():
+    redis = FakeRedis()
+    given_up = []
+
+    async def give_up(job):
+        given_up.append(job)
+
+    async def run():
+        await redis.lpush("queue", "{not json")
+        return await make_pool(redis, "a", give_up=give_up).run_once()
+
+    assert asyncio.run(run()) is None
+    assert redis.lists["dead"] == [b"{not json"]
+    assert redis.lists["queue"] == [] and redis.lists["processing:a"] == []
+    assert given_up == []
+
+
+def test_recover_leaves_jobs_of_live_consumers_alone():
+    redis = FakeRedis()
+
+    async def run():
+        alive, starting = make_pool(redis, "alive"), make_pool(redis, "starting")
+        await alive.heartbeat()
+        redis.lists["processing:alive"] = [b'{"task_set_id": 1}']
+        redis.clock += 10
+        await starting.heartbeat()
+        return await starting.recover()
+
+    assert asyncio.run(run()) == 0
+    assert redis.lists["processing:alive"] == [b'{"task_set_id": 1}']
+    assert redis.lists.get("queue", []) == []
+
+
+def test_recover_requeues_jobs_of_expired_consumers_once():
+    redis = FakeRedis()
+
+    async def run():
+        crashed, first, second = make_pool(redis, "crashed"), make_pool(redis, "first"), make_pool(redis, "second")
+        await crashed.heartbeat()
+        redis.lists["processing:crashed"] = [b'{"task_set_id": 2}', b'{"task_set_id": 1}']
+        redis.clock += 31
+        await first.heartbeat()
+        await second.heartbeat()
+        return await first.recover(), await second.recover()
+
+    assert asyncio.run(run()) == (2, 0)
+    assert redis.lists["queue"] == [b'{"task_set_id": 2}', b'{"task_set_id": 1}']
+    assert redis.lists["processing:crashed"] == []
+    assert set(redis.zsets["consumers"]) == {"first", "second"}
+
+
+def test_stop_requeues_own_unfinished_jobs():
+    redis = FakeRedis()
+    started = asyncio.Event()
+
+    async def run():
+        async def handler(job):
+            started.set()
+            await asyncio.sleep(60)
+
+        pool = make_pool(redis, "a", handler)
+        await redis.cus_lpush("queue", {"task_set_id": 1})
+        await pool.start()
+        await started.wait()
+        await pool.stop()
+
+    asyncio.run(run())
+    assert redis.lists["queue"] == [b'{"task_set_id": 1}']
+    assert redis.lists["processing:a"] == []
+    assert "a" not in redis.zsets["consumers"]
@@ -0,0 +1,83 @@
+"""all pairs topology on small hand made graphs"""
+import asyncio
+
+import numpy as np
+
+from scheduler.topology import Topology, TopologyCache, all_pairs
+
+INF = np.inf
+
+
+def test_all_pairs_shortest_delay_and_widest_bandwidth():
+    # 1 - 2 - 3 is slow but wide, 1 - 3 is fast but narrow, 4 hangs off 3
+    topology = all_pairs([(1, 2, 5, 100), (2, 3, 5, 100), (1, 3, 20, 10), (3, 4, 1, 50)])
+
+    assert topology.node_ids.tolist() == [1, 2, 3, 4]
+    assert topology.delay.tolist() == [
+        [0, 5, 10, 11],
+        [5, 0, 5, 6],
+        [10, 5, 0, 1],
+        [11, 6, 1, 0],
+    ]
+    assert topology.bandwidth.tolist() == [
+        [INF, 100, 100, 50],
+        [100, INF, 100, 50],
+        [100, 100, INF, 50],
+        [50, 50, 50, INF],
+    ]
+
+
+def test_all_pairs_parallel_links_and_unreachable_nodes():
+    topology = all_pairs([(1, 2, 9, 10), (2, 1, 4, 30), (3, 4, 2, 5)])
+
+    assert topology.delay.tolist() == [
+        [0, 4, INF, INF],
+        [4, 0, INF, INF],
+        [INF, INF, 0, 2],
+        [INF, INF, 2, 0],
+    ]
+    assert topology.bandwidth[0].tolist() == [INF, 30, 0, 0]
+
+
+def test_align_reorders_and_isolates_unknown_nodes():
+    topology = all_pairs([(1, 2, 5, 100), (2, 3, 5, 40)])
+
+    delay, bandwidth = topology.align(np.array([3, 7, 1]))
+
+    assert delay.tolist() == [
+        [0, INF, 10],
+        [INF, 0, INF],
+        [10, INF, 0],
+    ]
+    assert bandwidth.tolist() == [
+        [INF, 0, 40],
+        [0, INF, 0],
+        [40, 0, INF],
+    ]
+
+
+def test_align_without_links():
+    topology = all_pairs([])
+
+    delay, bandwidth = topology.align(np.array([1, 2]))
+
+    assert len(topology.node_ids) == 0
+    assert delay.tolist() == [[0, INF], [INF, 0]]
+    assert bandwidth.tolist() == [[INF, 0], [0, INF]]
+
+
+def test_cache_hands_out_no_matrices_without_links():
+    cache = TopologyCache()
+
+    async def load():
+        return cache.topology
+
+    cache.load = load
+    cache.topology = all_pairs([])
+    assert asyncio.run(cache.aligned(np.array([1, 2]))) == (None, None)
+
+    cache.topology = Topology(node_ids=np.array([1, 2]), delay=np.array([[0, 3.0], [3, 0]]),
+                              bandwidth=np.array([[INF, 8], [8, INF]]))
+    delay, bandwidth = asyncio.run(cache.aligned(np.array([2, 1])))
+    assert delay.tolist() == [[0, 3], [3, 0]]
+    assert bandwidth.tolist() == [[INF, 8], [8, INF]]
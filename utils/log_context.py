@@ -0,0 +1,31 @@
+"""log id of the current request, kept apart from utils.logger so it can be used without configuring logging"""
+import contextvars
+import random
+import string
+from datetime import datetime
+
+log_id_context = contextvars.ContextVar('log_id')
+
+
+def new_log_id() -> str:
+    time_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    ip_id = "010010010010"
+    random_id = str("".join([random.choice(string.hexdigits).capitalize() for s in range(6)]))
+    return time_id + ip_id + random_id
+
+
+def get_context_log_id():
+    """ get unique log id for current context.
+
+    Context environment can be thread or coroutine.
+    Returns:
+        str: log id for current context
+    """
+
+    log_id = log_id_context.get(None)
+    if log_id:
+        return log_id
+    else:
+        new_id = new_log_id()
+        log_id_context.set(new_id)
+        return new_id
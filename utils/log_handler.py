@@ -0,0 +1,231 @@
+"""
+log handlers
+
+Loggers only put records on a bounded queue; a single listener thread takes
+them off in batches and does the formatting, file writes and rotation, so a
+slow disk never blocks the event loop.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, TimedRotatingFileHandler
+from typing import Dict, List, Optional, Sequence
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+class ConcurrentTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    TimedRotatingFileHandler that several processes can share
+
+    Rotation runs under a lock file, and a process whose file was rotated away
+    by another one reopens it instead of writing into the rotated file.
+    """
+
+    def __init__(self, filename, *args, **kwargs):
+        super().__init__(filename, *args, **kwargs)
+        self.lock_filename = self.baseFilename + ".lock"
+
+    def _stream_is_current(self) -> bool:
+        if self.stream is None:
+            return False
+        try:
+            return os.fstat(self.stream.fileno()).st_ino == os.stat(self.baseFilename).st_ino
+        except OSError:
+            return False
+
+    def _reopen(self):
+        if self.stream is not None:
+            self.stream.close()
+        self.stream = self._open()
+
+    def doRollover(self):
+        if fcntl is None:
+            super().doRollover()
+            return
+        with open(self.lock_filename, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if self._stream_is_current():
+                    super().doRollover()
+                else:
+                    # another process rotated already, only move on to its new file
+                    self._reopen()
+                    self.rolloverAt = self.computeRollover(int(time.time()))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def emit_batch(self, records: Sequence[logging.LogRecord]):
+        """write a batch of records with one write and one flush"""
+        lines = []
+        self.acquire()
+        try:
+            for record in records:
+                if not self.filter(record):
+                    continue
+                try:
+                    if self.shouldRollover(record):
+                        if lines:
+                            self.stream.write("".join(lines))
+                            lines = []
+                        self.doRollover()
+                    lines.append(self.format(record) + self.terminator)
+                except Exception:
+                    self.handleError(record)
+            if not lines:
+                return
+            if not self._stream_is_current():
+                self._reopen()
+            self.stream.write("".join(lines))
+            self.stream.flush()
+        except Exception:
+            self.handleError(records[-1])
+        finally:
+            self.release()
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    QueueHandler that never blocks the caller
+
+    Once the queue is filled above high_water, records below WARNING are kept
+    one in sample_rate. A full queue drops records below ERROR and makes room
+    for ERROR and above by dropping the oldest record. Drops are counted and
+    reported by the listener.
+    """
+
+    def __init__(self, max_size: int, high_water: float = 0.8, sample_rate: int = 10):
+        super().__init__(queue.Queue(max_size))
+        self.max_size = max_size
+        self.high_water = int(max_size * high_water)
+        self.sample_rate = max(1, sample_rate)
+        self.dropped = 0
+        self._sampled = 0
+        self._lock = threading.Lock()
+
+    def _drop(self):
+        with self._lock:
+            self.dropped += 1
+
+    def take_dropped(self) -> int:
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+    def enqueue(self, record: logging.LogRecord):
+        if record.levelno < logging.WARNING and self.queue.qsize() >= self.high_water:
+            with self._lock:
+                self._sampled += 1
+                keep = not self._sampled % self.sample_rate
+            if not keep:
+                self._drop()
+                return
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        if record.levelno < logging.ERROR:
+            self._drop()
+            return
+        try:
+            self.queue.get_nowait()
+            self._drop()
+        except queue.Empty:
+            pass
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._drop()
+
+
+class BatchingQueueListener:
+    """
+    listener thread taking records off the queue in batches and routing them
+    to the handlers of the logger they were logged to
+    """
+    _sentinel = None
+
+    def __init__(self, handler: BoundedQueueHandler, routes: Dict[str, List[logging.Handler]],
+                 batch_size: int = 256, report_to: str = "app"):
+        self.queue = handler.queue
+        self.queue_handler = handler
+        self.routes = routes
+        self.batch_size = batch_size
+        # logger whose handlers get the dropped records warnings
+        self.report_to = report_to
+        self._resolved: Dict[str, List[logging.Handler]] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def handlers_for(self, name: str) -> List[logging.Handler]:
+        """handlers of the logger or, for child loggers like "app.scheduler", of its nearest routed parent"""
+        handlers = self._resolved.get(name)
+        if handlers is None:
+            parent = name
+            while parent not in self.routes and "." in parent:
+                parent = parent.rsplit(".", 1)[0]
+            handlers = self._resolved[name] = self.routes.get(parent, [])
+        return handlers
+
+    def _next_batch(self) -> List[logging.LogRecord]:
+        record = self.queue.get()
+        batch = [record]
+        while record is not self._sentinel and len(batch) < self.batch_size:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(record)
+        return batch
+
+    def handle_batch(self, records: List[logging.LogRecord]):
+        by_handler: Dict[logging.Handler, List[logging.LogRecord]] = {}
+        for record in records:
+            for handler in self.handlers_for(record.name):
+                if record.levelno >= handler.level:
+                    by_handler.setdefault(handler, []).append(record)
+        for handler, batch in by_handler.items():
+            if hasattr(handler, "emit_batch"):
+                handler.emit_batch(batch)
+            else:
+                for record in batch:
+                    handler.handle(record)
+
+    def report_dropped(self):
+        dropped = self.queue_handler.take_dropped()
+        if not dropped:
+            return
+        record = logging.LogRecord(self.report_to, logging.WARNING, __file__, 0,
+                                   "log queue overloaded, dropped %s records", (dropped,), None)
+        record._logid = "-"
+        self.handle_batch([record])
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is self._sentinel
+            if stop:
+                batch.pop()
+            if batch:
+                self.handle_batch(batch)
+            self.report_dropped()
+            if stop:
+                break
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="log-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """write out what is queued and stop the thread"""
+        if self._thread is None:
+            return
+        # blocking, so stop() isn't lost on a full queue
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
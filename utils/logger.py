@@ -1,14 +1,11 @@
 """define the log used globally"""
-import contextvars
+import atexit
 import logging.config
 import os
-import random
-import string
-from datetime import datetime
 
 from core import settings
-
-log_id_context = contextvars.ContextVar('log_id')
+from utils.log_context import get_context_log_id, log_id_context
+from utils.log_handler import BatchingQueueListener, BoundedQueueHandler
 
 
 class LogIdFilter(logging.Filter):
@@ -16,32 +13,13 @@ class LogIdFilter(logging.Filter):
         tags = getattr(record, "tags", None)
         if tags is None:
             setattr(record, "tags", {})
-        log_id = get_context_log_id()
+        # set already when the record went through the queue handler on the caller's thread
+        log_id = getattr(record, "_logid", None) or get_context_log_id()
         getattr(record, "tags", {})["_logid"] = log_id
         record._logid = log_id
         return True
 
 
-def get_context_log_id():
-    """ get unique log id for current context.
-
-    Context environment can be thread or coroutine.
-    Returns:
-        str: log id for current context
-    """
-
-    log_id = log_id_context.get(None)
-    if log_id:
-        return log_id
-    else:
-        time_id = datetime.now().strftime("%Y%m%d%H%M%S")
-        ip_id = "010010010010"
-        random_id = str("".join([random.choice(string.hexdigits).capitalize() for s in range(6)]))
-        new_log_id = time_id + ip_id + random_id
-        log_id_context.set(new_log_id)
-        return new_log_id
-
-
 config = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -57,18 +35,12 @@ config = {
         }
     },
     "handlers": {
-        "log_agent": {
+        "console": {
             "level": "INFO",
-            "class": "bytedlogger.StreamLogHandler",
-            "tags": {},
+            "class": "logging.StreamHandler",
+            "formatter": "default",
             "filters": ["logid_filter"],
         },
-        # "console": {
-        #     "level": "INFO",
-        #     "class": "logging.StreamHandler",
-        #     "formatter": "default",
-        #     "filters": ["logid_filter"],
-        # },
         "file_handler_info": {
             "level": "INFO",
             "class": "utils.log_handler.ConcurrentTimedRotatingFileHandler",
@@ -120,22 +92,49 @@ config = {
     },
     "loggers": {
         "request": {
-            "handlers": ["request_handler", "log_agent"],
+            "handlers": ["request_handler", "console"],
             "level": "INFO",
             "propagate": False,
         },
         "app": {
-            "handlers": ["file_handler_info", "file_handler_error", "log_agent"],
+            "handlers": ["file_handler_info", "file_handler_error", "console"],
             "level": "INFO"
         },
         "aiohttp": {
-            "handlers": ["aiohttp_handler", "log_agent"],
+            "handlers": ["aiohttp_handler", "console"],
             "level": "INFO"
         }
     }
 }
 
 logging.config.dictConfig(config)
+
+
+def start_queue_logging() -> BatchingQueueListener:
+    """
+    move the configured handlers behind one bounded queue
+
+    The loggers keep only a BoundedQueueHandler, the handlers dictConfig put
+    on them are driven by a BatchingQueueListener thread instead.
+    """
+    queue_handler = BoundedQueueHandler(settings.LOG_QUEUE_SIZE, sample_rate=settings.LOG_OVERLOAD_SAMPLE_RATE)
+    # log id comes from a contextvar, so it is read here on the caller's thread,
+    # not by the handlers on the listener thread
+    queue_handler.addFilter(LogIdFilter())
+    routes = {}
+    for name in config["loggers"]:
+        logger = logging.getLogger(name)
+        routes[name] = list(logger.handlers)
+        for handler in routes[name]:
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+    listener = BatchingQueueListener(queue_handler, routes, batch_size=settings.LOG_BATCH_SIZE)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = start_queue_logging()
 app_logger = logging.getLogger("app")
 request_logger = logging.getLogger("request")
 aiohttp_logger = logging.getLogger("aiohttp")
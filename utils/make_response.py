@@ -1,9 +1,13 @@
+import json
 from typing import Union, Type, Any
 
+import orjson
 from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
 from starlette import status
 from starlette.responses import Response
 
+from core import settings
 from utils.result_schema import SchemasType
 
 
@@ -13,6 +17,51 @@ def resp_200(code: int = 20000, data: Union[Type[SchemasType], Any] = None,
     return {"code": code, "data": data, "msg": msg}
 
 
+def _encode_default(obj: Any):
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+class EnvelopeResponse(ORJSONResponse):
+    """ORJSONResponse that also encodes pydantic models, by their dict()"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_encode_default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+# 返回 Response 时 FastAPI 不再按 response_model 校验和序列化，只在测试里打开校验
+def resp_200_fast(code: int = 20000, data: Any = None, msg: str = "Success"):
+    """
+    resp_200 encoded with orjson right away, for large read endpoints
+
+    :param code:
+    :param data: has to have the shape of the route's response_model already
+    :param msg:
+    :return:
+    """
+    if settings.VALIDATE_RESPONSES:
+        return resp_200(code=code, data=data, msg=msg)
+    return EnvelopeResponse(content={"code": code, "data": data, "msg": msg})
+
+
+def resp_200_json(text: str, code: int = 20000, msg: str = "Success"):
+    """
+    resp_200 around data that is json text already, e.g. from a cache, the
+    text is embedded without being decoded
+
+    :param text:
+    :param code:
+    :param msg:
+    :return:
+    """
+    if settings.VALIDATE_RESPONSES:
+        return resp_200(code=code, data=json.loads(text), msg=msg)
+    head = orjson.dumps({"code": code, "msg": msg})
+    return Response(content=head[:-1] + b',"data":' + text.encode() + b"}", media_type="application/json")
+
+
 def resp_400(code: int = 20000, data: str = None,
              msg: str = "Bad Request") -> Response:
     return ORJSONResponse(
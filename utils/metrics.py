@@ -0,0 +1,241 @@
+"""
+in-process metrics in the Prometheus text format
+
+Request latency, request counts and in-flight requests are recorded per route
+template by MetricsMiddleware. Database queries are attributed to the request
+that ran them through log_id_context, see db.database.InstrumentedDatabase.
+
+Numbers are per process. Under serve.py every worker keeps its own and a scrape
+is answered by whichever worker gets it, so samples carry a pid label there and
+every worker shows up as series of its own.
+"""
+import bisect
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from core import settings
+from utils.log_context import log_id_context, new_log_id
+
+LabelValues = Tuple[str, ...]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# route label of requests that match no route, keeps the label set bounded
+UNMATCHED_ROUTE = "unmatched"
+# route label of queries run outside of any request, e.g. by scheduling workers
+BACKGROUND_ROUTE = "background"
+
+
+def format_labels(names: Sequence[str], values: LabelValues, **extra: str) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        # labels of every sample, set by the registry
+        self.const_labels: Dict[str, str] = {}
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[LabelValues, float] = defaultdict(float)
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] += amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.label_names, labels, **self.const_labels)} {format_value(value)}"
+                for labels, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self._values[labels] -= amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # per label values: [count of every bucket, not cumulative], sum
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        item = self._values.get(labels)
+        if item is None:
+            item = self._values[labels] = [[0] * len(self.buckets), 0.0]
+        item[0][bisect.bisect_left(self.buckets, value)] += 1
+        item[1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = format_labels(self.label_names, labels, **self.const_labels, le=format_value(bound))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = format_labels(self.label_names, labels, **self.const_labels)
+            lines.append(f"{self.name}_sum{label_text} {format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """ 指标注册表 """
+
+    def __init__(self, const_labels: Optional[Dict[str, str]] = None):
+        self._metrics: Dict[str, Metric] = {}
+        self.const_labels = const_labels or {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        metric.const_labels = self.const_labels
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+# workers of serve.py are told apart by pid
+registry = MetricsRegistry({"pid": str(os.getpid())} if settings.SHARED_SNAPSHOT else None)
+
+REQUESTS = registry.counter("http_requests_total", "HTTP requests", ("method", "route", "status"))
+REQUEST_LATENCY = registry.histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+REQUESTS_IN_FLIGHT = registry.gauge("http_requests_in_flight", "HTTP requests being served", ("method", "route"))
+REQUEST_DB_QUERIES = registry.histogram("http_request_db_queries", "database queries per HTTP request",
+                                        ("method", "route"), QUERY_COUNT_BUCKETS)
+REQUEST_DB_TIME = registry.histogram("http_request_db_duration_seconds", "database time per HTTP request",
+                                     ("method", "route"))
+DB_QUERIES = registry.counter("db_queries_total", "database queries", ("route",))
+DB_TIME = registry.counter("db_query_duration_seconds_total", "database time", ("route",))
+
+
+class RequestStats:
+    __slots__ = ("route", "queries", "db_seconds")
+
+    def __init__(self, route: str):
+        self.route = route
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# stats of the requests being served, by log id
+_requests: Dict[str, RequestStats] = {}
+
+
+def record_query(seconds: float):
+    """account one database query to the request of the current log id"""
+    log_id = log_id_context.get(None)
+    stats: Optional[RequestStats] = _requests.get(log_id) if log_id else None
+    route = BACKGROUND_ROUTE
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += seconds
+        route = stats.route
+    DB_QUERIES.inc(route)
+    DB_TIME.inc(route, amount=seconds)
+
+
+def route_template(scope: Scope) -> str:
+    """path template of the route a request goes to, e.g. /api/scheduling/task_set/{task_set_id}"""
+    app = scope.get("app")
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """
+    pure ASGI middleware recording request metrics
+
+    Every request gets its own log id, which the database wrapper uses to
+    attribute queries to it.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = route_template(scope)
+        log_id = new_log_id()
+        token = log_id_context.set(log_id)
+        stats = _requests[log_id] = RequestStats(route)
+        status = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc(method, route)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_LATENCY.observe(time.perf_counter() - started, method, route)
+            REQUESTS_IN_FLIGHT.dec(method, route)
+            REQUESTS.inc(method, route, str(status))
+            REQUEST_DB_QUERIES.observe(stats.queries, method, route)
+            REQUEST_DB_TIME.observe(stats.db_seconds, method, route)
+            _requests.pop(log_id, None)
+            log_id_context.reset(token)
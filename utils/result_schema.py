@@ -18,10 +18,12 @@ class ResultList(GenericModel, Generic[SchemasType]):
     """
     定义分页获取数据的 model
     data_list: 当前页的数据
-    count: 总数量，并非 len(data_list)
+    count: 总数量，并非 len(data_list)，不统计时为 None
+    next_cursor: 下一页的游标，没有下一页时为 None
     """
     items: Union[SchemasType, Any]
-    count: int
+    count: Optional[int]
+    next_cursor: Optional[str] = None
 
 
 class ResultListModel(GenericModel, Generic[SchemasType]):
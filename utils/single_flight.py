@@ -0,0 +1,97 @@
+"""
+single-flight coalescing of read handlers
+
+Concurrent calls of a decorated handler with the same arguments share one call:
+the first one runs the handler, the others wait for its result. A Response is
+rendered once and every caller gets its own Response around the same bytes.
+Not Found responses are remembered for a short time, so a burst of requests for
+an id that doesn't exist (yet) costs one query too. Coalescing is per process.
+"""
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from starlette import status
+from starlette.requests import Request
+from starlette.responses import Response
+
+from core import settings
+from db.cache import LocalLRU
+from utils.metrics import registry
+
+SINGLE_FLIGHT = registry.counter("single_flight_calls_total", "coalesced handler calls by result",
+                                 ("handler", "result"))
+
+
+class RenderedResponse:
+    """status, headers and body of a Response, turned into a new Response for every caller"""
+
+    def __init__(self, response: Response):
+        self.status_code = response.status_code
+        self.headers = dict(response.headers)
+        self.body = response.body
+
+    def response(self) -> Response:
+        return Response(content=self.body, status_code=self.status_code, headers=self.headers)
+
+
+class SingleFlight:
+    """ 并发相同请求合并 """
+
+    def __init__(self, negative_size: int = settings.SINGLE_FLIGHT_NEGATIVE_SIZE,
+                 negative_ttl: float = settings.SINGLE_FLIGHT_NEGATIVE_TTL):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.negative = LocalLRU(negative_size, negative_ttl)
+
+    @staticmethod
+    def key(name: str, kwargs: dict) -> Tuple:
+        # the request object differs per call and isn't part of what is fetched
+        return (name,) + tuple(sorted((k, v) for k, v in kwargs.items() if not isinstance(v, Request)))
+
+    async def _run(self, name: str, key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            result = await call()
+            if isinstance(result, Response):
+                result = RenderedResponse(result)
+                if result.status_code == status.HTTP_404_NOT_FOUND:
+                    self.negative.set(key, result)
+            return result
+        finally:
+            del self._calls[key]
+
+    async def call(self, name: str, kwargs: dict, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        result of call, shared with the callers of the same handler and arguments
+
+        :param name: handler name
+        :param kwargs: handler arguments, part of the key
+        :param call: runs the handler
+        :return:
+        """
+        key = self.key(name, kwargs)
+        result = self.negative.get(key)
+        if result is not None:
+            SINGLE_FLIGHT.inc(name, "negative")
+        else:
+            task = self._calls.get(key)
+            if task is None:
+                SINGLE_FLIGHT.inc(name, "leader")
+                task = self._calls[key] = asyncio.ensure_future(self._run(name, key, call))
+            else:
+                SINGLE_FLIGHT.inc(name, "shared")
+            # a caller that goes away doesn't cancel the call the others wait for
+            result = await asyncio.shield(task)
+        return result.response() if isinstance(result, RenderedResponse) else result
+
+    def __call__(self, handler: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        """decorator for route handlers, applied below the route decorator"""
+        name = handler.__qualname__
+
+        @functools.wraps(handler)
+        async def wrapper(**kwargs):
+            return await self.call(name, kwargs, lambda: handler(**kwargs))
+
+        return wrapper
+
+
+single_flight = SingleFlight()